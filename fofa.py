@@ -1,3 +1,4 @@
+from __future__ import annotations # 类型注解延迟求值，扫描子进程不导入 telegram 也能定义处理函数
 import os
 import sys
 import json
@@ -5,40 +6,62 @@ import logging
 import base64
 import time
 import re
-import requests
-import httpx
 import signal
 import socket
 import hashlib
 import shutil
 import random
 import csv
+import queue
 import asyncio
-import pandas as pd
 import threading
 import zipfile
+import atexit
+import io
+import mmap
+import struct
+import gzip
+import sqlite3
 import glob
 import math
+import bisect
+import errno
+import itertools
+import ssl
+import html
+import multiprocessing
 from functools import wraps
+from collections import deque
+from array import array
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from dateutil import tz
 from urllib.parse import urlparse
 import uuid # 确保文件顶部有这行
 import resource
-import threading
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, ParseMode, ReplyKeyboardMarkup, KeyboardButton, InlineQueryResultArticle, InputTextMessageContent
-from telegram.ext import (
-    Updater,
-    CommandHandler,
-    CallbackContext,
-    ConversationHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    InlineQueryHandler, # <--- 确保有这个
-    Filters,
-)
-
-from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError, InvalidToken
+
+# 多进程分片扫描的子进程以 spawn 方式重新导入本文件 (模块名为 __mp_main__)。
+# 子进程只运行扫描代码: 跳过第三方依赖导入以及日志轮换、数据库、配置加载等模块级初始化。
+SCAN_WORKER = __name__ == '__mp_main__'
+
+if not SCAN_WORKER:
+    import requests
+    import httpx
+    import pandas as pd
+    from dateutil import tz
+    from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, ParseMode, ReplyKeyboardMarkup, KeyboardButton, InlineQueryResultArticle, InputTextMessageContent
+    from telegram.ext import (
+        Updater,
+        CommandHandler,
+        CallbackContext,
+        ConversationHandler,
+        MessageHandler,
+        CallbackQueryHandler,
+        InlineQueryHandler, # <--- 确保有这个
+        Filters,
+    )
+
+    from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError, InvalidToken
+    from apscheduler.executors.pool import ThreadPoolExecutor
 
 CONFIG_LOCK = threading.Lock()
 HISTORY_LOCK = threading.Lock()
@@ -49,18 +72,19 @@ DATA_LOCK = threading.Lock() # <--- 添加这一行
 # --- 全局变量和常量 ---
 # 全局共享的异步 HTTP 客户端
 # limits 参数直接控制连接池大小，彻底解决 FD 泄漏
-_HTTPX_LIMITS = httpx.Limits(
-    max_connections=50,        # 全局最大并发连接数
-    max_keepalive_connections=20,  # 保持活跃的连接数（复用）
-    keepalive_expiry=30.0      # 空闲连接超时关闭（秒）
-)
+if not SCAN_WORKER:
+    _HTTPX_LIMITS = httpx.Limits(
+        max_connections=50,        # 全局最大并发连接数
+        max_keepalive_connections=20,  # 保持活跃的连接数（复用）
+        keepalive_expiry=30.0      # 空闲连接超时关闭（秒）
+    )
 
-_HTTPX_TIMEOUT = httpx.Timeout(
-    connect=10.0,   # 建立连接超时
-    read=60.0,      # 读取响应超时
-    write=10.0,     # 发送请求超时
-    pool=5.0        # 从连接池获取连接的等待超时
-)
+    _HTTPX_TIMEOUT = httpx.Timeout(
+        connect=10.0,   # 建立连接超时
+        read=60.0,      # 读取响应超时
+        write=10.0,     # 发送请求超时
+        pool=5.0        # 从连接池获取连接的等待超时
+    )
 
 
 _thread_local = threading.local()
@@ -73,6 +97,7 @@ FOFA_CACHE_DIR = 'fofa_file'
 ANONYMOUS_KEYS_FILE = 'fofa_anonymous.json'
 SCAN_TASKS_FILE = 'scan_tasks.json'
 MONITOR_TASKS_FILE = 'monitor_tasks.json' # 新增监控配置
+SHARD_PLANS_FILE = 'shard_plans.json' # 分片引擎的历史消耗，用于任务预估
 MONITOR_DATA_DIR = 'monitor_data' # 新增监控数据目录
 MAX_HISTORY_SIZE = 50
 MAX_SCAN_TASKS = 50
@@ -101,6 +126,9 @@ CONTINENT_COUNTRIES = {
     'Oceania': ['AS', 'AU', 'CK', 'FJ', 'PF', 'GU', 'KI', 'MH', 'FM', 'NR', 'NC', 'NZ', 'NU', 'NF', 'MP', 'PW', 'PG', 'PN', 'WS', 'SB', 'TK', 'TO', 'TV', 'VU', 'WF']
 }
 ALL_COUNTRY_CODES = sorted(list(set(code for countries in CONTINENT_COUNTRIES.values() for code in countries)))
+# 分片下载: 数据量通常巨大的国家单独处理，其余国家按块分组 (避免 URL 过长)
+SHARDING_BIG_N = ['CN', 'US', 'DE', 'JP', 'RU', 'GB', 'FR', 'NL', 'CA', 'KR']
+SHARDING_CHUNK_SIZE = 20
 
 # --- FOFA 字段定义 ---
 FOFA_STATS_FIELDS = "protocol,domain,port,title,os,server,country,asn,org,asset_type,fid,icp"
@@ -117,14 +145,15 @@ FIELD_CATEGORIES = {
 KEY_LEVELS = {}
 
 # --- 日志配置 ---
-if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > (5 * 1024 * 1024):
-    try: os.rename(LOG_FILE, LOG_FILE + '.old')
-    except OSError as e: print(f"无法轮换日志文件: {e}")
-logging.basicConfig(
-    level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler(LOG_FILE, encoding='utf-8'), logging.StreamHandler()]
-)
-logging.getLogger("requests").setLevel(logging.WARNING); logging.getLogger("urllib3").setLevel(logging.WARNING)
+if not SCAN_WORKER:
+    if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > (5 * 1024 * 1024):
+        try: os.rename(LOG_FILE, LOG_FILE + '.old')
+        except OSError as e: print(f"无法轮换日志文件: {e}")
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[logging.FileHandler(LOG_FILE, encoding='utf-8'), logging.StreamHandler()]
+    )
+    logging.getLogger("requests").setLevel(logging.WARNING); logging.getLogger("urllib3").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # --- 会话状态定义 (v10.9.6 重构) ---
@@ -181,15 +210,34 @@ STATE_AWAITING_QUERY, STATE_AWAITING_HOST = range(1, 3)
 (
     SCAN_STATE_GET_CONCURRENCY,
     SCAN_STATE_GET_TIMEOUT,
-) = range(100, 102)
+    SCAN_STATE_GET_PROBES,
+) = range(100, 103)
 
 # /preview 预览功能
 PREVIEW_STATE_PAGINATE = 110
 
 # --- 配置管理 & 缓存 ---
+def atomic_write_json(filename, data):
+    """先写同目录临时文件并 fsync，再 rename 覆盖目标，崩溃时目标要么是旧版本要么是新版本。"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    tmp_path = f"{filename}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+            f.flush(); os.fsync(f.fileno())
+        os.replace(tmp_path, filename)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try: os.fsync(dir_fd)
+        finally: os.close(dir_fd)
+    except OSError:
+        pass # 部分平台/文件系统不支持对目录 fsync
+
 def load_json_file(filename, default_content):
     if not os.path.exists(filename):
-        with open(filename, 'w', encoding='utf-8') as f: json.dump(default_content, f, indent=4); return default_content
+        atomic_write_json(filename, default_content); return default_content
     try:
         with open(filename, 'r', encoding='utf-8') as f:
             config = json.load(f)
@@ -197,79 +245,496 @@ def load_json_file(filename, default_content):
                 for key, value in default_content.items(): config.setdefault(key, value)
             return config
     except (json.JSONDecodeError, IOError):
-        logger.error(f"{filename} 损坏，将使用默认配置重建。");
-        with open(filename, 'w', encoding='utf-8') as f: json.dump(default_content, f, indent=4); return default_content
+        # 保留损坏的原文件，便于手工找回
+        corrupt_path = f"{filename}.corrupt.{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        try: shutil.copy2(filename, corrupt_path)
+        except OSError: corrupt_path = None
+        logger.error(f"{filename} 损坏，已备份到 {corrupt_path}，将使用默认配置重建。")
+        atomic_write_json(filename, default_content); return default_content
         
+# --- 查询规范化 ---
+# 把语义相同但写法不同的 FOFA 语句 (操作数顺序、空格、引号、多余括号) 归一成同一个规范串，
+# 再取哈希作为缓存索引键。解析失败时退化为仅压缩空白，保证不会把不同的查询误判为相同。
+_QUERY_TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|(&&)|(\|\|)|("(?:[^"\\]|\\.)*")|(==|!=|\*=|~=|>=|<=|=|>|<)|([^\s()"=!<>~*&|]+))')
+
+class QuerySyntaxError(ValueError):
+    pass
+
+def _tokenize_query(query_text):
+    tokens, pos, text = [], 0, query_text.strip()
+    kinds = ('(', ')', '&&', '||', 'str', 'op', 'word')
+    while pos < len(text):
+        m = _QUERY_TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos: raise QuerySyntaxError(f"无法解析的位置: {text[pos:pos + 20]}")
+        kind = next(k for k, g in zip(kinds, m.groups()) if g is not None)
+        tokens.append((kind, m.group(m.lastindex)))
+        pos = m.end()
+    return tokens
+
+def _parse_query(tokens):
+    pos = 0
+    def peek():
+        return tokens[pos][0] if pos < len(tokens) else None
+    def take(kind):
+        nonlocal pos
+        if peek() != kind: raise QuerySyntaxError(f"期望 {kind}，得到 {peek()}")
+        pos += 1; return tokens[pos - 1][1]
+    def atom():
+        if peek() == '(':
+            take('('); node = expr(); take(')'); return node
+        if peek() == 'str': return ('leaf', take('str'))
+        field = take('word')
+        if peek() != 'op': return ('leaf', f'"{field}"')
+        field, op = field.lower(), take('op')
+        value = take('str')[1:-1] if peek() == 'str' else take('word')
+        return ('leaf', f'{field}{op}"{value}"')
+    def expr():
+        children, ops = [atom()], set()
+        while peek() in ('&&', '||'):
+            ops.add(take(peek())); children.append(atom())
+        # 同一层级混用 && 与 || 时优先级由 FOFA 决定，不做重排，交给调用方降级处理
+        if len(ops) > 1: raise QuerySyntaxError("同一层级混用 && 与 ||")
+        return children[0] if not ops else (ops.pop(), children)
+    node = expr()
+    if pos != len(tokens): raise QuerySyntaxError("存在多余的符号")
+    return node
+
+def _flatten_query(node, kind):
+    # 结合律：同类运算展开，(a && b) && c 与 a && b && c 等价
+    if node[0] != kind: return [node]
+    return [leaf for child in node[1] for leaf in _flatten_query(child, kind)]
+
+def _render_query(node, parent=None):
+    kind, payload = node
+    if kind == 'leaf': return payload
+    parts = sorted({_render_query(child, kind) for child in _flatten_query(node, kind)})
+    rendered = f" {kind} ".join(parts)
+    return rendered if parent is None or len(parts) == 1 else f"({rendered})"
+
+def canonicalize_query(query_text):
+    try:
+        return _render_query(_parse_query(_tokenize_query(query_text)))
+    except QuerySyntaxError:
+        return " ".join(query_text.split())
+
+def query_fingerprint(query_text):
+    return hashlib.sha1(canonicalize_query(query_text).encode('utf-8')).hexdigest()
+
 def find_cached_query(query_text):
     """
-    在本地历史记录中查找是否存在完全匹配的查询缓存。
+    在本地历史记录中查找语义相同 (规范化后哈希一致) 的查询缓存。
     """
-    with HISTORY_LOCK:
-        for item in HISTORY.get('queries', []):
-            if item.get('query_text') == query_text:
-                # 检查文件是否存在，防止缓存记录还在但文件被删了
-                if item.get('cache') and os.path.exists(item['cache'].get('file_path', '')):
-                    return item
+    item = STATE.get_history_by_fingerprint(query_fingerprint(query_text))
+    # 检查文件是否存在，防止缓存记录还在但文件被删了
+    if item and item.get('cache') and os.path.exists(item['cache'].get('file_path', '')):
+        CACHE_MANAGER.touch(item['cache']['file_path'])
+        return item
     return None
 
 def save_json_file(filename, data, lock=None):
     """
-    保存 JSON 文件，支持线程锁。
+    原子地保存 JSON 文件，支持线程锁。
     """
     if lock:
         with lock:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=4, ensure_ascii=False)
+            atomic_write_json(filename, data)
     else:
-        # 如果没有传入锁，则直接写入（兼容旧调用，但建议都传锁）
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        atomic_write_json(filename, data)
+
+# 每类重任务的默认并发上限，config.json 的 job_limits 可覆盖 (JobScheduler 也以它列举任务类别)
+DEFAULT_JOB_LIMITS = {"download": 3, "scan": 2, "batchfind": 2, "monitor": 4}
 
 DEFAULT_CONFIG = { 
     "bot_token": "YOUR_BOT_TOKEN_HERE", "apis": [], "admins": [], "proxy": "", 
     "proxies": [], "full_mode": False, "public_mode": False, "presets": [], 
     "update_url": "", "upload_api_url": "", "upload_api_token": "",
-    "show_download_links": True
+    "show_download_links": True, "key_max_concurrency": 1, "key_interactive_slots": 1, "interactive_workers": 8,
+    "tg_global_rate": 25, "tg_chat_edit_interval": 3, "cache_compression": "gzip", "cache_max_bytes": 5 * 1024 ** 3, "host_local_max_age": 86400,
+    "job_limits": dict(DEFAULT_JOB_LIMITS)
 }
-CONFIG = load_json_file(CONFIG_FILE, DEFAULT_CONFIG)
-HISTORY = load_json_file(HISTORY_FILE, {"queries": []})
-ANONYMOUS_KEYS = load_json_file(ANONYMOUS_KEYS_FILE, {})
-SCAN_TASKS = load_json_file(SCAN_TASKS_FILE, {})
-MONITOR_TASKS = load_json_file(MONITOR_TASKS_FILE, {}) # 加载监控任务
+# --- 状态存储 (SQLite) ---
+# 旧版本把所有状态整文件写入 JSON，监控任务一多，每次运行都要重写整个文件。
+# 现在统一落到一个 WAL 模式的 SQLite 库中，按行增量更新；内存中仍保留原有的 dict 结构，
+# save_* 只写入发生变化的行。首次启动时自动从旧 JSON 文件迁移。
+STATE_DB_FILE = 'fofa_state.db'
+
+class StateStore:
+    # 表名 -> (旧 JSON 文件, 建表语句)
+    TABLES = {
+        'config': (CONFIG_FILE, "CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT NOT NULL)"),
+        'anonymous_keys': (ANONYMOUS_KEYS_FILE, "CREATE TABLE IF NOT EXISTS anonymous_keys (key TEXT PRIMARY KEY, value TEXT NOT NULL)"),
+        'scan_tasks': (SCAN_TASKS_FILE, "CREATE TABLE IF NOT EXISTS scan_tasks (key TEXT PRIMARY KEY, value TEXT NOT NULL)"),
+        'shard_plans': (SHARD_PLANS_FILE, "CREATE TABLE IF NOT EXISTS shard_plans (key TEXT PRIMARY KEY, value TEXT NOT NULL)"),
+        'monitor_tasks': (MONITOR_TASKS_FILE, "CREATE TABLE IF NOT EXISTS monitor_tasks (key TEXT PRIMARY KEY, chat_id INTEGER, status TEXT, value TEXT NOT NULL)"),
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._shadow = {} # 表名 -> {key: 最近一次写入的 JSON}，用于计算差异
+        self.writes = 0
+        self.conn = None
+        self._open()
+
+    def _open(self):
+        self._shadow = {}
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.lock:
+            for _, ddl in self.TABLES.values():
+                self.conn.execute(ddl)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_monitor_chat ON monitor_tasks (chat_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_monitor_status ON monitor_tasks (status)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS history (query_text TEXT PRIMARY KEY, timestamp TEXT NOT NULL, cache TEXT, fingerprint TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_history_ts ON history (timestamp)")
+            if 'fingerprint' not in {row[1] for row in self.conn.execute("PRAGMA table_info(history)")}:
+                self.conn.execute("ALTER TABLE history ADD COLUMN fingerprint TEXT")
+            for (query_text,) in self.conn.execute("SELECT query_text FROM history WHERE fingerprint IS NULL").fetchall():
+                self.conn.execute("UPDATE history SET fingerprint=? WHERE query_text=?", (query_fingerprint(query_text), query_text))
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_history_fp ON history (fingerprint)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def close(self):
+        with self.lock:
+            try: self.conn.close()
+            except sqlite3.Error: pass
+
+    def restore_from(self, zf):
+        """用备份压缩包里的状态库覆盖当前库并重新打开；旧的 WAL/SHM 文件一并清掉，避免被回放到新库上。"""
+        with self.lock:
+            self.close()
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(self.path + suffix): os.remove(self.path + suffix)
+            zf.extract(os.path.basename(self.path), os.path.dirname(self.path) or '.')
+            self._open()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except Exception:
+                self.conn.execute("ROLLBACK"); raise
+            else:
+                self.conn.execute("COMMIT")
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, str(value)))
+
+    # --- 通用键值表 ---
+    def load(self, table):
+        """按插入顺序读出整张表 (SCAN_TASKS 依赖插入顺序做淘汰)。"""
+        with self.lock:
+            rows = self.conn.execute(f"SELECT key, value FROM {table} ORDER BY rowid").fetchall()
+        self._shadow[table] = dict(rows)
+        return {key: json.loads(value) for key, value in rows}
+
+    def _upsert(self, conn, table, key, value):
+        if table == 'monitor_tasks':
+            conn.execute(
+                "INSERT INTO monitor_tasks (key, chat_id, status, value) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET chat_id=excluded.chat_id, status=excluded.status, value=excluded.value",
+                (key, *self._monitor_columns(value), value))
+        else:
+            conn.execute(f"INSERT INTO {table} (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
+
+    @staticmethod
+    def _monitor_columns(value):
+        task = json.loads(value)
+        return task.get('chat_id'), task.get('status')
+
+    def sync(self, table, mapping):
+        """把内存中的 dict 与表对齐，只写变化的行，返回写入行数。"""
+        with self.lock:
+            shadow = self._shadow.setdefault(table, {})
+            current = {str(k): json.dumps(v, ensure_ascii=False, sort_keys=True) for k, v in list(mapping.items())}
+            changed = [(k, v) for k, v in current.items() if shadow.get(k) != v]
+            removed = [k for k in shadow if k not in current]
+            if not changed and not removed: return 0
+            with self.transaction() as conn:
+                for key, value in changed: self._upsert(conn, table, key, value)
+                for key in removed: conn.execute(f"DELETE FROM {table} WHERE key=?", (key,))
+            shadow.update(changed)
+            for key in removed: shadow.pop(key, None)
+            self.writes += len(changed) + len(removed)
+            return len(changed) + len(removed)
+
+    def put(self, table, key, value):
+        """单行写入，用于监控任务等热点路径。"""
+        key = str(key)
+        with self.lock:
+            shadow = self._shadow.setdefault(table, {})
+            if value is None:
+                if key not in shadow: return
+                self.conn.execute(f"DELETE FROM {table} WHERE key=?", (key,)); shadow.pop(key, None)
+            else:
+                encoded = json.dumps(value, ensure_ascii=False, sort_keys=True)
+                if shadow.get(key) == encoded: return
+                self._upsert(self.conn, table, key, encoded); shadow[key] = encoded
+            self.writes += 1
+
+    # --- 查询历史 ---
+    def load_history(self, limit):
+        with self.lock:
+            rows = self.conn.execute("SELECT query_text, timestamp, cache FROM history ORDER BY timestamp DESC LIMIT ?", (limit,)).fetchall()
+        return [{"query_text": q, "timestamp": ts, "cache": json.loads(c) if c else None} for q, ts, c in rows]
+
+    def _get_history(self, where, arg):
+        with self.lock:
+            row = self.conn.execute(f"SELECT query_text, timestamp, cache FROM history WHERE {where}=? ORDER BY timestamp DESC", (arg,)).fetchone()
+        if not row: return None
+        return {"query_text": row[0], "timestamp": row[1], "cache": json.loads(row[2]) if row[2] else None}
+
+    def get_history(self, query_text):
+        return self._get_history('query_text', query_text)
+
+    def get_history_by_fingerprint(self, fingerprint):
+        return self._get_history('fingerprint', fingerprint)
+
+    def history_cache_paths(self):
+        """返回 {缓存文件绝对路径: query_text}，供缓存清理判断文件是否仍被引用。"""
+        with self.lock:
+            rows = self.conn.execute("SELECT query_text, cache FROM history WHERE cache IS NOT NULL").fetchall()
+        paths = {}
+        for query_text, cache in rows:
+            file_path = (json.loads(cache) or {}).get('file_path')
+            if file_path: paths[os.path.abspath(file_path)] = query_text
+        return paths
+
+    def clear_history_cache(self, query_text):
+        with self.lock:
+            self.conn.execute("UPDATE history SET cache=NULL WHERE query_text=?", (query_text,))
+        self.writes += 1
+
+    def upsert_history(self, item, keep):
+        fingerprint = query_fingerprint(item['query_text'])
+        with self.transaction() as conn:
+            # 同一规范形式只保留最新的一条写法
+            conn.execute("DELETE FROM history WHERE fingerprint=? AND query_text<>?", (fingerprint, item['query_text']))
+            conn.execute(
+                "INSERT INTO history (query_text, timestamp, cache, fingerprint) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(query_text) DO UPDATE SET timestamp=excluded.timestamp, cache=excluded.cache, fingerprint=excluded.fingerprint",
+                (item['query_text'], item['timestamp'], json.dumps(item['cache'], ensure_ascii=False) if item.get('cache') else None, fingerprint))
+            conn.execute("DELETE FROM history WHERE query_text NOT IN (SELECT query_text FROM history ORDER BY timestamp DESC LIMIT ?)", (keep,))
+        self.writes += 1
+
+    # --- 旧 JSON 迁移 ---
+    def _table_empty(self, table):
+        with self.lock:
+            return self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
+
+    def _read_legacy(self, filename):
+        try:
+            with open(filename, 'r', encoding='utf-8') as f: return json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"迁移时读取 {filename} 失败: {e}"); return None
+
+    def migrate_from_json(self, force=False):
+        """把旧版 JSON 状态导入数据库。默认只导入空表；force=True 用于从旧备份恢复。"""
+        migrated = []
+        for table, (filename, _) in self.TABLES.items():
+            if table == 'config' or not os.path.exists(filename): continue
+            if not force and not self._table_empty(table): continue
+            data = self._read_legacy(filename)
+            if not isinstance(data, dict): continue
+            with self.transaction() as conn:
+                conn.execute(f"DELETE FROM {table}")
+                for key, value in data.items():
+                    self._upsert(conn, table, str(key), json.dumps(value, ensure_ascii=False, sort_keys=True))
+            self._shadow.pop(table, None)
+            os.replace(filename, filename + '.migrated')
+            migrated.append(f"{filename} ({len(data)})")
+        if os.path.exists(HISTORY_FILE) and (force or self._table_empty('history')):
+            data = self._read_legacy(HISTORY_FILE)
+            if isinstance(data, dict):
+                queries = data.get('queries', [])
+                with self.transaction() as conn:
+                    conn.execute("DELETE FROM history")
+                    for item in queries:
+                        if not item.get('query_text'): continue
+                        conn.execute("INSERT OR REPLACE INTO history (query_text, timestamp, cache, fingerprint) VALUES (?, ?, ?, ?)",
+                                     (item['query_text'], item.get('timestamp') or datetime.now(tz.tzutc()).isoformat(),
+                                      json.dumps(item['cache'], ensure_ascii=False) if item.get('cache') else None,
+                                      query_fingerprint(item['query_text'])))
+                os.replace(HISTORY_FILE, HISTORY_FILE + '.migrated')
+                migrated.append(f"{HISTORY_FILE} ({len(queries)})")
+        if migrated: logger.info(f"已将旧版 JSON 状态迁移到 {self.path}: {', '.join(migrated)}")
+        return migrated
+
+    # --- 配置 ---
+    # config.json 仍然是用户手工编辑、备份恢复的入口，数据库中保存一份按键拆分的副本。
+    # 文件比数据库新 (手工修改或恢复) 时以文件为准重新导入。
+    def load_config(self, default_content):
+        file_mtime = os.path.getmtime(CONFIG_FILE) if os.path.exists(CONFIG_FILE) else 0
+        imported_mtime = float(self.get_meta('config_mtime', 0) or 0)
+        if self._table_empty('config') or file_mtime > imported_mtime:
+            config = load_json_file(CONFIG_FILE, default_content)
+            self._shadow.pop('config', None)
+            self.sync('config', config)
+            self.set_meta('config_mtime', os.path.getmtime(CONFIG_FILE))
+            return config
+        config = self.load('config')
+        for key, value in default_content.items(): config.setdefault(key, value)
+        return config
+
+    def save_config(self, config):
+        self.sync('config', config)
+        atomic_write_json(CONFIG_FILE, config)
+        self.set_meta('config_mtime', os.path.getmtime(CONFIG_FILE))
+
+    def backup_to(self, filename):
+        """在线生成一致性快照，供 /backup 打包。"""
+        with self.lock:
+            target = sqlite3.connect(filename)
+            try: self.conn.backup(target)
+            finally: target.close()
+
+    def stats(self):
+        with self.lock:
+            counts = {table: self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in list(self.TABLES) + ['history']}
+        size = sum(os.path.getsize(p) for p in (self.path, self.path + '-wal') if os.path.exists(p))
+        return {"counts": counts, "size": size, "writes": self.writes}
+
+def load_config():
+    return STATE.load_config(DEFAULT_CONFIG)
+
+if not SCAN_WORKER:
+    STATE = StateStore(STATE_DB_FILE)
+    STATE.migrate_from_json()
+    CONFIG = load_config()
+    HISTORY = {"queries": STATE.load_history(MAX_HISTORY_SIZE)}
+    ANONYMOUS_KEYS = STATE.load('anonymous_keys')
+    SCAN_TASKS = STATE.load('scan_tasks')
+    MONITOR_TASKS = STATE.load('monitor_tasks') # 加载监控任务
+    SHARD_PLANS = STATE.load('shard_plans')
+# --- 延迟合并写入 ---
+# 保存请求先登记到 PERSIST，窗口期内对同一对象的多次保存只落盘一次；
+# 进程退出、备份和恢复前会主动 flush。
+PERSIST_DEBOUNCE_SECONDS = 2.0
+
+class DebouncedPersister:
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.pending = {} # 名称 -> 写入函数，同名请求后到覆盖先到
+        self.timer = None
+        self.frozen = False
+        self.stats = {'requested': 0, 'flushed': 0, 'failed': 0}
+
+    def schedule(self, name, writer):
+        with self.lock:
+            if self.frozen: return
+            self.pending[name] = writer
+            self.stats['requested'] += 1
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.frozen: return
+            pending, self.pending = self.pending, {}
+            if self.timer is not None: self.timer.cancel(); self.timer = None
+        for name, writer in pending.items():
+            try:
+                writer(); self.stats['flushed'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error(f"持久化 {name} 失败，稍后重试: {e}", exc_info=True)
+                with self.lock: self.pending.setdefault(name, writer)
+        with self.lock:
+            if self.pending and self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def freeze(self):
+        """
+        恢复备份开始时调用: 丢弃尚未落盘的请求，并拒绝之后的 schedule/flush (包括退出时的 atexit 落盘)，
+        避免内存中的旧状态在重启前写回覆盖刚恢复的数据。
+        """
+        with self.lock:
+            self.frozen = True
+            self.pending.clear()
+            if self.timer is not None: self.timer.cancel(); self.timer = None
+
+    def thaw(self):
+        """恢复失败、机器人继续运行时重新允许落盘。"""
+        with self.lock: self.frozen = False
+
+PERSIST = DebouncedPersister(PERSIST_DEBOUNCE_SECONDS)
+if not SCAN_WORKER: atexit.register(PERSIST.flush)
+
+def _write_config():
+    with CONFIG_LOCK:
+        STATE.save_config(CONFIG)
+
+def _write_table(table, mapping):
+    with DATA_LOCK:
+        return STATE.sync(table, mapping)
+
 def save_config(): 
-    save_json_file(CONFIG_FILE, CONFIG, lock=CONFIG_LOCK)
+    PERSIST.schedule('config', _write_config)
 
 def save_anonymous_keys(): 
-    save_json_file(ANONYMOUS_KEYS_FILE, ANONYMOUS_KEYS, lock=DATA_LOCK)
+    PERSIST.schedule('anonymous_keys', lambda: _write_table('anonymous_keys', ANONYMOUS_KEYS))
+
+def save_shard_plans():
+    PERSIST.schedule('shard_plans', lambda: _write_table('shard_plans', SHARD_PLANS))
 
 def save_scan_tasks():
-    logger.info(f"Saving {len(SCAN_TASKS)} scan tasks to {SCAN_TASKS_FILE}")
-    save_json_file(SCAN_TASKS_FILE, SCAN_TASKS, lock=DATA_LOCK)
+    def writer():
+        written = _write_table('scan_tasks', SCAN_TASKS)
+        logger.info(f"Saved scan tasks ({written} rows changed, {len(SCAN_TASKS)} total)")
+    PERSIST.schedule('scan_tasks', writer)
 
 def save_monitor_tasks():
-    save_json_file(MONITOR_TASKS_FILE, MONITOR_TASKS, lock=DATA_LOCK)
+    PERSIST.schedule('monitor_tasks', lambda: _write_table('monitor_tasks', MONITOR_TASKS))
+
+def save_monitor_task(task_id):
+    """只写入单个监控任务，监控执行的热点路径使用。"""
+    def writer():
+        with DATA_LOCK:
+            STATE.put('monitor_tasks', task_id, MONITOR_TASKS.get(task_id))
+    PERSIST.schedule(f"monitor_task:{task_id}", writer)
 
 def add_or_update_query(query_text, cache_data=None):
-    # 使用锁确保 修改内存数据 和 写入文件 是原子操作
     with HISTORY_LOCK:
-        existing_query = next((q for q in HISTORY['queries'] if q['query_text'] == query_text), None)
+        # 按指纹索引查库，再用库中记录的原始写法定位内存条目，不对每条历史重新计算指纹
+        existing_query = STATE.get_history_by_fingerprint(query_fingerprint(query_text))
+        if existing_query:
+            existing_query = next((q for q in HISTORY['queries'] if q['query_text'] == existing_query['query_text']), existing_query)
         if existing_query:
-            HISTORY['queries'].remove(existing_query)
+            HISTORY['queries'] = [q for q in HISTORY['queries'] if q['query_text'] != existing_query['query_text']]
+            existing_query['query_text'] = query_text
             existing_query['timestamp'] = datetime.now(tz.tzutc()).isoformat()
             if cache_data: existing_query['cache'] = cache_data
             HISTORY['queries'].insert(0, existing_query)
         else:
-            new_query = {"query_text": query_text, "timestamp": datetime.now(tz.tzutc()).isoformat(), "cache": cache_data}
-            HISTORY['queries'].insert(0, new_query)
+            existing_query = {"query_text": query_text, "timestamp": datetime.now(tz.tzutc()).isoformat(), "cache": cache_data}
+            HISTORY['queries'].insert(0, existing_query)
         
         while len(HISTORY['queries']) > MAX_HISTORY_SIZE: 
             HISTORY['queries'].pop()
         
-        # 这里直接调用带锁的保存，或者因为已经在 with HISTORY_LOCK 里了，
-        # 为了避免死锁，这里直接写文件，或者调用时传入 None (因为外层已经锁了)
-        # 最安全的做法是直接在这里写文件：
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f: 
-            json.dump(HISTORY, f, indent=4, ensure_ascii=False)
+        # 只写入这一行，并在库中裁剪超出上限的旧记录
+        STATE.upsert_history(existing_query, MAX_HISTORY_SIZE)
+
+def clear_query_cache(query_text):
+    """缓存文件被淘汰后同时清掉库中和内存历史条目上的 cache，避免下次 add_or_update_query 把失效路径写回。"""
+    with HISTORY_LOCK:
+        STATE.clear_history_cache(query_text)
+        for item in HISTORY['queries']:
+            if item['query_text'] == query_text: item['cache'] = None
 
 # --- 辅助函数与装饰器 ---
 def generate_filename_from_query(query_text: str, prefix: str = "fofa", ext: str = ".txt") -> str:
@@ -330,9 +795,585 @@ def create_progress_bar(percentage: float, length: int = 10) -> str:
     bar = '█' * filled_length + '░' * (length - filled_length)
     return f"[{bar}] {percentage:.1f}%"
 
+# --- 结果缓存压缩 ---
+# 缓存目录中的结果文件按配置压缩存储 (gzip / zstd / none)，读写统一走 open_cache_file，
+# 旧的明文 .txt 缓存按扩展名识别，照常可读。
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CACHE_CODECS = {'gzip': '.gz', 'zstd': '.zst'}
+_ZSTD_FALLBACK_WARNED = False
+
+def get_cache_codec():
+    codec = str(CONFIG.get('cache_compression', 'gzip')).lower()
+    if codec == 'zstd' and zstandard is None:
+        global _ZSTD_FALLBACK_WARNED
+        if not _ZSTD_FALLBACK_WARNED:
+            logger.warning("未安装 zstandard 模块，缓存压缩回退为 gzip。"); _ZSTD_FALLBACK_WARNED = True
+        return 'gzip'
+    return codec if codec in CACHE_CODECS else None
+
+def cache_codec_of(path):
+    return next((codec for codec, ext in CACHE_CODECS.items() if path.endswith(ext)), None)
+
+def cache_file_path(filename):
+    codec = get_cache_codec()
+    return os.path.join(FOFA_CACHE_DIR, filename + (CACHE_CODECS[codec] if codec else ''))
+
+def open_cache_file(path, mode='r'):
+    """按扩展名透明地读写缓存文件。
+    'r' 返回 utf-8 文本流；'w' 返回按块写入并在关闭时生成行索引的 BlockCacheWriter；带 'b' 时返回字节流。"""
+    codec = cache_codec_of(path)
+    if mode == 'w': return BlockCacheWriter(path)
+    text_kwargs = {} if 'b' in mode else {'encoding': 'utf-8', 'errors': 'ignore'}
+    if codec == 'gzip':
+        return gzip.open(path, mode if 'b' in mode else mode + 't', compresslevel=6, **text_kwargs)
+    if codec == 'zstd':
+        if zstandard is None: raise RuntimeError(f"读取 {os.path.basename(path)} 需要 zstandard 模块")
+        if mode == 'r':
+            # 块格式的缓存由多个 zstd frame 组成，需要跨 frame 连续读取
+            reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+            return io.TextIOWrapper(reader, **text_kwargs)
+        return zstandard.open(path, mode, **text_kwargs)
+    return open(path, mode, **text_kwargs)
+
+def compress_file(src_path, dst_path):
+    """流式地把文件写成压缩文件 (编码由 dst_path 扩展名决定)，不整份读入内存。"""
+    with open(src_path, 'rb') as src, open_cache_file(dst_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    return dst_path
+
+def store_cache_file(src_path, filename):
+    """把明文结果文件移入缓存目录，按配置压缩并建立行索引，返回缓存路径。"""
+    os.makedirs(FOFA_CACHE_DIR, exist_ok=True)
+    cache_path = cache_file_path(filename)
+    if cache_codec_of(cache_path):
+        with open(src_path, 'r', encoding='utf-8', errors='ignore') as src, open_cache_file(cache_path, 'w') as dst:
+            dst.writelines(src)
+        os.remove(src_path)
+    else:
+        shutil.move(src_path, cache_path)
+        line_index(cache_path)
+    return cache_path
+
+# --- 缓存文件行索引 ---
+# 结果文件按 CACHE_BLOCK_LINES 行切块写入，压缩文件的每一块都是独立的 gzip member / zstd frame
+# (整体仍是合法的 .gz / .zst，外部工具照常解压)。旁路索引 <file>.idx 记录每块的起始字节偏移，
+# 读取时 mmap 索引，计数 O(1)，翻页只解压目标块。明文文件 (监控数据) 追加后索引按增量补齐。
+# 没有索引的旧格式压缩缓存在后台线程重写成块格式，重写完成前读取退化为顺序扫描。
+CACHE_BLOCK_LINES = 10000
+LINE_INDEX_SUFFIX = '.idx'
+_LINE_INDEX_MAGIC = 0x31584449 # "IDX1"
+_LINE_INDEX_GUARD = threading.Lock()
+_LINE_INDEX_LOCKS = {} # 文件路径 -> 锁，不同文件的索引维护互不阻塞
+_LINE_INDEX_MIGRATING = set()
+
+def _line_index_lock(path):
+    with _LINE_INDEX_GUARD:
+        return _LINE_INDEX_LOCKS.setdefault(path, threading.Lock())
+
+def _compress_block(payload, codec):
+    if codec == 'gzip': return gzip.compress(payload, compresslevel=6)
+    if codec == 'zstd': return zstandard.ZstdCompressor(level=3).compress(payload)
+    return payload
+
+def _decompress_block(data, codec):
+    if codec == 'gzip': return gzip.decompress(data)
+    if codec == 'zstd': return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+class LineIndex:
+    # 布局 (uint64): magic, block_lines, total_lines, covered_bytes, 之后是每块的起始偏移
+    HEADER = struct.Struct('=4Q')
+
+    def __init__(self, block_lines=CACHE_BLOCK_LINES, total=0, covered=0, offsets=None):
+        self.block_lines, self.total, self.covered = block_lines, total, covered
+        self.offsets = offsets if offsets is not None else array('Q')
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path + LINE_INDEX_SUFFIX, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, block_lines, total, covered = cls.HEADER.unpack_from(mm, 0)
+                if magic != _LINE_INDEX_MAGIC: return None
+                offsets = array('Q'); offsets.frombytes(mm[cls.HEADER.size:])
+                return cls(block_lines, total, covered, offsets)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def save(self, path):
+        tmp_path = path + LINE_INDEX_SUFFIX + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(_LINE_INDEX_MAGIC, self.block_lines, self.total, self.covered))
+            f.write(self.offsets.tobytes())
+        os.replace(tmp_path, path + LINE_INDEX_SUFFIX)
+
+    def block_range(self, block):
+        end = self.offsets[block + 1] if block + 1 < len(self.offsets) else self.covered
+        return self.offsets[block], end
+
+class BlockCacheWriter:
+    """按块写入缓存文件，关闭时写出行索引。接口与文本文件对象一致 (write / writelines / with)。"""
+    def __init__(self, path):
+        self.path, self.codec = path, cache_codec_of(path)
+        self.raw = open(path, 'wb')
+        self.index = LineIndex()
+        self.pending, self.partial = [], ''
+
+    def write(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.pending.append(line)
+            if len(self.pending) >= self.index.block_lines: self._flush_block()
+        return len(text)
+
+    def writelines(self, lines):
+        for line in lines: self.write(line)
+
+    def _flush_block(self):
+        if not self.pending: return
+        self.index.offsets.append(self.raw.tell())
+        self.index.total += len(self.pending)
+        self.raw.write(_compress_block(('\n'.join(self.pending) + '\n').encode('utf-8'), self.codec))
+        self.pending = []
+
+    def close(self):
+        if self.raw.closed: return
+        if self.partial: self.pending.append(self.partial); self.partial = ''
+        self._flush_block()
+        self.index.covered = self.raw.tell()
+        self.raw.close()
+        self.index.save(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _extend_plain_index(path, index):
+    """从已索引的位置继续扫描明文文件，只处理新追加的部分。"""
+    with open(path, 'rb') as f:
+        f.seek(index.covered)
+        pos = index.covered
+        for line in f:
+            if not line.endswith(b'\n'): break # 半行 (正在追加) 留到下次
+            if index.total % index.block_lines == 0: index.offsets.append(pos)
+            index.total += 1; pos += len(line)
+        index.covered = pos
+
+def _migrate_legacy_cache(path):
+    """把旧格式的压缩缓存重写成块格式。重写在锁外进行，只有替换文件时才持有该文件的锁。"""
+    tmp_path = path + '.rebuild' + CACHE_CODECS[cache_codec_of(path)]
+    try:
+        with open_cache_file(path) as src, open_cache_file(tmp_path, 'w') as dst:
+            dst.writelines(src)
+        with _line_index_lock(path):
+            os.replace(tmp_path, path); os.replace(tmp_path + LINE_INDEX_SUFFIX, path + LINE_INDEX_SUFFIX)
+        logger.info(f"旧格式缓存已重写为块格式: {os.path.basename(path)}")
+    except Exception as e:
+        logger.warning(f"重写旧格式缓存 {os.path.basename(path)} 失败: {e}")
+        for leftover in (tmp_path, tmp_path + LINE_INDEX_SUFFIX):
+            try: os.remove(leftover)
+            except OSError: pass
+    finally:
+        with _LINE_INDEX_GUARD: _LINE_INDEX_MIGRATING.discard(path)
+
+def line_index(path):
+    """
+    返回文件的行索引，明文文件缺失或过期时就地补建。
+    没有索引的旧格式压缩缓存返回 None，并在后台重写 (每个文件同时只有一个重写线程)。
+    """
+    with _line_index_lock(path):
+        index = LineIndex.load(path)
+        size = os.path.getsize(path)
+        if index and index.covered == size: return index
+        if cache_codec_of(path) is None:
+            if not index or index.covered > size: index = LineIndex()
+            _extend_plain_index(path, index)
+            index.save(path)
+            return index
+    with _LINE_INDEX_GUARD:
+        if path in _LINE_INDEX_MIGRATING: return None
+        _LINE_INDEX_MIGRATING.add(path)
+    threading.Thread(target=_migrate_legacy_cache, args=(path,), daemon=True, name="cache_migrate").start()
+    return None
+
+def count_lines(path):
+    index = line_index(path)
+    if index: return index.total
+    with open_cache_file(path) as f:
+        return sum(1 for _ in f)
+
+def read_lines(path, start, count):
+    """随机读取第 start 行起的 count 行 (从 0 开始)，只解压涉及的块；旧格式缓存顺序跳读。"""
+    index = line_index(path)
+    if index is None:
+        with open_cache_file(path) as f:
+            return [line.rstrip('\n') for line in itertools.islice(f, start, start + max(count, 0))]
+    if start >= index.total or count <= 0: return []
+    codec, lines = cache_codec_of(path), []
+    first_block, last_block = start // index.block_lines, min(start + count - 1, index.total - 1) // index.block_lines
+    with open(path, 'rb') as f:
+        for block in range(first_block, last_block + 1):
+            begin, end = index.block_range(block)
+            f.seek(begin)
+            lines.extend(_decompress_block(f.read(end - begin), codec).decode('utf-8', errors='ignore').splitlines())
+    skip = start - first_block * index.block_lines
+    return lines[skip:skip + count]
+
+# --- 缓存容量管理 ---
+# 历史记录只保留 MAX_HISTORY_SIZE 条，被挤出的条目、上传的临时文件等都会留在缓存目录里。
+# CacheManager 定期清理无人引用的文件，并在总量超出预算时按最近访问时间 (mtime) 淘汰缓存。
+DEFAULT_CACHE_MAX_BYTES = 5 * 1024 ** 3
+CACHE_ORPHAN_GRACE = 6 * 3600  # 无主文件的保留时间，给仍在写入的下载任务和临时文件留余量
+CACHE_SWEEP_INTERVAL = 3600
+
+class CacheManager:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.stats = {'orphans_removed': 0, 'evicted': 0, 'freed_bytes': 0, 'last_sweep': 0}
+
+    def budget(self):
+        return int(CONFIG.get('cache_max_bytes', DEFAULT_CACHE_MAX_BYTES))
+
+    def touch(self, path):
+        """缓存命中时刷新 mtime，作为 LRU 的访问时间。"""
+        try: os.utime(path, None)
+        except OSError: pass
+
+    def _scan(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir): return entries
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if os.path.isfile(path): entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def _remove(self, path, size):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"清理缓存文件 {path} 失败: {e}"); return False
+        self.stats['freed_bytes'] += size
+        return True
+
+    def sweep(self):
+        """清理无主文件并执行 LRU 淘汰，返回清理后的总占用字节数。"""
+        with self.lock:
+            referenced = STATE.history_cache_paths()
+            now, total, owned = time.time(), 0, []
+            for path, size, mtime in self._scan():
+                if path.endswith(LINE_INDEX_SUFFIX):
+                    # 行索引跟随主文件，主文件不在了就直接删除
+                    if os.path.exists(path[:-len(LINE_INDEX_SUFFIX)]): total += size
+                    elif self._remove(path, size): self.stats['orphans_removed'] += 1
+                    continue
+                query_text = referenced.get(os.path.abspath(path))
+                if query_text is not None:
+                    owned.append((mtime, path, size, query_text)); total += size
+                elif now - mtime > CACHE_ORPHAN_GRACE and self._remove(path, size):
+                    self.stats['orphans_removed'] += 1
+                else:
+                    total += size
+            budget = self.budget()
+            for mtime, path, size, query_text in sorted(owned):
+                if total <= budget: break
+                if self._remove(path, size):
+                    clear_query_cache(query_text)
+                    total -= size; self.stats['evicted'] += 1
+                    index_path = path + LINE_INDEX_SUFFIX
+                    if os.path.exists(index_path):
+                        index_size = os.path.getsize(index_path)
+                        if self._remove(index_path, index_size): total -= index_size
+            self.stats['last_sweep'] = now
+            if self.stats['orphans_removed'] or self.stats['evicted']:
+                logger.info(f"缓存清理完成: 占用 {total / 1024 ** 2:.1f} MB，累计清理无主文件 {self.stats['orphans_removed']} 个，淘汰 {self.stats['evicted']} 个")
+            return total
+
+    def usage(self):
+        entries = self._scan()
+        return sum(size for _, size, _ in entries), len(entries)
+
+CACHE_MANAGER = CacheManager(FOFA_CACHE_DIR)
+
+def cache_maintenance_job(context: CallbackContext):
+    try:
+        CACHE_MANAGER.sweep()
+    except Exception as e:
+        logger.error(f"缓存维护任务出错: {e}", exc_info=True)
+
+# --- 本地资产库 ---
+# 所有下载结果 (host 或 /batch 的自定义字段) 都会落入 fofa_assets.db：
+#   assets        每个 host 一行，country/org/server/protocol 等重复度高的列字典编码，记录 first_seen/last_seen
+#   queries       按规范化指纹区分的查询
+#   query_assets  查询 × host 的归属关系，按首次入库日期分区 (day)
+# 过滤、投影和再导出都在本地完成，不再消耗 FOFA 额度。
+ASSET_DB_FILE = 'fofa_assets.db'
+ASSET_DICT_COLUMNS = ('protocol', 'country', 'org', 'server')
+ASSET_PLAIN_COLUMNS = ('ip', 'port', 'title', 'domain')
+ASSET_DEFAULT_COLUMNS = ('host', 'ip', 'port', 'protocol', 'country', 'org', 'server', 'title', 'domain', 'first_seen', 'last_seen')
+ASSET_INGEST_BATCH = 5000
+_HOST_PORT_RE = re.compile(r':(\d{1,5})/?$')
+_IPV4_RE = re.compile(r'^(?:\d{1,3}\.){3}\d{1,3}$')
+
+class AssetStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._dict_ids = {} # (列名, 值) -> id
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS dictionary (id INTEGER PRIMARY KEY, col TEXT NOT NULL, value TEXT NOT NULL, UNIQUE (col, value));
+            CREATE TABLE IF NOT EXISTS assets (
+                host TEXT PRIMARY KEY, ip TEXT, port INTEGER,
+                protocol INTEGER, country INTEGER, org INTEGER, server INTEGER,
+                title TEXT, domain TEXT, extra TEXT, first_seen INTEGER NOT NULL, last_seen INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS idx_assets_last_seen ON assets (last_seen);
+            CREATE INDEX IF NOT EXISTS idx_assets_ip ON assets (ip);
+            CREATE INDEX IF NOT EXISTS idx_assets_port ON assets (port);
+            CREATE INDEX IF NOT EXISTS idx_assets_country ON assets (country);
+            CREATE INDEX IF NOT EXISTS idx_assets_domain ON assets (domain);
+            CREATE INDEX IF NOT EXISTS idx_assets_host_lower ON assets (lower(host));
+            CREATE INDEX IF NOT EXISTS idx_assets_domain_lower ON assets (lower(domain));
+            CREATE TABLE IF NOT EXISTS imported_files (path TEXT PRIMARY KEY, mtime REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS queries (
+                id INTEGER PRIMARY KEY, fingerprint TEXT UNIQUE NOT NULL, query_text TEXT NOT NULL,
+                first_seen INTEGER NOT NULL, last_seen INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS query_assets (
+                query_id INTEGER NOT NULL, host TEXT NOT NULL, day TEXT NOT NULL,
+                first_seen INTEGER NOT NULL, last_seen INTEGER NOT NULL,
+                PRIMARY KEY (query_id, host)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_query_assets_day ON query_assets (query_id, day);
+        """)
+
+    def _dict_id(self, col, value):
+        if value in (None, ''): return None
+        key = (col, str(value))
+        cached = self._dict_ids.get(key)
+        if cached is None:
+            self.conn.execute("INSERT OR IGNORE INTO dictionary (col, value) VALUES (?, ?)", key)
+            cached = self.conn.execute("SELECT id FROM dictionary WHERE col=? AND value=?", key).fetchone()[0]
+            self._dict_ids[key] = cached
+        return cached
+
+    def _query_id(self, query_text, now):
+        fingerprint = query_fingerprint(query_text)
+        self.conn.execute(
+            "INSERT INTO queries (fingerprint, query_text, first_seen, last_seen) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(fingerprint) DO UPDATE SET query_text=excluded.query_text, last_seen=MAX(last_seen, excluded.last_seen)",
+            (fingerprint, query_text, now, now))
+        return self.conn.execute("SELECT id FROM queries WHERE fingerprint=?", (fingerprint,)).fetchone()[0]
+
+    @staticmethod
+    def _normalize_row(row, fields):
+        record = {'host': row} if isinstance(row, str) else dict(zip(fields, row if isinstance(row, (list, tuple)) else [row]))
+        record = {k: v for k, v in record.items() if v not in (None, '')}
+        host = record.get('host')
+        if not host and record.get('ip'):
+            host = f"{record['ip']}:{record['port']}" if record.get('port') else record['ip']
+        if not host: return None
+        record['host'] = host = str(host).strip()
+        if 'port' not in record:
+            m = _HOST_PORT_RE.search(host)
+            if m: record['port'] = m.group(1)
+        if 'ip' not in record:
+            bare = host.split('://', 1)[-1].rsplit(':', 1)[0]
+            if _IPV4_RE.match(bare): record['ip'] = bare
+        try:
+            record['port'] = int(record['port']) if 'port' in record else None
+        except (TypeError, ValueError):
+            record['port'] = None
+        return record
+
+    def ingest(self, query_text, rows, fields=("host",), seen_at=None):
+        """把一批结果写入资产库，返回写入的 host 数。rows 为 host 字符串或与 fields 对应的列表。
+        seen_at 用于回填历史文件时指定观测时间，默认当前时间。"""
+        fields = [f.strip() for f in (fields.split(',') if isinstance(fields, str) else fields)]
+        now = int(seen_at or time.time()); day = datetime.fromtimestamp(now).strftime('%Y-%m-%d')
+        known = set(ASSET_DICT_COLUMNS) | set(ASSET_PLAIN_COLUMNS) | {'host'}
+        written, batch = 0, []
+        def flush():
+            nonlocal written
+            if not batch: return
+            with self.lock:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    query_id = self._query_id(query_text, now) if query_text else None
+                    asset_rows, link_rows = [], []
+                    for record in batch:
+                        extra = {k: v for k, v in record.items() if k not in known}
+                        asset_rows.append((
+                            record['host'], record.get('ip'), record.get('port'),
+                            *[self._dict_id(col, record.get(col)) for col in ASSET_DICT_COLUMNS],
+                            record.get('title'), record.get('domain'),
+                            json.dumps(extra, ensure_ascii=False) if extra else None, now, now))
+                        if query_id is not None: link_rows.append((query_id, record['host'], day, now, now))
+                    self.conn.executemany(
+                        "INSERT INTO assets (host, ip, port, protocol, country, org, server, title, domain, extra, first_seen, last_seen) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(host) DO UPDATE SET "
+                        "ip=COALESCE(excluded.ip, ip), port=COALESCE(excluded.port, port), "
+                        "protocol=COALESCE(excluded.protocol, protocol), country=COALESCE(excluded.country, country), "
+                        "org=COALESCE(excluded.org, org), server=COALESCE(excluded.server, server), "
+                        "title=COALESCE(excluded.title, title), domain=COALESCE(excluded.domain, domain), "
+                        "extra=CASE WHEN excluded.extra IS NULL THEN extra WHEN extra IS NULL THEN excluded.extra ELSE json_patch(extra, excluded.extra) END, "
+                        "first_seen=MIN(first_seen, excluded.first_seen), last_seen=MAX(last_seen, excluded.last_seen)", asset_rows)
+                    if link_rows:
+                        self.conn.executemany(
+                            "INSERT INTO query_assets (query_id, host, day, first_seen, last_seen) VALUES (?, ?, ?, ?, ?) "
+                            "ON CONFLICT(query_id, host) DO UPDATE SET first_seen=MIN(first_seen, excluded.first_seen), "
+                            "last_seen=MAX(last_seen, excluded.last_seen)", link_rows)
+                except Exception:
+                    # 回滚会撤销本批新插入的字典项，缓存里的 id 随之失效
+                    self.conn.execute("ROLLBACK"); self._dict_ids.clear(); raise
+                self.conn.execute("COMMIT")
+            written += len(batch); batch.clear()
+        for row in rows:
+            record = self._normalize_row(row, fields)
+            if record: batch.append(record)
+            if len(batch) >= ASSET_INGEST_BATCH: flush()
+        flush()
+        return written
+
+    def _column_sql(self, col):
+        if col in ASSET_DICT_COLUMNS: return f"(SELECT value FROM dictionary WHERE id=a.{col})"
+        if col in ('first_seen', 'last_seen'): return f"datetime(a.{col}, 'unixepoch', 'localtime')"
+        if col == 'host' or col in ASSET_PLAIN_COLUMNS: return f"a.{col}"
+        return f"json_extract(a.extra, '$.\"{col}\"')"
+
+    def _iter_rows(self, sql, params, batch=1000):
+        """在独立的只读连接上分批读取游标：导出大量资产时不整表读入内存，也不占用写入锁。"""
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=30)
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows: break
+                yield from rows
+        finally:
+            conn.close()
+
+    def select(self, columns=None, filters=None, query_text=None, since=None, limit=None):
+        """按条件查询资产，返回 (列名, 行迭代器)。filters 为 {列名: 值}，since 为秒数。"""
+        columns = [c for c in (columns or ASSET_DEFAULT_COLUMNS) if re.match(r'^[\w.]+$', c)]
+        sql = [f"SELECT {', '.join(self._column_sql(c) for c in columns)} FROM assets a"]
+        where, params = [], []
+        if query_text:
+            sql.append("JOIN query_assets qa ON qa.host = a.host JOIN queries q ON q.id = qa.query_id AND q.fingerprint = ?")
+            params.append(query_fingerprint(query_text))
+        for col, value in (filters or {}).items():
+            if not re.match(r'^[\w.]+$', col): continue
+            if col in ASSET_DICT_COLUMNS:
+                where.append(f"a.{col} = (SELECT id FROM dictionary WHERE col = ? AND value = ?)"); params += [col, value]
+            elif col == 'port':
+                where.append("a.port = ?"); params.append(int(value))
+            else:
+                where.append(f"{self._column_sql(col)} = ?"); params.append(value)
+        if since:
+            where.append("a.last_seen >= ?"); params.append(int(time.time() - since))
+        if where: sql.append("WHERE " + " AND ".join(where))
+        sql.append("ORDER BY a.last_seen DESC")
+        if limit: sql.append(f"LIMIT {int(limit)}")
+        return columns, self._iter_rows(" ".join(sql), params)
+
+    def export(self, path, fmt, **select_kwargs):
+        """把查询结果导出为 txt (仅 host) / csv / xlsx，返回导出行数。txt/csv 边读边写。"""
+        if fmt == 'txt': select_kwargs['columns'] = ['host']
+        columns, rows = self.select(**select_kwargs)
+        if fmt == 'xlsx':
+            rows = list(rows) # openpyxl 需要整表在内存中
+            pd.DataFrame(rows, columns=columns).to_excel(path, index=False, engine='openpyxl')
+            return len(rows)
+        count = 0
+        if fmt == 'txt':
+            with open(path, 'w', encoding='utf-8') as f:
+                for row in rows: f.write(row[0] + "\n"); count += 1
+        else:
+            with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+                writer = csv.writer(f); writer.writerow(columns)
+                for row in rows: writer.writerow(row); count += 1
+        return count
+
+    def lookup_host(self, target):
+        """按 IP 或域名查找本地资产。返回 (记录列表, 最近入库时间戳)，记录已合并 extra 字段。"""
+        target = target.strip().lower()
+        if not re.match(r'^[\w.\-]+$', target): return [], None
+        # host/domain 按原始大小写入库，比较时统一小写 (有 lower() 表达式索引)；
+        # "host:*" / "host/*" 前缀写成范围条件，每个分支都能走索引
+        exact = [f"{scheme}{target}" for scheme in ('', 'http://', 'https://')]
+        prefixes = [f"{host}{sep}" for host in exact for sep in (':', '/')]
+        columns = [c for c in ASSET_DEFAULT_COLUMNS if c not in ('first_seen', 'last_seen')]
+        sql = (f"SELECT {', '.join(self._column_sql(c) for c in columns)}, a.extra, a.last_seen FROM assets a "
+               f"WHERE a.ip = ? OR lower(a.domain) = ? OR lower(a.host) IN ({', '.join('?' * len(exact))}) OR "
+               + " OR ".join(["(lower(a.host) >= ? AND lower(a.host) < ?)"] * len(prefixes)))
+        params = [target, target] + exact + [v for p in prefixes for v in (p, p[:-1] + chr(ord(p[-1]) + 1))]
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        records = []
+        for row in rows:
+            record = {k: v for k, v in zip(columns, row[:len(columns)]) if v is not None}
+            if row[-2]: record.update(json.loads(row[-2]))
+            record['_last_seen'] = row[-1]
+            records.append(record)
+        return records, max((r['_last_seen'] for r in records), default=None)
+
+    def import_file_once(self, path, query_text):
+        """把历史结果文件导入资产库，按 (路径, mtime) 去重，返回导入行数。"""
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            row = self.conn.execute("SELECT mtime FROM imported_files WHERE path=?", (path,)).fetchone()
+        if row and row[0] >= mtime: return 0
+        with open_cache_file(path) as f:
+            count = self.ingest(query_text, (line.strip() for line in f if line.strip()), seen_at=mtime)
+        with self.lock:
+            self.conn.execute("INSERT INTO imported_files (path, mtime) VALUES (?, ?) ON CONFLICT(path) DO UPDATE SET mtime=excluded.mtime", (path, mtime))
+        return count
+
+    def stats(self):
+        with self.lock:
+            assets = self.conn.execute("SELECT COUNT(*) FROM assets").fetchone()[0]
+            queries = self.conn.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+            recent = self.conn.execute("SELECT COUNT(*) FROM assets WHERE last_seen >= ?", (int(time.time()) - 86400,)).fetchone()[0]
+        size = sum(os.path.getsize(p) for p in (self.path, self.path + '-wal') if os.path.exists(p))
+        return {'assets': assets, 'queries': queries, 'seen_24h': recent, 'size': size}
+
+if not SCAN_WORKER: ASSET_STORE = AssetStore(ASSET_DB_FILE)
+
+def backfill_asset_store():
+    """启动时把资产库建立之前的缓存下载和监控数据导入进来，已导入的文件会跳过。"""
+    total = 0
+    for item in HISTORY.get('queries', []):
+        file_path = (item.get('cache') or {}).get('file_path')
+        if file_path and os.path.exists(file_path):
+            try: total += ASSET_STORE.import_file_once(os.path.abspath(file_path), item['query_text'])
+            except Exception as e: logger.warning(f"导入缓存 {file_path} 到资产库失败: {e}")
+    for data_file in glob.glob(os.path.join(MONITOR_DATA_DIR, "*.txt")):
+        task = MONITOR_TASKS.get(os.path.splitext(os.path.basename(data_file))[0], {})
+        try: total += ASSET_STORE.import_file_once(os.path.abspath(data_file), task.get('query'))
+        except Exception as e: logger.warning(f"导入监控数据 {data_file} 到资产库失败: {e}")
+    if total: logger.info(f"资产库回填完成，导入 {total} 条历史结果。")
+
+def archive_results(query_text, rows, fields=("host",)):
+    """下载结果入库。入库失败只记录日志，不影响结果文件的发送。"""
+    try:
+        return ASSET_STORE.ingest(query_text, rows, fields)
+    except Exception as e:
+        logger.error(f"结果写入资产库失败: {e}", exc_info=True)
+        return 0
+
 # --- 文件上传辅助函数 ---
 def send_file_safely(context: CallbackContext, chat_id: int, file_path: str, caption: str = "", parse_mode: str = None, filename: str = None):
-    """安全地发送文件，处理Telegram API的大小限制，支持自动压缩和分卷。"""
+    """安全地发送文件，处理Telegram API的大小限制，支持自动压缩和分卷。已压缩的缓存文件直接发送。"""
     temp_files_to_clean = []
     try:
         if not os.path.exists(file_path):
@@ -340,6 +1381,9 @@ def send_file_safely(context: CallbackContext, chat_id: int, file_path: str, cap
 
         file_size = os.path.getsize(file_path)
         base_filename = filename or os.path.basename(file_path)
+        codec = cache_codec_of(file_path)
+        if codec and not base_filename.endswith(CACHE_CODECS[codec]): base_filename += CACHE_CODECS[codec]
+        plain_filename = base_filename[:-len(CACHE_CODECS[codec])] if codec else base_filename
 
         # 1. 直接发送
         if file_size < TELEGRAM_MAX_FILE_SIZE_BYTES:
@@ -349,37 +1393,36 @@ def send_file_safely(context: CallbackContext, chat_id: int, file_path: str, cap
                     caption=caption, parse_mode=parse_mode, timeout=120)
             return
 
-        # 2. 尝试单文件压缩
-        context.bot.send_message(chat_id, f"⚠️ 文件 `{escape_markdown_v2(base_filename)}` 过大，正在尝试压缩\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        zip_path = file_path + ".zip"
-        temp_files_to_clean.append(zip_path)
-        try:
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-                zf.write(file_path, arcname=base_filename)
-            
-            if os.path.getsize(zip_path) < TELEGRAM_MAX_FILE_SIZE_BYTES:
-                with open(zip_path, 'rb') as doc:
-                    context.bot.send_document(
-                        chat_id, document=doc, filename=os.path.basename(zip_path),
-                        caption=f"{caption}\n\n*文件已被压缩*", parse_mode=parse_mode, timeout=180)
-                return
-        except Exception as e:
-            logger.error(f"压缩文件 '{file_path}' 时出错: {e}")
-            # Fall through to next method
+        # 2. 尝试单文件压缩 (已是压缩缓存时再压一次没有收益，直接跳过)
+        if not codec:
+            context.bot.send_message(chat_id, f"⚠️ 文件 `{escape_markdown_v2(base_filename)}` 过大，正在尝试压缩\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
+            packed_path = file_path + CACHE_CODECS[get_cache_codec() or 'gzip']
+            temp_files_to_clean.append(packed_path)
+            try:
+                compress_file(file_path, packed_path)
+                if os.path.getsize(packed_path) < TELEGRAM_MAX_FILE_SIZE_BYTES:
+                    with open(packed_path, 'rb') as doc:
+                        context.bot.send_document(
+                            chat_id, document=doc, filename=base_filename + packed_path[len(file_path):],
+                            caption=f"{caption}\n\n*文件已被压缩*", parse_mode=parse_mode, timeout=180)
+                    return
+            except Exception as e:
+                logger.error(f"压缩文件 '{file_path}' 时出错: {e}")
+                # Fall through to next method
 
         # 3. 如果是可分割文件类型(txt, csv), 进行分卷
-        if base_filename.endswith(('.txt', '.csv')):
+        if plain_filename.endswith(('.txt', '.csv')):
             context.bot.send_message(chat_id, "⚠️ 压缩后文件依然过大，将进行分卷发送。")
             part_num = 1
             part_size = 45 * 1024 * 1024  # 45MB parts
             
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            with open_cache_file(file_path) as f:
                 while True:
                     lines = f.readlines(part_size)
                     if not lines:
                         break
                     
-                    part_filename = f"{base_filename}.part{part_num}"
+                    part_filename = f"{plain_filename}.part{part_num}"
                     part_path = os.path.join(os.path.dirname(file_path), part_filename)
                     temp_files_to_clean.append(part_path)
                     
@@ -391,7 +1434,7 @@ def send_file_safely(context: CallbackContext, chat_id: int, file_path: str, cap
                     part_num += 1
             
             # 使用转义确保文件名中的特殊字符不会破坏格式
-            safe_base_filename = escape_markdown_v2(base_filename)
+            safe_base_filename = escape_markdown_v2(plain_filename)
             context.bot.send_message(chat_id, f"✅ 分卷发送完成。\n您可以通过 `copy /b {safe_base_filename}\\.part\\* {safe_base_filename}` (Win) 或 `cat {safe_base_filename}\\.part\\* > {safe_base_filename}` (Linux/Mac) 来合并文件。", parse_mode=ParseMode.MARKDOWN_V2)
 
             return
@@ -628,6 +1671,16 @@ def fetch_fofa_next_data(key, query, next_id=None, page_size=10000, fields="host
     params['next'] = next_id if next_id is not None else ""
     return _make_api_request(FOFA_NEXT_URL, params, proxy_session=proxy_session)
 
+API_LATENCY = {'ewma': None}
+
+def record_api_latency(seconds, alpha=0.2):
+    """成功请求耗时的指数滑动平均，用于任务耗时预估。"""
+    previous = API_LATENCY['ewma']
+    API_LATENCY['ewma'] = seconds if previous is None else alpha * seconds + (1 - alpha) * previous
+
+def get_api_latency():
+    return API_LATENCY['ewma'] or 3.0
+
 def _make_api_request(
     url: str,
     params: dict,
@@ -638,8 +1691,12 @@ def _make_api_request(
 ) -> tuple[dict | None, str | None]:
     """
     同步兼容层（函数签名不变，业务代码零修改）。
+    交互通道中的请求使用更少的重试和更短的超时，避免用户等待批量任务式的长退避。
     """
-    return _run_async_api_call(
+    if in_interactive_lane():
+        retries, timeout = min(retries, INTERACTIVE_RETRIES), min(timeout, INTERACTIVE_TIMEOUT)
+    started = time.monotonic()
+    data, error = _run_async_api_call(
         _make_api_request_async(
             url=url,
             params=params,
@@ -649,86 +1706,312 @@ def _make_api_request(
             proxy_url=proxy_session
         )
     )
+    if not error: record_api_latency(time.monotonic() - started)
+    return data, error
 
 # --- 智能下载核心工具 ---
-def iter_fofa_traceback(key, query, limit=None, proxy_session=None, page_size=10000):
+def fetch_next_page_with_failover(cursor_state, query, next_id, page_size=10000, fields="host"):
     """
-    通过 before/after 时间回溯机制迭代获取数据的生成器。
-    Yields: 结果列表
+    通过 search/next 获取一页数据，带 Key/代理 故障转移。
+    额度类错误通过租约管理器迁移到另一个 VIP Key，网络类错误换代理；游标 next_id 保持不变，切换后从原位置继续。
+    cursor_state: {'lease': dict, 'key': str, 'proxy': str|None, 'rotations': int}，原地更新。
     """
-    current_query = query
-    last_page_date = None
-    collected_count = 0
-    
-    # 简单的哈希去重（用于处理同一天的分页重叠）
-    page_hashes = set() 
-    
+    proxies_list = CONFIG.get("proxies", [])
+    proxy_retries_left = len(proxies_list)
+    lease = cursor_state['lease']
+
     while True:
-        # 获取第一页
-        # 注意：这里需要请求 lastupdatetime 以便确定下一页的 before 时间锚点
-        # 为了兼容性，如果没有 VIP 权限，这个 fields 请求可能会被忽略或者需要外部确保 Key 权限
-        # 这里假设调用此函数时已使用了具备权限的 Key
-        fields = "host,lastupdatetime"
-        
-        # 使用 execute_query_with_fallback 的等价单次调用，或者直接调 fetch。
-        # 这里是迭代器内部，假定 key 是确定的。
-        # 如果 Key 等级 < 1 (无法查询 lastupdatetime)，则只能查普通翻页，这会导致大量数据下的死循环，
-        # 所以外部必须确保 key level >= 1
-        
-        data, error = fetch_fofa_data(key, current_query, page=1, page_size=page_size, fields=fields, proxy_session=proxy_session)
-        
-        if error or not data or not data.get('results'):
-            break
+        key = cursor_state.get('key')
+        if not key:
+            return None, "所有可用 Key 均已尝试，额度全部耗尽。"
 
-        results = data.get('results', [])
-        if not results:
-            break
-
-        # Yield current batch
-        # 我们返回完整结果以便外部处理
-        yield results
-        collected_count += len(results)
-        if limit and collected_count >= limit:
-            break
-
-        # 分析最后一条的时间，设置新的 Time Anchor
-        # FOFA 结果是倒序的，最后一条是最旧的
-        # 取最后一条的时间，作为下一轮的 before
-        valid_anchor_found = False
-        
-        # 倒序寻找有效时间戳
-        for i in range(len(results) - 1, -1, -1):
-            if not results[i] or len(results[i]) < 2: continue
-            
-            # 格式可能是 "2023-01-01 12:00:00"
-            ts_str = results[i][-1] # lastupdatetime
+        KEY_LEASES.renew(lease)
+        data, error = fetch_fofa_next_data(key, query, next_id=next_id, page_size=page_size, fields=fields, proxy_session=cursor_state.get('proxy'))
+        if not error:
+            return data, None
+
+        if is_quota_error(error):
+            next_key = KEY_LEASES.rotate(lease, error)
+            logger.warning(f"游标翻页: Key ...{key[-4:]} 额度耗尽 ({error})，切换到 {('...' + next_key[-4:]) if next_key else '无'}")
+            cursor_state['key'] = next_key
+            cursor_state['rotations'] = cursor_state.get('rotations', 0) + 1
+            continue
+
+        if is_network_error(error) and proxy_retries_left > 0:
+            other_proxies = [p for p in proxies_list if p != cursor_state.get('proxy')]
+            if other_proxies:
+                proxy_retries_left -= 1
+                cursor_state['proxy'] = random.choice(other_proxies)
+                cursor_state['rotations'] = cursor_state.get('rotations', 0) + 1
+                logger.warning(f"游标翻页: 网络错误 ({error})，切换代理后重试当前游标。")
+                continue
+
+        return None, error
+
+class FetchPipeline:
+    """
+    顺序请求的生产者/消费者流水线。
+
+    抓取线程: 请求一页 -> 立即用 next_request() 从这一页算出下一次请求 (时间锚点/游标) 并继续抓取；
+    阶段线程: 每个 stage 独占一个线程，通过有界队列串联 (如 解析 -> 去重 -> 写入/UI)。
+    这样网络等待和 CPU 处理互相重叠，而请求本身仍然严格按顺序发出。
+    抓取线程最多领先处理进度 lookahead 页: 第 N 页还在处理时只会预取第 N+1 页，
+    任务因上限或 /stop 结束时不会有多页额度已经花掉。
+
+    fetch_page(request) -> (data, error)
+    next_request(request, data) -> 下一次请求，返回 None 表示结束
+    stages: [callable(item) -> item | None]，返回 None 的条目不再向后传递
+    """
+    _SENTINEL = object()
+
+    def __init__(self, fetch_page, next_request, first_request=None, stages=(), initial_data=None,
+                 queue_size=1, lookahead=1, should_stop=None, name="pipeline"):
+        self.fetch_page = fetch_page
+        self.next_request = next_request
+        self.first_request = first_request
+        self.initial_data = initial_data
+        self.stages = list(stages)
+        self.should_stop = should_stop
+        self.name = name
+        self.error = None
+        self.fetch_count = 0
+        self._stopped = threading.Event()
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(len(self.stages) + 1)]
+        self._credits = threading.Semaphore(lookahead + 1) # 正在处理的一页 + 预取的页
+        self._threads = []
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _put(self, q, item):
+        while True:
+            if self._stopped.is_set() and item is not self._SENTINEL:
+                return  # 已停止: 丢弃在途数据
             try:
-                current_date_obj = datetime.strptime(ts_str.split(' ')[0], '%Y-%m-%d').date()
-                
-                # 防止死循环：如果这页找到的日期 >= 上一页找到的锚点日期，说明在这一天内卡住了
-                # 我们需要强制将日期 -1 天来跳过这一天（会有数据损失，但好过死循环）
-                # 或者，FOFA api 支持 page 翻页，如果是在同一天，我们可以尝试翻 page 2?
-                # 简化起见：Time Slicing 策略是“天”级的。如果一天 > 10000 条，这里的逻辑会跳过当天剩余数据。
-                # 但根据 Smart Slicing 假设，国家被剥离后，单日单国数据很难 > 10000。
-                
-                next_page_date_obj = current_date_obj
-                
-                if last_page_date and current_date_obj >= last_page_date:
-                    # 如果时间没有前推，强制 -1 天
-                    next_page_date_obj -= timedelta(days=1)
-                
-                last_page_date = next_page_date_obj
-                
-                # 更新查询：追加 before 参数
-                # 注意处理 query 中现有的括号
-                current_query = f'({query}) && before="{next_page_date_obj.strftime("%Y-%m-%d")}"'
-                valid_anchor_found = True
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if self._stopped.is_set():
+                    # 已停止且下游不再消费: 腾出位置保证结束信号能送达
+                    try: q.get_nowait()
+                    except queue.Empty: pass
+
+    def _acquire_credit(self):
+        while not self._stopped.is_set():
+            if self._credits.acquire(timeout=0.5): return True
+        return False
+
+    def _page_done(self):
+        self._credits.release()
+
+    def _fetch_loop(self):
+        request, data = self.first_request, self.initial_data
+        try:
+            while not self._stopped.is_set():
+                if not self._acquire_credit(): break
+                if self.should_stop and self.should_stop():
+                    self.stop()
+                    break
+                if data is None:
+                    data, error = self.fetch_page(request)
+                    self.fetch_count += 1
+                    if error:
+                        self.error = error
+                        break
+                next_req = self.next_request(request, data)
+                self._put(self._queues[0], data)
+                data = None
+                if next_req is None:
+                    break
+                request = next_req
+        except Exception as e:
+            logger.error(f"[{self.name}] 抓取阶段异常: {e}", exc_info=True)
+            self.error = str(e)
+        finally:
+            self._put(self._queues[0], self._SENTINEL)
+
+    def _stage_loop(self, stage, in_q, out_q):
+        while True:
+            item = in_q.get()
+            if item is self._SENTINEL:
+                self._put(out_q, self._SENTINEL)
+                return
+            if self._stopped.is_set():
+                continue
+            try:
+                result = stage(item)
+            except Exception as e:
+                logger.error(f"[{self.name}] 处理阶段异常: {e}", exc_info=True)
+                self.error = str(e)
+                self.stop()
+                continue
+            if result is not None:
+                self._put(out_q, result)
+            else:
+                self._page_done() # 这一页在中途被丢弃，处理结束
+
+    def start(self):
+        t = threading.Thread(target=self._fetch_loop, name=f"{self.name}_fetch", daemon=True)
+        self._threads.append(t)
+        for i, stage in enumerate(self.stages):
+            self._threads.append(threading.Thread(
+                target=self._stage_loop, args=(stage, self._queues[i], self._queues[i + 1]),
+                name=f"{self.name}_stage{i}", daemon=True))
+        for t in self._threads: t.start()
+        return self
+
+    def __iter__(self):
+        """按顺序产出最后一个阶段的输出；提前退出迭代会停止整条流水线。"""
+        if not self._threads: self.start()
+        out_q = self._queues[-1]
+        try:
+            while True:
+                item = out_q.get()
+                if item is self._SENTINEL:
+                    return
+                yield item
+                self._page_done() # 调用方处理完这一页、请求下一页时才放行新的预取
+        finally:
+            self.stop()
+            for t in self._threads: t.join(timeout=5)
+
+    def run(self):
+        """运行到结束 (阶段自行处理数据时使用)。"""
+        for _ in self: pass
+        return self
+
+def next_traceback_anchor(results, last_anchor, force_advance=True):
+    """
+    从一页 [.., lastupdatetime] 结果中倒序找出下一轮 before 的日期锚点 (FOFA 结果按时间倒序，最后一条最旧)。
+    force_advance=True: 如果日期没有前推，强制 -1 天跳过这一天 (会有数据损失，但好过死循环)。
+    force_advance=False: 跳过不早于上一锚点的记录，找不到更早的日期就返回 None。
+    """
+    for i in range(len(results) - 1, -1, -1):
+        row = results[i]
+        if not row or not isinstance(row, list) or len(row) < 2 or not row[-1]: continue
+        try:
+            current_date_obj = datetime.strptime(row[-1].split(' ')[0], '%Y-%m-%d').date()
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if last_anchor and current_date_obj >= last_anchor:
+            if not force_advance: continue
+            return last_anchor - timedelta(days=1)
+        return current_date_obj
+    return None
+
+def iter_fofa_traceback(key, query, limit=None, proxy_session=None, page_size=10000, lease=None, fields="host", status=None):
+    """
+    通过 before/after 时间回溯机制迭代获取数据的生成器。
+    基于 FetchPipeline: 调用方处理当前批次时，下一轮的回溯请求已经在后台发出。
+    传入 lease 时使用租约中的 Key，额度耗尽会自动迁移到其他 Key 继续。
+    传入 status (dict) 时，结束后写入 error 和 complete (是否一直回溯到没有结果为止)。
+    Yields: 结果列表，每行为 fields 对应的值，最后一列固定是 lastupdatetime
+    """
+    # 需要请求 lastupdatetime 以便确定下一页的 before 时间锚点，
+    # 调用方必须确保 key level >= 1，否则只能普通翻页，会在大量数据下死循环
+    fields = ",".join([f for f in fields.split(',') if f != 'lastupdatetime'] + ['lastupdatetime'])
+
+    def fetch_page(request):
+        while True:
+            KEY_LEASES.renew(lease)
+            data, error = fetch_fofa_data(lease['key'] if lease else key, request['query'], page=1, page_size=page_size, fields=fields, proxy_session=proxy_session)
+            if error and lease and is_quota_error(error) and KEY_LEASES.rotate(lease, error):
+                continue
+            return data, error
+
+    def next_request(request, data):
+        results = data.get('results') or []
+        if not results: return None
+        anchor = next_traceback_anchor(results, request['anchor'], force_advance=True)
+        if anchor is None: return None
+        return {'query': f'({query}) && before="{anchor.strftime("%Y-%m-%d")}"', 'anchor': anchor}
+
+    pipeline = FetchPipeline(fetch_page, next_request, first_request={'query': query, 'anchor': None}, name="traceback_iter")
+    collected_count, truncated = 0, False
+    try:
+        for data in pipeline:
+            results = data.get('results') or []
+            if not results: break
+            yield results
+            collected_count += len(results)
+            if limit and collected_count >= limit:
+                truncated = True
                 break
-            except (ValueError, TypeError, IndexError):
+    except GeneratorExit:
+        truncated = True # 调用方提前结束迭代
+        raise
+    finally:
+        pipeline.stop()
+        if status is not None:
+            status.update(error=pipeline.error, complete=not truncated and not pipeline.error)
+
+
+# --- 基于时间的增量获取 ---
+# 用 after="<高水位前一天>" 只请求高水位之后更新过的资产。search/all 翻页只能稳定取到前 1 万条，
+# 所以不翻页: 按日期窗口从高水位往后推进，窗口内超过 1 万条就对半拆分，先取较早的一半。
+# FOFA 的 after/before 只精确到天，窗口边界当天可能重复下载，由调用方去重。
+DELTA_PAGE_SIZE = 10000
+
+def max_update_date(rows):
+    """取 [.., lastupdatetime] 结果中最新的日期。"""
+    newest = None
+    for row in rows:
+        if not isinstance(row, list) or not row or not row[-1]: continue
+        try: current = datetime.strptime(str(row[-1]).split(' ')[0], '%Y-%m-%d').date()
+        except ValueError: continue
+        if newest is None or current > newest: newest = current
+    return newest
+
+def fetch_fofa_delta(lease, query, since, fields="host", proxy_session=None, max_rows=None, should_stop=None):
+    """
+    获取 since (date) 之后更新的全部结果，需要 level >= 1 的 Key 租约 (要查 lastupdatetime)。
+    单日仍超过 1 万条时只能取到该日的前 1 万条 (与时间回溯相同的限制)。
+    Returns: (rows, 已覆盖到的日期, 是否完整覆盖, error, 实际请求次数)，rows 最后一列固定是 lastupdatetime。
+    已覆盖日期 (含) 之前的增量都已取到，调用方可以把高水位推进到这里；达到 max_rows、出错或停止时
+    只覆盖到已完成的窗口，下一轮从那里继续往后取。完整覆盖时返回结果中最新的 lastupdatetime 日期。
+    """
+    fields = ",".join([f for f in fields.split(',') if f != 'lastupdatetime'] + ['lastupdatetime'])
+    today = datetime.now().date()
+
+    def window_query(start, end):
+        window = f'({query}) && after="{(start - timedelta(days=1)).strftime("%Y-%m-%d")}"'
+        if end < today: window += f' && before="{(end + timedelta(days=1)).strftime("%Y-%m-%d")}"'
+        return window
+
+    requests_used = 0
+
+    def fetch(window):
+        nonlocal requests_used
+        while True:
+            KEY_LEASES.renew(lease)
+            requests_used += 1 # 换 Key 重试同样消耗请求
+            data, error = fetch_fofa_data(lease['key'], window, page=1, page_size=DELTA_PAGE_SIZE, fields=fields, proxy_session=proxy_session)
+            if error and is_quota_error(error) and KEY_LEASES.rotate(lease, error):
                 continue
-        
-        if not valid_anchor_found:
-            break
+            return data, error
+
+    rows, covered, error = [], None, None
+    pending = [(since, max(since, today))] # 栈顶始终是日期最早的未完成窗口
+    while pending:
+        if should_stop and should_stop(): break
+        start, end = pending[-1]
+        data, error = fetch(window_query(start, end))
+        if error: break
+        pending.pop()
+        if data.get('size', 0) > DELTA_PAGE_SIZE and start < end:
+            mid = start + (end - start) // 2
+            pending += [(mid + timedelta(days=1), end), (start, mid)]
+            continue
+        rows.extend(data.get('results') or [])
+        covered = end
+        if max_rows and len(rows) >= max_rows: break
+    complete = not pending and not error
+    if complete: covered = max_update_date(rows)
+    return rows, covered, complete, error, requests_used
 
 def check_and_classify_keys():
     logger.info("--- 开始检查并分类API Keys ---")
@@ -751,6 +2034,7 @@ def check_and_classify_keys():
             elif api_level >= 4: level = 3
             else: level = 1 
         KEY_LEVELS[key] = level
+        remember_key_quota(key, data)
         level_name = {0: "免费会员", 1: "个人会员", 2: "商业会员", 3: "企业会员"}.get(level, "未知等级")
         logger.info(f"Key '...{key[-4:]}' ({data.get('username', 'N/A')}) - 等级: {level} ({level_name})")
     logger.info("--- API Keys 分类完成 ---")
@@ -761,6 +2045,214 @@ def get_fields_by_level(level):
     if level == 1: return PERSONAL_FIELDS
     return FREE_FIELDS
 
+# 45022(并发), 820031(F点不足), 820041(每日上限) —— 换 Key 即可继续的错误
+QUOTA_ERROR_CODES = ("[45022]", "[820031]", "[820041]")
+
+def is_quota_error(error) -> bool:
+    error_str = str(error or "")
+    return any(code in error_str for code in QUOTA_ERROR_CODES)
+
+def is_network_error(error) -> bool:
+    """_make_api_request_async 在网络层失败时返回的错误前缀，换代理可能恢复。"""
+    error_str = str(error or "")
+    return error_str.startswith("请求超时") or error_str.startswith("网络请求失败")
+
+# --- 交互快速通道 (Interactive Lane) ---
+# /preview、/host、/lowhost、/stats 和内联查询对延迟敏感，与后台批量任务分开调度:
+# 走快速通道的线程重试更少、超时更短，Key 租约使用独立的交互配额，批量任务在页边界让路。
+INTERACTIVE_RETRIES = 2
+INTERACTIVE_TIMEOUT = 20
+INTERACTIVE_PREEMPT_WAIT = 15  # 批量任务在页边界最多为交互请求让路的秒数
+_LANE = threading.local()
+INTERACTIVE_LATENCY = {}
+INTERACTIVE_LATENCY_LOCK = threading.Lock()
+
+def in_interactive_lane() -> bool:
+    return getattr(_LANE, 'interactive', False)
+
+def record_interactive_latency(name, seconds):
+    with INTERACTIVE_LATENCY_LOCK:
+        INTERACTIVE_LATENCY.setdefault(name, deque(maxlen=500)).append(seconds)
+
+def interactive_command(name):
+    """标记处理函数走交互快速通道，并记录端到端耗时用于 p95 统计。"""
+    def decorator(func):
+        @wraps(func)
+        def wrapped(update, context, *args, **kwargs):
+            _LANE.interactive = True
+            start = time.monotonic()
+            try:
+                return func(update, context, *args, **kwargs)
+            finally:
+                _LANE.interactive = False
+                record_interactive_latency(name, time.monotonic() - start)
+        return wrapped
+    return decorator
+
+@contextmanager
+def interactive_lane():
+    """在非交互命令的处理函数里临时走快速通道，例如模式选择前的预估请求。"""
+    previous = in_interactive_lane()
+    _LANE.interactive = True
+    try: yield
+    finally: _LANE.interactive = previous
+
+def interactive_latency_stats():
+    """返回 {命令: (样本数, p50, p95)}，'all' 为全部命令汇总。"""
+    def percentile(values, p):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(math.ceil(p * len(ordered))) - 1)]
+    with INTERACTIVE_LATENCY_LOCK:
+        samples = {name: list(values) for name, values in INTERACTIVE_LATENCY.items() if values}
+    report = {name: (len(v), percentile(v, 0.5), percentile(v, 0.95)) for name, v in samples.items()}
+    merged = [x for v in samples.values() for x in v]
+    if merged: report['all'] = (len(merged), percentile(merged, 0.5), percentile(merged, 0.95))
+    return report
+
+# --- Key 租约管理 ---
+KEY_CONCURRENCY_COOLDOWN = 60  # [45022] 并发受限: 短暂冷却后即可再次分配
+KEY_QUOTA_COOLDOWN = 3600      # [820031]/[820041] 额度耗尽: 冷却一小时后再试探
+
+class KeyLeaseManager:
+    """
+    API Key 租约管理，避免多个任务同时压在同一个 Key 上触发 [45022]:
+    - 每个 Key 同时持有的批量租约数不超过 key_max_concurrency (config，默认 1)，
+      另有 key_interactive_slots 个交互通道配额，批量任务无法占用
+    - acquire() 优先分配当前租约最少、累计请求最少的 Key，全部满载时等待，超时后与负载最低的 Key 共享
+    - 长任务在每页请求前 renew()，若该 Key 上有交互请求正在进行则先让路 (页边界抢占)；
+      超过 lease_ttl 未续约的租约视为泄漏并自动回收
+    - Key 额度耗尽时 rotate() 把租约原地迁移到另一个 Key，持有者无需重新获取
+    - stats() 汇总各 Key 利用率，供 /check 展示
+    """
+    def __init__(self, lease_ttl=900):
+        self._cond = threading.Condition()
+        self._leases = {}
+        self._blocked_until = {}
+        self._usage = {}
+        self._seq = 0
+        self.lease_ttl = lease_ttl
+
+    def max_concurrency(self, lane='bulk'):
+        if lane == 'interactive':
+            return max(1, int(CONFIG.get('key_interactive_slots', 1)))
+        return max(1, int(CONFIG.get('key_max_concurrency', 1)))
+
+    def _usage_of(self, key):
+        return self._usage.setdefault(key, {'grants': 0, 'requests': 0, 'busy_seconds': 0.0, 'exhausted': 0, 'yields': 0})
+
+    def _active_count(self, key, lane='bulk'):
+        return sum(1 for lease in self._leases.values() if lease['key'] == key and lease['lane'] == lane)
+
+    def _drop(self, lease_id):
+        lease = self._leases.pop(lease_id, None)
+        if lease:
+            self._usage_of(lease['key'])['busy_seconds'] += time.time() - lease['acquired']
+            self._cond.notify_all()
+
+    def _expire_stale(self):
+        now = time.time()
+        for lease_id, lease in list(self._leases.items()):
+            if now - lease['renewed'] > self.lease_ttl:
+                logger.warning(f"Key 租约 #{lease_id} (...{lease['key'][-4:]}, {lease['owner']}) 超时未续约，已回收。")
+                self._drop(lease_id)
+
+    def _candidates(self, min_level, exclude):
+        now = time.time()
+        return [k for k in CONFIG.get('apis', [])
+                if KEY_LEVELS.get(k, -1) >= min_level and k not in exclude and self._blocked_until.get(k, 0) <= now]
+
+    def acquire(self, min_level=0, owner="", prefer=None, exclude=(), wait=30, lane=None):
+        """获取一个租约；没有任何满足等级且未冷却的 Key 时返回 None。lane 默认按当前线程是否处于交互通道决定。"""
+        lane = lane or ('interactive' if in_interactive_lane() else 'bulk')
+        other_lane = 'bulk' if lane == 'interactive' else 'interactive'
+        deadline = time.time() + wait
+        with self._cond:
+            while True:
+                self._expire_stale()
+                candidates = self._candidates(min_level, exclude)
+                if not candidates: return None
+                cap = self.max_concurrency(lane)
+                free = [k for k in candidates if self._active_count(k, lane) < cap]
+                if free or time.time() >= deadline:
+                    pool = free or candidates
+                    key = prefer if prefer in pool else min(
+                        pool, key=lambda k: (self._active_count(k, lane), self._active_count(k, other_lane),
+                                             self._usage_of(k)['requests'], random.random()))
+                    self._seq += 1
+                    now = time.time()
+                    lease = {'id': self._seq, 'key': key, 'owner': owner, 'min_level': min_level, 'lane': lane,
+                             'acquired': now, 'renewed': now, 'rotations': 0}
+                    self._leases[lease['id']] = lease
+                    self._usage_of(key)['grants'] += 1
+                    if not free:
+                        logger.info(f"所有 Key 均已满载，{owner or '请求'} 与 ...{key[-4:]} 共享租约。")
+                    return lease
+                self._cond.wait(timeout=max(0.1, min(1.0, deadline - time.time())))
+
+    def renew(self, lease, requests=1):
+        """续约并记录本次请求，长任务应在每页请求前调用；批量租约在此为交互请求让路。"""
+        if not lease: return
+        with self._cond:
+            if lease['lane'] == 'bulk' and self._active_count(lease['key'], 'interactive'):
+                self._usage_of(lease['key'])['yields'] += 1
+                deadline = time.time() + INTERACTIVE_PREEMPT_WAIT
+                while self._active_count(lease['key'], 'interactive') and time.time() < deadline:
+                    self._cond.wait(timeout=0.5)
+            lease['renewed'] = time.time()
+            self._leases.setdefault(lease['id'], lease)
+            self._usage_of(lease['key'])['requests'] += requests
+
+    def release(self, lease):
+        if not lease: return
+        with self._cond:
+            self._drop(lease['id'])
+
+    def mark_exhausted(self, key, error=None):
+        cooldown = KEY_CONCURRENCY_COOLDOWN if "[45022]" in str(error or "") else KEY_QUOTA_COOLDOWN
+        with self._cond:
+            self._blocked_until[key] = time.time() + cooldown
+            self._usage_of(key)['exhausted'] += 1
+            self._cond.notify_all()
+
+    def rotate(self, lease, error=None, wait=30):
+        """当前 Key 额度耗尽: 冷却该 Key 并把租约迁移到另一个 Key，返回新 Key (无可用时返回 None)。"""
+        old_key = lease['key']
+        self.mark_exhausted(old_key, error)
+        with self._cond:
+            self._drop(lease['id'])
+        new_lease = self.acquire(min_level=lease['min_level'], owner=lease['owner'], exclude={old_key}, wait=wait, lane=lease['lane'])
+        if not new_lease: return None
+        with self._cond:
+            self._leases[new_lease['id']] = lease
+            lease.update(id=new_lease['id'], key=new_lease['key'], acquired=new_lease['acquired'], renewed=new_lease['renewed'])
+            lease['rotations'] += 1
+        logger.warning(f"Key 租约迁移 ({lease['owner']}): ...{old_key[-4:]} -> ...{lease['key'][-4:]} ({error})")
+        return lease['key']
+
+    @contextmanager
+    def lease(self, min_level=0, owner="", prefer=None, wait=30, lane=None):
+        lease = self.acquire(min_level=min_level, owner=owner, prefer=prefer, wait=wait, lane=lane)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def stats(self):
+        now = time.time()
+        with self._cond:
+            report = []
+            for key in CONFIG.get('apis', []):
+                usage = dict(self._usage_of(key))
+                active = [l for l in self._leases.values() if l['key'] == key]
+                usage['busy_seconds'] += sum(now - l['acquired'] for l in active)
+                usage.update(key=key, active=len(active), interactive=sum(1 for l in active if l['lane'] == 'interactive'),
+                             owners=[l['owner'] for l in active],
+                             cooldown=max(0, self._blocked_until.get(key, 0) - now))
+                report.append(usage)
+            return report
+
+KEY_LEASES = KeyLeaseManager()
+
 def execute_query_with_fallback(query_func, preferred_key_index=None, proxy_session=None, min_level=0):
     if not CONFIG['apis']: return None, None, None, None, None, "没有配置任何API Key。"
     
@@ -773,14 +2265,14 @@ def execute_query_with_fallback(query_func, preferred_key_index=None, proxy_sess
         return None, None, None, None, None, "所有配置的API Key都无效。"
     
     # --- 负载均衡逻辑 (Load Balancing) ---
-    # 默认随机选择一个起始点，实现请求分摊
-    start_index = random.randint(0, len(keys_to_try) - 1)
+    # 由租约管理器挑选当前最空闲的 Key，避免与后台任务撞在同一个 Key 上
+    preferred_key = None
     
     # 如果用户指定了特定 Key，则从该 Key 开始 (作为首选)
     if preferred_key_index is not None and 1 <= preferred_key_index <= len(CONFIG['apis']):
         preferred_key = CONFIG['apis'][preferred_key_index - 1]
-        if preferred_key in keys_to_try:
-            start_index = keys_to_try.index(preferred_key)
+        if preferred_key not in keys_to_try:
+            preferred_key = None
 
     # 确定代理会话
     current_proxy_session_str = proxy_session
@@ -791,16 +2283,22 @@ def execute_query_with_fallback(query_func, preferred_key_index=None, proxy_sess
         else:
             current_proxy_session_str = CONFIG.get("proxy")
 
-    # --- 轮询执行 (Round Robin with Failover) ---
-    for i in range(len(keys_to_try)):
-        # 环形取 Key
-        idx = (start_index + i) % len(keys_to_try)
-        key = keys_to_try[idx]
+    # --- 轮询执行 (Lease with Failover) ---
+    tried_keys = set()
+    for _ in range(len(keys_to_try)):
+        lease = KEY_LEASES.acquire(min_level=min_level, owner="query", prefer=preferred_key, exclude=tried_keys,
+                                   wait=1 if in_interactive_lane() else 5)
+        if not lease: break
+        key = lease['key']; tried_keys.add(key); preferred_key = None
         key_num = CONFIG['apis'].index(key) + 1
         key_level = KEY_LEVELS.get(key, 0)
         
         # 执行查询
-        data, error = query_func(key, key_level, current_proxy_session_str)
+        KEY_LEASES.renew(lease)
+        try:
+            data, error = query_func(key, key_level, current_proxy_session_str)
+        finally:
+            KEY_LEASES.release(lease)
         
         if not error:
             # 成功！返回数据
@@ -809,8 +2307,8 @@ def execute_query_with_fallback(query_func, preferred_key_index=None, proxy_sess
         # --- 故障转移逻辑 (Failover) ---
         error_str = str(error)
         # 同时检测 45022(并发), 820031(F点不足), 820041(每日上限)
-        if "[45022]" in error_str or "[820031]" in error_str or "[820041]" in error_str:
-
+        if is_quota_error(error_str):
+            KEY_LEASES.mark_exhausted(key, error_str)
             logger.warning(f"Key [#{key_num}] 额度耗尽 ({error_str})，自动切换下一个 Key...")
             continue # 跳过当前 Key，尝试下一个
             
@@ -819,18 +2317,31 @@ def execute_query_with_fallback(query_func, preferred_key_index=None, proxy_sess
         
     return None, None, None, None, None, "所有可用 Key 均已尝试，额度全部耗尽，明天再来使用该bot。"
 # --- 异步扫描逻辑 ---
-async def async_check_port(host: str, port: int, timeout: float) -> str | None:
+# 本机资源耗尽类错误: 出现即说明并发过高，需要立刻降速
+SCAN_LOCAL_ERRNOS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.EADDRNOTAVAIL, errno.EAGAIN}
+
+async def async_probe_port(host: str, port: int, timeout: float, probes=None):
+    """
+    尝试建立 TCP 连接，返回 (状态, 耗时秒, 探测信息)，状态为 open / closed / timeout / error。
+    指定 probes 时连接成功后在同一连接上运行应用层探测插件，否则探测信息为 None。
+    """
     writer = None
+    started = time.monotonic()
     try:
-        _, writer = await asyncio.wait_for(
+        reader, writer = await asyncio.wait_for(
             asyncio.open_connection(host, port),
             timeout=timeout
         )
-        return f"{host}:{port}"
-    except (asyncio.TimeoutError, ConnectionRefusedError, OSError, socket.gaierror):
-        return None
+        rtt = time.monotonic() - started
+        return 'open', rtt, (await run_scan_probes(reader, writer, host, port, probes) if probes else None)
+    except asyncio.TimeoutError:
+        return 'timeout', timeout, None
+    except (ConnectionRefusedError, socket.gaierror):
+        return 'closed', time.monotonic() - started, None
+    except OSError as e:
+        return ('error' if e.errno in SCAN_LOCAL_ERRNOS else 'closed'), time.monotonic() - started, None
     except Exception:
-        return None
+        return 'closed', time.monotonic() - started, None
     finally:
         if writer is not None:
             try:
@@ -839,169 +2350,590 @@ async def async_check_port(host: str, port: int, timeout: float) -> str | None:
             except Exception:
                 pass
 
+# --- 应用层探测插件 ---
+# 连接建立后在同一连接上做一次应用层交互，区分真实服务和 tarpit / 中间设备。每个插件读取不超过
+# SCAN_PROBE_READ_LIMIT 字节、整体不超过 SCAN_PROBE_TIMEOUT 秒，返回 {'service', 'verified', ...}。
+SCAN_PROBE_READ_LIMIT = 4096
+SCAN_PROBE_TIMEOUT = 3.0
+SCAN_PROBE_BANNER_WAIT = 1.0 # 通用探测先被动等待服务端 banner 的时间
+SCAN_PROBE_COLUMNS = ('host', 'port', 'service', 'verified', 'status', 'title', 'banner', 'rtt_ms', 'error')
+SCAN_PROBES = {}
+_HTML_TITLE_RE = re.compile(rb'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+
+def scan_probe(name, ports=()):
+    """注册探测插件；ports 为该插件优先处理的端口，空表示只作为通用探测。"""
+    def decorator(func):
+        SCAN_PROBES[name] = {'func': func, 'ports': frozenset(ports)}
+        return func
+    return decorator
+
+async def _probe_read(reader, limit=SCAN_PROBE_READ_LIMIT, until=None):
+    """读取到 limit 字节、遇到 until 或对端关闭为止。"""
+    data = b''
+    while len(data) < limit:
+        chunk = await reader.read(limit - len(data))
+        if not chunk: break
+        data += chunk
+        if until and until in data: break
+    return data
+
+def _banner_text(data):
+    return data[:256].decode('utf-8', 'replace').strip().replace('\r', ' ').replace('\n', ' ')
+
+async def _probe_start_tls(reader, writer, host):
+    """
+    在已建立的连接上升级 TLS (不校验证书)，返回之后使用的 writer。
+    StreamWriter.start_tls 只在 Python 3.11+ 提供；更早的版本用 loop.start_tls 换掉底层 transport，
+    沿用原协议对象，原 reader 继续收到解密后的数据，关闭原 writer 时连接照常释放。
+    """
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname, ssl_context.verify_mode = False, ssl.CERT_NONE
+    server_hostname = None if re.match(r'^[\d.:]+$', host) else host
+    if hasattr(writer, 'start_tls'):
+        await writer.start_tls(ssl_context, server_hostname=server_hostname)
+        return writer
+    loop = asyncio.get_running_loop()
+    protocol = writer.transport.get_protocol()
+    transport = await loop.start_tls(writer.transport, protocol, ssl_context, server_hostname=server_hostname)
+    protocol._over_ssl = True # 与 3.11 的实现一致: EOF 交给 SSL 层处理，避免每个连接告警
+    return asyncio.StreamWriter(transport, protocol, reader, loop)
+
+@scan_probe('http', ports=(80, 81, 8000, 8001, 8008, 8080, 8081, 8088, 8888, 9000, 9090))
+async def probe_http(reader, writer, host, port, tls=False):
+    if tls: writer = await _probe_start_tls(reader, writer, host)
+    writer.write(f"GET / HTTP/1.0\r\nHost: {host}:{port}\r\nUser-Agent: Mozilla/5.0\r\nAccept: */*\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    data = await _probe_read(reader, until=b'</title>')
+    match = re.match(rb'HTTP/\d(?:\.\d)? (\d{3})', data)
+    if not match:
+        return {'service': 'https' if tls else 'http', 'verified': False, 'banner': _banner_text(data)}
+    title = _HTML_TITLE_RE.search(data)
+    return {'service': 'https' if tls else 'http', 'verified': True, 'status': int(match.group(1)),
+            'title': html.unescape(title.group(1).decode('utf-8', 'replace')).strip()[:200] if title else ''}
+
+@scan_probe('https', ports=(443, 8443, 9443))
+async def probe_https(reader, writer, host, port):
+    return await probe_http(reader, writer, host, port, tls=True)
+
+@scan_probe('banner', ports=(21, 22, 25, 110, 143, 587, 2222))
+async def probe_banner(reader, writer, host, port):
+    """被动读取服务端先发的 banner (SSH / FTP / SMTP / POP3 / IMAP)。"""
+    data = await _probe_read(reader, until=b'\n')
+    text = _banner_text(data)
+    upper = text.upper()
+    if text.startswith('SSH-'): service = 'ssh'
+    elif text.startswith('220') and 'FTP' in upper: service = 'ftp'
+    elif text.startswith('220'): service = 'smtp' if ('SMTP' in upper or port in (25, 587)) else 'ftp'
+    elif text.startswith('+OK'): service = 'pop3'
+    elif text.startswith('* OK'): service = 'imap'
+    else: service = 'unknown'
+    return {'service': service, 'verified': service != 'unknown', 'banner': text}
+
+@scan_probe('redis', ports=(6379, 6380))
+async def probe_redis(reader, writer, host, port):
+    writer.write(b"*1\r\n$4\r\nPING\r\n")
+    await writer.drain()
+    data = await _probe_read(reader, limit=256, until=b'\r\n')
+    text = _banner_text(data)
+    verified = data.startswith(b'+PONG') or data.startswith(b'-NOAUTH') or data.startswith(b'-ERR')
+    return {'service': 'redis', 'verified': verified, 'status': 'open' if data.startswith(b'+PONG') else 'auth' if verified else '',
+            'banner': text}
+
+@scan_probe('mysql', ports=(3306, 3307))
+async def probe_mysql(reader, writer, host, port):
+    """MySQL 服务端先发握手包: 3 字节长度 + 序号，随后协议版本 10 和以 \\0 结尾的版本号；0xff 为错误包。"""
+    data = await _probe_read(reader, limit=512, until=b'\x00')
+    if len(data) >= 5 and data[4] == 10 and b'\x00' in data[5:]:
+        version = data[5:data.index(b'\x00', 5)].decode('utf-8', 'replace')
+        return {'service': 'mysql', 'verified': True, 'banner': version}
+    if len(data) >= 7 and data[4] == 0xff:
+        return {'service': 'mysql', 'verified': True, 'status': 'denied', 'banner': _banner_text(data[7:])}
+    return {'service': 'mysql', 'verified': False, 'banner': _banner_text(data)}
+
+def parse_probe_selection(text):
+    """解析 "off" / "auto" / "http,redis" 以及可选的输出格式 jsonl|csv，返回 (插件列表或 None, 格式)。"""
+    words = text.strip().lower().replace('，', ',').split()
+    fmt = 'jsonl'
+    if len(words) > 1 and words[-1] in ('jsonl', 'csv'): fmt = words.pop()
+    spec = ",".join(words) or 'off'
+    if spec == 'off': return None, fmt
+    if spec == 'auto': return list(SCAN_PROBES), fmt
+    names = list(dict.fromkeys(n.strip() for n in spec.split(',') if n.strip()))
+    unknown = [n for n in names if n not in SCAN_PROBES]
+    if unknown: raise ValueError(f"未知的探测插件: {', '.join(unknown)}")
+    return names, fmt
+
+async def run_scan_probes(reader, writer, host, port, probes):
+    """按端口选择插件；端口没有对应插件时先等 banner，服务端不说话再尝试 HTTP。"""
+    specific = [name for name in probes if port in SCAN_PROBES[name]['ports']]
+    try:
+        if specific:
+            return await asyncio.wait_for(SCAN_PROBES[specific[0]]['func'](reader, writer, host, port), SCAN_PROBE_TIMEOUT)
+        if 'banner' in probes:
+            try:
+                info = await asyncio.wait_for(probe_banner(reader, writer, host, port), SCAN_PROBE_BANNER_WAIT)
+                if info.get('banner') or 'http' not in probes: return info
+            except asyncio.TimeoutError:
+                if 'http' not in probes: return {'service': 'unknown', 'verified': False, 'error': 'timeout'}
+        if 'http' in probes:
+            return await asyncio.wait_for(probe_http(reader, writer, host, port), SCAN_PROBE_TIMEOUT)
+        return {'service': 'unknown', 'verified': False}
+    except asyncio.TimeoutError:
+        return {'service': specific[0] if specific else 'unknown', 'verified': False, 'error': 'timeout'}
+    except Exception as e:
+        return {'service': specific[0] if specific else 'unknown', 'verified': False, 'error': type(e).__name__}
+
+def write_probe_results(path, rows, fmt='jsonl'):
+    rows = sorted(rows, key=lambda r: (r['host'], r['port']))
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, fieldnames=SCAN_PROBE_COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows: f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+# 自动模式: 并发按 AIMD 调节 (窗口内超时率明显高于历史基线或出现本机资源错误时减半，否则线性增加)，
+# 超时取成功连接 RTT 的 p99 × 倍数；自动超时下首轮超时的目标用两倍超时重试一次，固定超时不重试。
+SCAN_AUTO_START_CONCURRENCY = 200
+SCAN_AUTO_MIN_CONCURRENCY = 20
+SCAN_AUTO_MAX_CONCURRENCY = 5000
+SCAN_AIMD_STEP = 50
+SCAN_AIMD_TIMEOUT_TOLERANCE = 0.05 # 窗口超时率超过基线多少算拥塞
+SCAN_AIMD_ERROR_RATE = 0.01
+SCAN_AUTO_TIMEOUT_START = 3.0
+SCAN_AUTO_TIMEOUT_MIN = 0.3
+SCAN_AUTO_TIMEOUT_MAX = 5.0
+SCAN_RTT_SAMPLES = 2048
+SCAN_RTT_MIN_SAMPLES = 50
+SCAN_RTT_MULTIPLIER = 3.0
+# FD 预算: 每个连接占一个 FD，留出本进程其余用途 (数据库、日志、Telegram 连接等) 的余量
+SCAN_FD_RESERVE = 256
+
+def scan_fd_budget():
+    """按当前 RLIMIT_NOFILE 软限制 (main() 启动时已提升) 计算本进程可用于扫描连接的 FD 数。"""
+    try:
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ValueError, resource.error):
+        soft = 1024
+    if soft == resource.RLIM_INFINITY: soft = 65536
+    return max(SCAN_AUTO_MIN_CONCURRENCY, soft - SCAN_FD_RESERVE)
 
-async def async_scanner_orchestrator(scan_targets, concurrency, timeout, progress_callback=None):
-    semaphore = asyncio.Semaphore(concurrency)
-    total_tasks = len(scan_targets)
+class ScanController:
+    """
+    concurrency / timeout 为 None 时分别进入自动模式；同时负责统计扫描结果。
+    max_concurrency 是本进程的 FD 预算，固定并发也不会超过它。
+    """
+    def __init__(self, concurrency=None, timeout=None, max_concurrency=None):
+        self.auto_concurrency = concurrency is None
+        self.auto_timeout = timeout is None
+        cap = max_concurrency or scan_fd_budget()
+        self.max_limit = min(cap, SCAN_AUTO_MAX_CONCURRENCY if self.auto_concurrency else concurrency)
+        self.limit = min(self.max_limit, SCAN_AUTO_START_CONCURRENCY) if self.auto_concurrency else self.max_limit
+        self.base_timeout = SCAN_AUTO_TIMEOUT_START if self.auto_timeout else timeout
+        self.active = 0
+        self.cond = None
+        self.rtts = deque(maxlen=SCAN_RTT_SAMPLES)
+        self._timeout = self.base_timeout
+        self._rtt_dirty = 0
+        self.window = {'done': 0, 'timeout': 0, 'error': 0}
+        self.floor_rate = None
+        self.cooldown = 0
+        self.peak_limit = self.limit
+        self.shards = []
+        self.stats = {'probed': 0, 'open': 0, 'timeout': 0, 'error': 0, 'retried': 0, 'recovered': 0,
+                      'increase': 0, 'decrease': 0, 'started': time.monotonic()}
+
+    async def acquire(self):
+        if self.cond is None: self.cond = asyncio.Condition()
+        async with self.cond:
+            while self.active >= self.limit:
+                await self.cond.wait()
+            self.active += 1
+
+    async def release(self):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def timeout(self):
+        if not self.auto_timeout or len(self.rtts) < SCAN_RTT_MIN_SAMPLES: return self._timeout
+        if self._rtt_dirty >= SCAN_RTT_MIN_SAMPLES: # 每积累一批新样本重新计算一次分位数
+            ordered = sorted(self.rtts)
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            self._timeout = min(SCAN_AUTO_TIMEOUT_MAX, max(SCAN_AUTO_TIMEOUT_MIN, p99 * SCAN_RTT_MULTIPLIER))
+            self._rtt_dirty = 0
+        return self._timeout
+
+    def should_retry(self):
+        """只有自动超时才重试首轮超时的目标；固定超时尊重用户设定，不额外消耗时间。"""
+        return self.auto_timeout
+
+    def retry_timeout(self):
+        return min(SCAN_AUTO_TIMEOUT_MAX, self.timeout() * 2)
+
+    def record(self, state, rtt, retry=False):
+        """记录一次探测结果；首轮探测计入 AIMD 窗口。"""
+        if state in ('open', 'closed'):
+            self.rtts.append(rtt); self._rtt_dirty += 1
+        if retry:
+            if state == 'open': self.stats['recovered'] += 1
+            return
+        self.stats['probed'] += 1
+        if state in self.stats: self.stats[state] += 1
+        if not self.auto_concurrency: return
+        self.window['done'] += 1
+        if state in ('timeout', 'error'): self.window[state] += 1
+        if self.window['done'] >= max(100, self.limit): self._adjust()
+
+    def _adjust(self):
+        done = self.window['done']
+        timeout_rate, error_rate = self.window['timeout'] / done, self.window['error'] / done
+        self.window = {'done': 0, 'timeout': 0, 'error': 0}
+        if self.cooldown: # 减速后的首个窗口仍包含高并发时发出的探测，跳过
+            self.cooldown -= 1
+            return
+        if self.floor_rate is None or timeout_rate < self.floor_rate: self.floor_rate = timeout_rate
+        else: self.floor_rate += (timeout_rate - self.floor_rate) * 0.05 # 目标构成变化时基线缓慢跟随
+        if error_rate > SCAN_AIMD_ERROR_RATE or timeout_rate > self.floor_rate + SCAN_AIMD_TIMEOUT_TOLERANCE:
+            self.limit = max(SCAN_AUTO_MIN_CONCURRENCY, self.limit // 2)
+            self.cooldown = 1
+            self.stats['decrease'] += 1
+        elif self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + SCAN_AIMD_STEP)
+            self.peak_limit = max(self.peak_limit, self.limit)
+            self.stats['increase'] += 1
+
+    def snapshot(self):
+        """子进程结束时回传给父进程的统计。"""
+        return {'stats': {k: v for k, v in self.stats.items() if k != 'started'}, 'limit': self.limit,
+                'peak_limit': self.peak_limit, 'timeout': self.timeout(), 'rtt_samples': len(self.rtts)}
+
+    def absorb(self, snapshot):
+        for k, v in snapshot['stats'].items(): self.stats[k] += v
+        self.shards.append(snapshot)
+
+    def report(self):
+        s = self.stats
+        elapsed = max(0.001, time.monotonic() - s['started'])
+        lines = [f"用时 {elapsed:.0f}s, 吞吐 {s['probed'] / elapsed:.0f} 目标/秒, 首轮超时 {s['timeout']}, 本机错误 {s['error']}"]
+        if self.shards:
+            lines.append(f"分片: {len(self.shards)} 个进程")
+        if s['retried']:
+            found = s['open'] + s['recovered']
+            miss = s['recovered'] / found * 100 if found else 0
+            lines.append(f"重试 {s['retried']} 个超时目标, 其中 {s['recovered']} 个确认存活 (首轮漏报约 {miss:.1f}%)")
+        if self.auto_concurrency:
+            limit = sum(x['limit'] for x in self.shards) if self.shards else self.limit
+            peak = sum(x['peak_limit'] for x in self.shards) if self.shards else self.peak_limit
+            lines.append(f"自动并发: 最终 {limit}, 峰值 {peak} (增 {s['increase']} / 减 {s['decrease']} 次)")
+        if self.auto_timeout:
+            if self.shards:
+                timeout, samples = max(x['timeout'] for x in self.shards), sum(x['rtt_samples'] for x in self.shards)
+            else:
+                timeout, samples = self.timeout(), len(self.rtts)
+            lines.append(f"自动超时: {timeout:.2f}s (RTT 样本 {samples})")
+        return "\n".join(lines)
+
+# 目标以生成器的形式流式产生，经有界队列交给固定数量的 worker 协程，内存占用与目标总数无关
+SCAN_QUEUE_FACTOR = 2 # 队列容量 = 并发数 × 该系数
+
+def parse_scan_target(t):
+    """把一行缓存结果解析成 (host, port)，无法解析时返回 None。"""
+    try:
+        # Handle URLs with schema
+        if t.startswith('http://') or t.startswith('https://'):
+            parsed_url = urlparse(t)
+            hostname = parsed_url.hostname
+            port = parsed_url.port
+            if port is None:
+                port = 443 if parsed_url.scheme == 'https' else 80
+            # Strip brackets from IPv6 hostnames for socket connection
+            return (hostname.strip("[]"), port) if hostname else None
+
+        # Handle IPv6 in brackets like [ipv6]:port
+        match = re.match(r'\[([a-fA-F0-9:]+)\]:(\d+)', t)
+        if match:
+            return (match.group(1), int(match.group(2)))
+
+        # Handle host:port (IPv4 or domain)
+        host, port_str = t.rsplit(':', 1)
+        if host and port_str:
+            return (host, int(port_str))
+    except (ValueError, IndexError):
+        pass
+    return None
+
+def iter_cache_lines(file_path):
+    with open_cache_file(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if line: yield line
+
+def plan_scan_targets(file_path, mode, quiet=False, count=True):
+    """
+    预扫一遍缓存文件，返回 (目标总数, 目标生成器工厂)。
+    tcping 模式逐行解析；subnet 模式只保留 /24 -> 端口集合 (以整数表示网段)，展开推迟到生成器中。
+    quiet 不记录无法解析的行 (分片子进程用)；count=False 时 tcping 模式跳过计数预扫，总数返回 None。
+    """
+    if mode == 'tcping':
+        total = 0 if count else None
+        for line in (iter_cache_lines(file_path) if count else ()):
+            if parse_scan_target(line): total += 1
+            elif not quiet: logger.warning(f"无法解析扫描目标: {line}, 已跳过。")
+        def targets():
+            for line in iter_cache_lines(file_path):
+                target = parse_scan_target(line)
+                if target: yield target
+        return total, targets
+
+    subnets_to_ports = {}
+    for line in iter_cache_lines(file_path):
+        try:
+            ip_str, port_str = line.split(':'); port = int(port_str)
+            octets = [int(o) for o in ip_str.split('.')]
+            if len(octets) == 4 and all(0 <= o <= 255 for o in octets):
+                subnets_to_ports.setdefault((octets[0] << 16) | (octets[1] << 8) | octets[2], set()).add(port)
+            elif not quiet:
+                logger.warning(f"子网扫描跳过非IPv4目标: {line}")
+        except ValueError:
+            if not quiet: logger.warning(f"子网扫描无法解析行: {line}")
+    total = sum(254 * len(ports) for ports in subnets_to_ports.values())
+    def targets():
+        for subnet, ports in subnets_to_ports.items():
+            prefix = f"{subnet >> 16}.{(subnet >> 8) & 255}.{subnet & 255}"
+            ports = sorted(ports)
+            for i in range(1, 255):
+                for port in ports:
+                    yield (f"{prefix}.{i}", port)
+    return total, targets
+
+async def async_scanner_orchestrator(scan_targets, concurrency, timeout, progress_callback=None, should_stop=None, total=None, controller=None, probes=None):
+    """
+    scan_targets 可以是任意 (host, port) 可迭代对象；total 缺省时取 len(scan_targets)。
+    concurrency / timeout 传 None 时自动调节 (见 ScanController)，传入 controller 可在结束后读取统计。
+    返回 "host:port" 列表；指定 probes 时返回探测结果字典列表 (字段见 SCAN_PROBE_COLUMNS)。
+    """
+    controller = controller or ScanController(concurrency, timeout)
+    total_tasks = total if total is not None else len(scan_targets)
     completed_tasks = 0
     all_results = []
-    
-    # Best Practice: Batch processing to avoid FD exhaustion and memory overflow
-    BATCH_SIZE = 10000
-    
-    async def worker(host, port):
+    workers, producing = [], True
+    target_queue = asyncio.Queue(maxsize=max(1, controller.max_limit) * SCAN_QUEUE_FACTOR)
+
+    def grow():
+        # 工作协程数跟随当前并发上限增加: 自动模式从起始并发开始，不会一次创建 max_limit 个。
+        # 生产者结束后不再增加，保证每个工作协程都能收到结束信号。
+        while producing and len(workers) < controller.limit:
+            workers.append(asyncio.ensure_future(worker()))
+
+    async def producer():
+        nonlocal producing
+        try:
+            for target in scan_targets:
+                if should_stop and should_stop(): break
+                await target_queue.put(target)
+        finally:
+            producing = False
+            for _ in range(len(workers)): await target_queue.put(None)
+
+    async def probe(host, port, timeout, retry=False):
+        await controller.acquire()
+        try:
+            state, rtt, info = await async_probe_port(host, port, timeout, probes)
+        except Exception:
+            state, rtt, info = 'closed', 0, None
+        finally:
+            await controller.release()
+        controller.record(state, rtt, retry=retry)
+        if state == 'open':
+            all_results.append(f"{host}:{port}" if not probes else
+                               {'host': host, 'port': port, 'rtt_ms': round(rtt * 1000, 1), **(info or {})})
+        return state
+
+    async def worker():
         nonlocal completed_tasks
-        async with semaphore:
-            try:
-                result = await async_check_port(host, port, timeout)
-            except Exception:
-                result = None
-            
+        while True:
+            target = await target_queue.get()
+            if target is None: return
+            if should_stop and should_stop(): continue # 停止后只清空队列
+            host, port = target
+            state = await probe(host, port, controller.timeout())
+            if state == 'timeout' and controller.should_retry() and not (should_stop and should_stop()):
+                controller.stats['retried'] += 1
+                await probe(host, port, controller.retry_timeout(), retry=True)
+
             completed_tasks += 1
+            grow()
             if progress_callback:
                 try:
                     await progress_callback(completed_tasks, total_tasks)
                 except Exception:
                     pass
-            return result
-
-    # Execute tasks in batches
-    for i in range(0, total_tasks, BATCH_SIZE):
-        batch = scan_targets[i : i + BATCH_SIZE]
-        tasks = [worker(host, port) for host, port in batch]
-        batch_results = await asyncio.gather(*tasks)
-        for res in batch_results:
-            if res is not None:
-                all_results.append(res)
-                
+
+    grow()
+    try:
+        await producer()
+    finally:
+        await asyncio.gather(*workers)
     return all_results
 
+# --- 多进程分片扫描 ---
+# 目标数达到 SCAN_SHARD_MIN_TARGETS 时按 CPU 核数拆成多个子进程 (config: scan_processes，0 为自动，1 为关闭)。
+# 每个子进程自己解析缓存文件，按序号取模只扫描属于自己的目标，拥有独立的事件循环和 FD 预算；
+# 结果与进度通过队列汇总到父进程。子进程用 spawn 启动，避免 fork 带走机器人线程持有的锁。
+SCAN_SHARD_MIN_TARGETS = 200000
+SCAN_SHARD_RESULT_CHUNK = 5000
+SCAN_SHARD_PROGRESS_INTERVAL = 0.5
+
+def scan_process_count(total_targets):
+    if total_targets < SCAN_SHARD_MIN_TARGETS: return 1
+    configured = int(CONFIG.get('scan_processes', 0) or 0)
+    return max(1, configured or os.cpu_count() or 1)
+
+def scan_shard_process(file_path, mode, shard, shards, concurrency, timeout, out_queue, stop_event, probes=None):
+    """子进程入口: 扫描 file_path 中序号 % shards == shard 的目标。"""
+    try:
+        _, targets = plan_scan_targets(file_path, mode, quiet=True, count=False)
+        controller = ScanController(concurrency, timeout)
+        last_report = [0.0, 0]
+
+        async def progress_callback(completed, total):
+            now = time.monotonic()
+            if now - last_report[0] >= SCAN_SHARD_PROGRESS_INTERVAL:
+                out_queue.put(('progress', shard, completed - last_report[1]))
+                last_report[:] = [now, completed]
+
+        results = asyncio.run(async_scanner_orchestrator(
+            itertools.islice(targets(), shard, None, shards), concurrency, timeout, progress_callback,
+            should_stop=stop_event.is_set, total=0, controller=controller, probes=probes))
+        out_queue.put(('progress', shard, controller.stats['probed'] - last_report[1]))
+        for i in range(0, len(results), SCAN_SHARD_RESULT_CHUNK):
+            out_queue.put(('results', shard, results[i:i + SCAN_SHARD_RESULT_CHUNK]))
+        out_queue.put(('done', shard, controller.snapshot()))
+    except BaseException as e:
+        out_queue.put(('error', shard, f"{type(e).__name__}: {e}"))
+
+def run_sharded_scan(file_path, mode, shards, concurrency, timeout, controller, progress=None, should_stop=None, probes=None):
+    """
+    启动 shards 个子进程扫描并汇总，返回存活目标列表。固定并发按进程数均分；
+    自动模式下每个进程各自从起始并发开始调节，上限为各自的 FD 预算。
+    """
+    ctx = multiprocessing.get_context('spawn')
+    out_queue, stop_event = ctx.Queue(), ctx.Event()
+    per_shard = None if concurrency is None else max(1, math.ceil(concurrency / shards))
+    processes = [ctx.Process(target=scan_shard_process, name=f"scan_shard_{i}", daemon=True,
+                             args=(file_path, mode, i, shards, per_shard, timeout, out_queue, stop_event, probes))
+                 for i in range(shards)]
+    for p in processes: p.start()
+
+    results, completed, finished = [], 0, set()
+    try:
+        while len(finished) < shards:
+            if should_stop and should_stop(): stop_event.set()
+            try:
+                kind, shard, payload = out_queue.get(timeout=1)
+            except queue.Empty:
+                # 子进程异常退出 (例如被 OOM 杀掉) 时不会回报，按退出码判定
+                for i, p in enumerate(processes):
+                    if i not in finished and not p.is_alive() and p.exitcode not in (0, None):
+                        logger.error(f"扫描分片 {i} 异常退出 (exitcode={p.exitcode})")
+                        finished.add(i)
+                continue
+            if kind == 'progress':
+                completed += payload
+                if progress: progress(completed)
+            elif kind == 'results':
+                results.extend(payload)
+            elif kind == 'done':
+                controller.absorb(payload)
+                finished.add(shard)
+            elif kind == 'error':
+                logger.error(f"扫描分片 {shard} 失败: {payload}")
+                finished.add(shard)
+    finally:
+        stop_event.set()
+        for p in processes:
+            p.join(timeout=10)
+            if p.is_alive(): p.terminate()
+    return results
+
 def run_async_scan_job(context: CallbackContext):
     job_context = context.job.context
     chat_id, msg, original_query, mode = job_context['chat_id'], job_context['msg'], job_context['original_query'], job_context['mode']
     concurrency, timeout = job_context['concurrency'], job_context['timeout']
+    probes, output_format = job_context.get('probes'), job_context.get('output_format', 'jsonl')
     
     cached_item = find_cached_query(original_query)
     if not cached_item:
-        try: msg.edit_text("❌ 找不到结果文件的本地缓存记录。")
-        except (BadRequest, RetryAfter, TimedOut): pass
+        OUTBOX.edit_now(msg, "❌ 找不到结果文件的本地缓存记录。")
         return
 
-    try: msg.edit_text("1/3: 正在解析和加载目标...")
-    except (BadRequest, RetryAfter, TimedOut): pass
-    
+    OUTBOX.edit_now(msg, "1/3: 正在解析和加载目标...")
+    scan_type_text = "TCP存活扫描" if mode == 'tcping' else "子网扫描"
     try:
-        with open(cached_item['cache']['file_path'], 'r', encoding='utf-8') as f:
-            raw_targets = [line.strip() for line in f if line.strip()]
+        total_targets, scan_targets = plan_scan_targets(cached_item['cache']['file_path'], mode)
     except Exception as e:
-        try: msg.edit_text(f"❌ 读取缓存文件失败: {e}")
-        except (BadRequest, RetryAfter, TimedOut): pass
+        OUTBOX.edit_now(msg, f"❌ 读取缓存文件失败: {e}")
         return
-        
-    scan_targets = []
-    scan_type_text = ""
-    if mode == 'tcping':
-        scan_type_text = "TCP存活扫描"
-        for t in raw_targets:
-            try:
-                # Handle URLs with schema
-                if t.startswith('http://') or t.startswith('https://'):
-                    parsed_url = urlparse(t)
-                    hostname = parsed_url.hostname
-                    port = parsed_url.port
-                    if port is None:
-                        port = 443 if parsed_url.scheme == 'https' else 80
-                    if hostname:
-                        # Strip brackets from IPv6 hostnames for socket connection
-                        hostname = hostname.strip("[]")
-                        scan_targets.append((hostname, port))
-                    continue
-                
-                # Handle IPv6 in brackets like [ipv6]:port
-                match = re.match(r'\[([a-fA-F0-9:]+)\]:(\d+)', t)
-                if match:
-                    scan_targets.append((match.group(1), int(match.group(2))))
-                    continue
 
-                # Handle host:port (IPv4 or domain)
-                host, port_str = t.rsplit(':', 1)
-                if host and port_str:
-                    scan_targets.append((host, int(port_str)))
-            except (ValueError, IndexError):
-                logger.warning(f"无法解析扫描目标: {t}, 已跳过。")
-                continue
-
-    elif mode == 'subnet':
-        scan_type_text = "子网扫描"
-        subnets_to_ports = {}
-        for line in raw_targets:
-            try:
-                ip_str, port_str = line.strip().split(':'); port = int(port_str)
-                # Basic check for IPv4 before splitting
-                if '.' in ip_str and len(ip_str.split('.')) == 4:
-                    subnet = ".".join(ip_str.split('.')[:3])
-                    if subnet not in subnets_to_ports: subnets_to_ports[subnet] = set()
-                    subnets_to_ports[subnet].add(port)
-                else:
-                    logger.warning(f"子网扫描跳过非IPv4目标: {line}")
-            except ValueError:
-                logger.warning(f"子网扫描无法解析行: {line}")
-                continue
-        for subnet, ports in subnets_to_ports.items():
-            for i in range(1, 255):
-                for port in ports:
-                    scan_targets.append((f"{subnet}.{i}", port))
-
-    if not scan_targets:
-        try: msg.edit_text("🤷‍♀️ 未能从文件中解析出任何有效的目标。请检查文件内容格式。")
-        except (BadRequest, RetryAfter, TimedOut): pass
+    if not total_targets:
+        OUTBOX.edit_now(msg, "🤷‍♀️ 未能从文件中解析出任何有效的目标。请检查文件内容格式。")
         return
         
-    async def main_scan_logic():
-        last_update_time = 0
-        
-        async def progress_callback(completed, total):
-            nonlocal last_update_time
-            current_time = time.time()
-            if total > 0 and current_time - last_update_time > 2:
-                percentage = (completed / total) * 100
-                progress_bar = create_progress_bar(percentage)
-                try:
-                    msg.edit_text(
-                        f"2/3: 正在进行异步{scan_type_text}...\n"
-                        f"{progress_bar} ({completed}/{total})"
-                    )
-                    last_update_time = current_time
-                except (BadRequest, RetryAfter, TimedOut):
-                    pass # Ignore if editing fails, continue scanning
-
-        initial_message = f"2/3: 已加载 {len(scan_targets)} 个有效目标，开始异步{scan_type_text} (并发: {concurrency}, 超时: {timeout}s)..."
-        try:
-            msg.edit_text(initial_message)
-        except (BadRequest, RetryAfter, TimedOut):
-            pass
+    controller = ScanController(concurrency, timeout)
+    shards = scan_process_count(total_targets)
+    should_stop = lambda: context.bot_data.get(job_stop_flag(job_context))
+    scan_started = time.time()
+
+    def report_progress(completed, total=total_targets):
+        track_job(job_context, rows=completed, total=total)
+        if total > 0:
+            # 由 OUTBOX 合并与限速，这里每次完成都可以直接提交最新进度
+            OUTBOX.edit(msg,
+                f"2/3: 正在进行异步{scan_type_text}...\n"
+                f"{create_progress_bar(completed / total * 100)} ({completed}/{total})\n"
+                f"{format_rate_eta(completed, total, scan_started)}"
+            )
 
-        return await async_scanner_orchestrator(scan_targets, concurrency, timeout, progress_callback)
+    probe_text = f", 探测: {','.join(probes)}" if probes else ""
+    initial_message = (f"2/3: 已加载 {total_targets} 个有效目标，开始异步{scan_type_text} "
+                       f"(并发: {concurrency or '自动'}, 超时: {f'{timeout}s' if timeout else '自动'}"
+                       f"{f', {shards} 个进程' if shards > 1 else ''}{probe_text})...")
+    OUTBOX.edit_now(msg, initial_message)
 
-    live_results = asyncio.run(main_scan_logic())
+    if shards > 1:
+        live_results = run_sharded_scan(cached_item['cache']['file_path'], mode, shards, concurrency, timeout, controller,
+                                        progress=report_progress, should_stop=should_stop, probes=probes)
+    else:
+        async def progress_callback(completed, total):
+            report_progress(completed, total)
+        live_results = asyncio.run(async_scanner_orchestrator(scan_targets(), concurrency, timeout, progress_callback,
+                                                              should_stop=should_stop, total=total_targets, controller=controller, probes=probes))
+    scan_report = controller.report()
+    logger.info(f"扫描完成 ({mode}, {original_query[:40]}): {scan_report}")
     
     if not live_results:
-        try: msg.edit_text("🤷‍♀️ 扫描完成，但未发现任何存活的目标。")
-        except (BadRequest, RetryAfter, TimedOut): pass
+        OUTBOX.edit_now(msg, f"🤷‍♀️ 扫描完成，但未发现任何存活的目标。\n{scan_report}")
         return
 
-    try: msg.edit_text("3/3: 正在打包并发送新结果...")
-    except (BadRequest, RetryAfter, TimedOut): pass
+    OUTBOX.edit_now(msg, "3/3: 正在打包并发送新结果...")
     
-    output_filename = generate_filename_from_query(original_query, prefix=f"{mode}_scan")
-    with open(output_filename, 'w', encoding='utf-8') as f: f.write("\n".join(sorted(list(live_results))))
+    output_filename = generate_filename_from_query(original_query, prefix=f"{mode}_scan", ext=f".{output_format}" if probes else ".txt")
+    verified_text = ""
+    if probes:
+        write_probe_results(output_filename, live_results, output_format)
+        verified = sum(1 for row in live_results if row.get('verified'))
+        verified_text = f"其中 *{verified}* 个通过应用层验证\\.\n"
+    else:
+        with open(output_filename, 'w', encoding='utf-8') as f: f.write("\n".join(sorted(list(live_results))))
     
-    final_caption = f"✅ *异步{escape_markdown_v2(scan_type_text)}完成\\!*\n\n共发现 *{len(live_results)}* 个存活目标\\."
+    final_caption = (f"✅ *异步{escape_markdown_v2(scan_type_text)}完成\\!*\n\n共发现 *{len(live_results)}* 个存活目标\\.\n"
+                     f"{verified_text}_{escape_markdown_v2(scan_report)}_")
     send_file_safely(context, chat_id, output_filename, caption=final_caption, parse_mode=ParseMode.MARKDOWN_V2)
     upload_and_send_links(context, chat_id, output_filename)
     os.remove(output_filename)
-    try: msg.delete()
-    except (BadRequest, RetryAfter, TimedOut): pass
+    OUTBOX.delete(msg)
 
 # --- 扫描流程入口 ---
 def offer_post_download_actions(context: CallbackContext, chat_id, query_text):
@@ -1033,72 +2965,492 @@ def start_scan_callback(update: Update, context: CallbackContext) -> int:
 
     context.user_data['scan_original_query'] = original_query
     context.user_data['scan_mode'] = mode
-    query.message.edit_text("请输入扫描并发数 (建议 100-5000):")
+    query.message.edit_text("请输入扫描并发数 (建议 100-5000，输入 auto 按网络状况自动调节):")
     return SCAN_STATE_GET_CONCURRENCY
 def get_concurrency_callback(update: Update, context: CallbackContext) -> int:
     try:
-        concurrency = int(update.message.text)
-        if not 1 <= concurrency <= 50000: raise ValueError
+        text = update.message.text.strip().lower()
+        concurrency = None if text == 'auto' else int(text)
+        if concurrency is not None and not 1 <= concurrency <= 50000: raise ValueError
         context.user_data['scan_concurrency'] = concurrency
-        update.message.reply_text("请输入连接超时时间 (秒, 建议 1-3):")
+        update.message.reply_text("请输入连接超时时间 (秒, 建议 1-3，输入 auto 按实测 RTT 自动计算):")
         return SCAN_STATE_GET_TIMEOUT
     except ValueError:
-        update.message.reply_text("无效输入，请输入 1-50000 之间的整数。")
+        update.message.reply_text("无效输入，请输入 1-50000 之间的整数或 auto。")
         return SCAN_STATE_GET_CONCURRENCY
 def get_timeout_callback(update: Update, context: CallbackContext) -> int:
     try:
-        timeout = float(update.message.text)
-        if not 0.1 <= timeout <= 10: raise ValueError
-        msg = update.message.reply_text("✅ 参数设置完毕，任务已提交到后台。")
-        job_context = {
-            'chat_id': update.effective_chat.id, 'msg': msg,
-            'original_query': context.user_data['scan_original_query'],
-            'mode': context.user_data['scan_mode'],
-            'concurrency': context.user_data['scan_concurrency'],
-            'timeout': timeout
-        }
-        context.job_queue.run_once(run_async_scan_job, 1, context=job_context, name=f"scan_{update.effective_chat.id}")
-        context.user_data.clear()
-        return ConversationHandler.END
-    except ValueError:
-        update.message.reply_text("无效输入，请输入 0.1-10 之间的数字。")
-        return SCAN_STATE_GET_TIMEOUT
+        text = update.message.text.strip().lower()
+        timeout = None if text == 'auto' else float(text)
+        if timeout is not None and not 0.1 <= timeout <= 10: raise ValueError
+        context.user_data['scan_timeout'] = timeout
+        update.message.reply_text(
+            "请选择应用层探测 (在同一连接上验证服务并输出结构化结果):\n"
+            f"off - 只检测端口存活\nauto - 按端口自动选择\n或指定插件: {', '.join(SCAN_PROBES)}\n"
+            "可在末尾附加输出格式 jsonl 或 csv，例如: auto csv")
+        return SCAN_STATE_GET_PROBES
+    except ValueError:
+        update.message.reply_text("无效输入，请输入 0.1-10 之间的数字或 auto。")
+        return SCAN_STATE_GET_TIMEOUT
+def get_probes_callback(update: Update, context: CallbackContext) -> int:
+    try:
+        probes, output_format = parse_probe_selection(update.message.text)
+    except ValueError as e:
+        update.message.reply_text(f"❌ {e}\n可用插件: {', '.join(SCAN_PROBES)}")
+        return SCAN_STATE_GET_PROBES
+    msg = update.message.reply_text("✅ 参数设置完毕，任务已提交到后台。")
+    job_context = {
+        'chat_id': update.effective_chat.id, 'msg': msg,
+        'original_query': context.user_data['scan_original_query'],
+        'mode': context.user_data['scan_mode'],
+        'concurrency': context.user_data['scan_concurrency'],
+        'timeout': context.user_data['scan_timeout'],
+        'probes': probes, 'output_format': output_format
+    }
+    submit_job(context, 'scan', run_async_scan_job, job_context, update.effective_chat.id, is_guest=not is_admin(update.effective_user.id))
+    context.user_data.clear()
+    return ConversationHandler.END
+
+# --- Telegram 消息出口 (进度合并与限速) ---
+class TelegramOutbox:
+    """
+    所有进度类消息编辑的统一出口，由单独线程按预算发送:
+    - 同一条消息 (chat_id, message_id) 的多次编辑只保留最后一次 (last write wins)
+    - 全局速率预算 tg_global_rate (条/秒) 与单会话最小间隔 tg_chat_edit_interval (秒)
+    - 收到 RetryAfter 时整体暂停对应秒数，未被覆盖的编辑重新入队
+    - edit_now()/delete() 同步执行并丢弃该消息尚未发出的进度，避免最终结果被旧进度覆盖；
+      如果该消息有一次进度编辑正在发出，会先等它完成，保证最终结果一定是最后一次编辑
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._inflight = set() # 发送线程正在编辑的消息
+        self._chat_next = {}
+        self._sent_times = deque()
+        self._paused_until = 0
+        self._thread = None
+        self.stats = {'queued': 0, 'coalesced': 0, 'sent': 0, 'retry_after': 0}
+
+    def _global_rate(self):
+        return max(1, int(CONFIG.get('tg_global_rate', 25)))
+
+    def _chat_interval(self):
+        return float(CONFIG.get('tg_chat_edit_interval', 3))
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="tg_outbox", daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _slot(message):
+        return (message.chat_id, message.message_id)
+
+    def edit(self, message, text, **kwargs):
+        """排队一次进度编辑，立即返回。"""
+        if message is None: return
+        with self._cond:
+            slot = self._slot(message)
+            if slot in self._pending:
+                self.stats['coalesced'] += 1
+                enqueued = self._pending[slot]['enqueued']
+            else:
+                enqueued = time.monotonic()
+            self._pending[slot] = {'message': message, 'text': text, 'kwargs': kwargs, 'enqueued': enqueued}
+            self.stats['queued'] += 1
+            self._ensure_started()
+            self._cond.notify()
+
+    def cancel(self, message):
+        """丢弃该消息排队中的进度，并等待正在发出的那一次完成。"""
+        if message is None: return
+        slot = self._slot(message)
+        with self._cond:
+            while slot in self._inflight:
+                self._cond.wait(timeout=1)
+            self._pending.pop(slot, None)
+
+    def _wait_budget(self):
+        """同步发送前等待全局预算与 RetryAfter 暂停。"""
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while self._sent_times and now - self._sent_times[0] > 1: self._sent_times.popleft()
+                delay = max(self._paused_until - now, 0)
+                if not delay and len(self._sent_times) >= self._global_rate():
+                    delay = 1 - (now - self._sent_times[0])
+                if delay <= 0:
+                    self._sent_times.append(now)
+                    return
+            time.sleep(min(delay, 5))
+
+    def _call(self, func, *args, **kwargs):
+        for _ in range(3):
+            self._wait_budget()
+            try:
+                return func(*args, **kwargs)
+            except RetryAfter as e:
+                self._pause(e.retry_after)
+            except (BadRequest, TimedOut) as e:
+                if "not modified" not in str(e).lower():
+                    logger.warning(f"Telegram 消息操作失败: {e}")
+                return None
+        return None
+
+    def edit_now(self, message, text, **kwargs):
+        """立即编辑 (用于最终结果)，并丢弃该消息排队中的进度。"""
+        if message is None: return None
+        self.cancel(message)
+        return self._call(message.edit_text, text, **kwargs)
+
+    def delete(self, message):
+        if message is None: return None
+        self.cancel(message)
+        return self._call(message.delete)
+
+    def _pause(self, retry_after):
+        with self._cond:
+            self.stats['retry_after'] += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + float(retry_after) + 0.5)
+        logger.warning(f"Telegram 限流 (RetryAfter {retry_after}s)，出站消息暂停。")
+
+    def _next_ready(self):
+        now = time.monotonic()
+        while self._sent_times and now - self._sent_times[0] > 1: self._sent_times.popleft()
+        waits = [self._paused_until - now]
+        if len(self._sent_times) >= self._global_rate():
+            waits.append(1 - (now - self._sent_times[0]))
+        if max(waits) > 0:
+            return None, max(waits)
+        ready, soonest = None, None
+        for slot, item in self._pending.items():
+            chat_wait = self._chat_next.get(slot[0], 0) - now
+            if chat_wait <= 0 and (ready is None or item['enqueued'] < self._pending[ready]['enqueued']):
+                ready = slot
+            elif chat_wait > 0:
+                soonest = chat_wait if soonest is None else min(soonest, chat_wait)
+        return ready, soonest
+
+    def _run(self):
+        while True:
+            with self._cond:
+                slot, wait = self._next_ready()
+                while slot is None:
+                    self._cond.wait(timeout=wait)
+                    slot, wait = self._next_ready()
+                item = self._pending.pop(slot)
+                self._inflight.add(slot)
+                now = time.monotonic()
+                self._sent_times.append(now)
+                self._chat_next[slot[0]] = now + self._chat_interval()
+            try:
+                item['message'].edit_text(item['text'], **item['kwargs'])
+                self.stats['sent'] += 1
+            except RetryAfter as e:
+                self._pause(e.retry_after)
+                with self._cond:
+                    self._pending.setdefault(slot, item)
+            except (BadRequest, TimedOut, NetworkError) as e:
+                if "not modified" not in str(e).lower():
+                    logger.debug(f"进度消息编辑失败: {e}")
+            except Exception as e:
+                logger.warning(f"出站消息线程异常: {e}")
+            finally:
+                with self._cond:
+                    self._inflight.discard(slot)
+                    self._cond.notify_all()
+
+OUTBOX = TelegramOutbox()
+
+def format_rate_eta(done, total, started_at):
+    """进度文本中的速率与预计剩余时间。"""
+    elapsed = max(time.time() - started_at, 1e-6)
+    rate = done / elapsed
+    eta = format_duration((total - done) / rate) if total and rate > 0 and total > done else "-"
+    return f"速率: {rate:.1f} 条/s | ETA: {eta}"
+
+# --- 全局任务调度 (准入控制) ---
+# 准入后的任务跑在 JobQueue (APScheduler) 的线程池里，线程数 = 各类上限之和 + 定时任务预留；
+# run_once 关闭 misfire 宽限，线程暂时占满时任务晚些执行而不是被当作 missed 丢弃 (丢弃会泄漏运行名额)。
+JOB_QUEUE_RESERVED_THREADS = 2 # monitor_tick / cache_maintenance
+JOB_PRIORITY_ADMIN, JOB_PRIORITY_GUEST = 0, 1
+
+class JobScheduler:
+    """
+    所有重任务的统一入口，负责准入控制:
+    - 每类任务 (download/scan/batchfind/monitor) 独立的并发上限 (config: job_limits)
+    - 管理员任务优先于访客任务
+    - 同优先级内在会话之间公平轮转: 当前运行任务最少、最久未被服务的会话先出队
+    - 排队的任务会收到队列位置反馈，位置变化时自动更新
+    每个任务分配唯一 job_id，同一会话可并行多个任务，可通过 /jobs 查看、/stop <id> 单独停止。
+    """
+    STOP_ALL_SKIP = ('monitor',) # 不带 id 的 /stop 不影响定时监控，避免误停长期任务
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._seq = 0
+        self._queued = {job_class: [] for job_class in DEFAULT_JOB_LIMITS}
+        self._running = {}
+        self._last_served = {}
+
+    def capacity(self):
+        """所有任务类别同时运行的上限之和，用于确定 JobQueue 线程池大小。"""
+        return sum(self.limit(job_class) for job_class in DEFAULT_JOB_LIMITS)
+
+    def limit(self, job_class):
+        limits = CONFIG.get('job_limits') or {}
+        return max(1, int(limits.get(job_class, DEFAULT_JOB_LIMITS.get(job_class, 1))))
+
+    def _running_in(self, job_class):
+        return [e for e in self._running.values() if e['class'] == job_class]
+
+    def _pick(self, candidates, running_by_chat):
+        return min(candidates, key=lambda e: (
+            e['priority'], running_by_chat.get(e['chat_id'], 0),
+            self._last_served.get(e['chat_id'], 0), e['id']))
+
+    def _dispatch_order(self, job_class):
+        """模拟出队顺序，用于计算队列位置。"""
+        running_by_chat = {}
+        for e in self._running_in(job_class):
+            running_by_chat[e['chat_id']] = running_by_chat.get(e['chat_id'], 0) + 1
+        pending, order = list(self._queued[job_class]), []
+        while pending:
+            entry = self._pick(pending, running_by_chat)
+            pending.remove(entry); order.append(entry)
+            running_by_chat[entry['chat_id']] = running_by_chat.get(entry['chat_id'], 0) + 1
+        return order
+
+    def submit(self, job_queue, job_class, callback, job_data, chat_id=None, priority=JOB_PRIORITY_ADMIN, name=None, bot=None, on_cancel=None):
+        """
+        提交任务，返回 (job_id, 排队位置)，位置为 0 表示已立即开始。
+        on_cancel 在任务未能开始执行 (排队中被取消、无法调度) 时调用，供调用方释放自己的占位。
+        """
+        with self._lock:
+            self._seq += 1
+            job_id = str(self._seq)
+            job_data = dict(job_data) if isinstance(job_data, dict) else {}
+            metrics = {'rows': 0, 'requests': 0, 'keys': set(), 'total': job_data.get('limit') or job_data.get('total_size')}
+            job_data.update(job_id=job_id, metrics=metrics)
+            entry = {
+                'id': self._seq, 'job_id': job_id, 'class': job_class, 'callback': callback,
+                'job_data': job_data, 'metrics': metrics, 'label': str(job_data.get('query') or job_data.get('original_query') or job_data.get('task_id', '')),
+                'chat_id': chat_id, 'priority': priority, 'name': name or f"{job_class}_{job_id}",
+                'submitted': time.time(), 'started': None, 'bot': bot, 'queue_msg': None, 'on_cancel': on_cancel,
+            }
+            self._queued.setdefault(job_class, []).append(entry)
+        self._dispatch(job_queue)
+        with self._lock:
+            if entry not in self._queued.get(job_class, []):
+                return job_id, 0
+            position = self._dispatch_order(job_class).index(entry) + 1
+        if bot and chat_id:
+            try:
+                entry['queue_msg'] = bot.send_message(chat_id, f"⏳ 当前同类任务较多，任务 #{job_id} 已进入队列，排在第 {position} 位。\n使用 /stop {job_id} 可取消。")
+            except Exception as e:
+                logger.warning(f"发送排队通知失败: {e}")
+        return job_id, position
+
+    def _dispatch(self, job_queue):
+        started, to_notify = [], []
+        with self._lock:
+            for job_class, pending in self._queued.items():
+                while pending and len(self._running_in(job_class)) < self.limit(job_class):
+                    running_by_chat = {}
+                    for e in self._running_in(job_class):
+                        running_by_chat[e['chat_id']] = running_by_chat.get(e['chat_id'], 0) + 1
+                    entry = self._pick(pending, running_by_chat)
+                    pending.remove(entry)
+                    entry['started'] = time.time()
+                    self._running[entry['id']] = entry
+                    self._last_served[entry['chat_id']] = time.monotonic()
+                    started.append(entry)
+                if started:
+                    to_notify.extend((e, i + 1) for i, e in enumerate(self._dispatch_order(job_class)) if e['queue_msg'])
+
+        for entry in started:
+            try:
+                job_queue.run_once(self._make_runner(entry), 0, context=entry['job_data'], name=entry['name'],
+                                   job_kwargs={'misfire_grace_time': None})
+            except RuntimeError as e:
+                logger.warning(f"无法调度任务 {entry['name']} (可能正在关闭): {e}")
+                with self._lock: self._running.pop(entry['id'], None)
+                self._cancelled(entry)
+                continue
+            if entry['queue_msg']:
+                OUTBOX.edit_now(entry['queue_msg'], f"▶️ 排队结束，任务 #{entry['job_id']} 开始执行。")
+        for entry, position in to_notify:
+            OUTBOX.edit(entry['queue_msg'], f"⏳ 任务 #{entry['job_id']} 正在排队，当前排在第 {position} 位。")
+
+    def _make_runner(self, entry):
+        def runner(context: CallbackContext):
+            try:
+                entry['callback'](context)
+            except Exception as e:
+                logger.error(f"任务 {entry['name']} 异常退出: {e}", exc_info=True)
+            finally:
+                with self._lock: self._running.pop(entry['id'], None)
+                context.bot_data.pop(f"stop_job_{entry['job_id']}", None)
+                self._dispatch(context.job_queue)
+        return runner
+
+    def stop(self, bot_data, chat_id, job_id=None):
+        """
+        停止会话内的任务: 排队中的直接移出队列，运行中的设置 stop_job_<job_id> 标志。
+        不指定 job_id 时作用于该会话的全部任务，但跳过 STOP_ALL_SKIP 中的类别 (定时监控)。
+        返回 (已通知停止的运行任务, 已取消的排队任务)。
+        """
+        def matches(entry):
+            if entry['chat_id'] != chat_id: return False
+            return entry['job_id'] == job_id if job_id else entry['class'] not in self.STOP_ALL_SKIP
+
+        stopped, cancelled = [], []
+        with self._lock:
+            for entry in self._running.values():
+                if matches(entry):
+                    bot_data[f"stop_job_{entry['job_id']}"] = True
+                    stopped.append(entry['job_id'])
+            for pending in self._queued.values():
+                for entry in [e for e in pending if matches(e)]:
+                    pending.remove(entry); cancelled.append(entry)
+        for entry in cancelled:
+            self._cancelled(entry)
+            if entry['queue_msg']:
+                OUTBOX.edit_now(entry['queue_msg'], f"🛑 排队中的任务 #{entry['job_id']} 已取消。")
+        return stopped, [e['job_id'] for e in cancelled]
+
+    @staticmethod
+    def _cancelled(entry):
+        if not entry.get('on_cancel'): return
+        try: entry['on_cancel']()
+        except Exception as e: logger.error(f"任务 {entry['name']} 取消回调出错: {e}")
+
+    def snapshot(self, chat_id=None):
+        """返回 (运行中, 排队中) 两个列表，排队列表按预计出队顺序排列。"""
+        with self._lock:
+            running = sorted((e for e in self._running.values() if chat_id in (None, e['chat_id'])), key=lambda e: e['id'])
+            queued = []
+            for job_class in self._queued:
+                for position, entry in enumerate(self._dispatch_order(job_class), 1):
+                    if chat_id in (None, entry['chat_id']): queued.append((position, entry))
+            return running, queued
+
+    def summary(self):
+        with self._lock:
+            return {cls: (len(self._running_in(cls)), len(self._queued.get(cls, [])), self.limit(cls)) for cls in DEFAULT_JOB_LIMITS}
+
+JOB_SCHEDULER = JobScheduler()
+
+def submit_job(context: CallbackContext, job_class, callback_func, job_data, chat_id, is_guest=False, name=None):
+    """提交任务到全局调度器，返回 (job_id, 排队位置)。"""
+    return JOB_SCHEDULER.submit(
+        context.job_queue, job_class, callback_func, job_data, chat_id=chat_id,
+        priority=JOB_PRIORITY_GUEST if is_guest else JOB_PRIORITY_ADMIN, name=name, bot=context.bot)
+
+def job_stop_flag(job_data):
+    return f"stop_job_{job_data.get('job_id') or job_data['chat_id']}"
+
+def track_job(job_data, rows=None, total=None, requests=0, key=None):
+    """向 /jobs 面板汇报任务进度 (metrics 由调度器在提交时注入)。"""
+    metrics = job_data.get('metrics') if isinstance(job_data, dict) else None
+    if metrics is None: return
+    if rows is not None: metrics['rows'] = rows
+    if total is not None: metrics['total'] = total
+    if requests: metrics['requests'] += requests
+    if key: metrics['keys'].add(key[-4:])
+
+def get_process_rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'): return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError): pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def format_duration(seconds):
+    seconds = int(max(0, seconds))
+    if seconds < 60: return f"{seconds}s"
+    if seconds < 3600: return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
 
 # --- 后台下载任务 ---
 def start_download_job(context: CallbackContext, callback_func, job_data):
-    chat_id = job_data['chat_id']; job_name = f"download_job_{chat_id}"
-    for job in context.job_queue.get_jobs_by_name(job_name): job.schedule_removal()
-    context.bot_data.pop(f'stop_job_{chat_id}', None)
-    context.job_queue.run_once(callback_func, 1, context=job_data, name=job_name)
+    chat_id = job_data['chat_id']
+    job_id, _ = submit_job(context, 'download', callback_func, job_data, chat_id, is_guest=bool(job_data.get('guest_key')))
+    return job_id
+def cache_high_water(started_at):
+    """
+    下载开始当天的日期，作为缓存的增量高水位。增量更新从该日起 (含当天) 重新获取，
+    下载期间更新的资产不会漏掉。所有写缓存的下载引擎都记录它，增量更新不再从历史时间戳推断。
+    """
+    return datetime.fromtimestamp(started_at).strftime('%Y-%m-%d')
+
 def run_full_download_query(context: CallbackContext):
     job_data = context.job.context; bot, chat_id, query_text, total_size = context.bot, job_data['chat_id'], job_data['query'], job_data['total_size']
-    output_filename = generate_filename_from_query(query_text); unique_results, stop_flag = set(), f'stop_job_{chat_id}'
-    msg = bot.send_message(chat_id, "⏳ 开始全量下载任务..."); pages_to_fetch = (total_size + 9999) // 10000
+    output_filename = generate_filename_from_query(query_text); unique_results, stop_flag = set(), job_stop_flag(job_data)
+    msg = bot.send_message(chat_id, "⏳ 开始全量下载任务..."); pages_to_fetch = (total_size + 9999) // 10000; start_time = time.time()
     for page in range(1, pages_to_fetch + 1):
-        if context.bot_data.get(stop_flag): msg.edit_text("🌀 下载任务已手动停止."); break
-        try: msg.edit_text(f"下载进度: {len(unique_results)}/{total_size} (Page {page}/{pages_to_fetch})...")
-        except (BadRequest, RetryAfter, TimedOut): pass
+        if context.bot_data.get(stop_flag): OUTBOX.edit_now(msg, "🌀 下载任务已手动停止."); break
+        OUTBOX.edit(msg, f"下载进度: {len(unique_results)}/{total_size} (Page {page}/{pages_to_fetch})...\n{format_rate_eta(len(unique_results), total_size, start_time)}")
         guest_key = job_data.get('guest_key')
         if guest_key:
-            data, error = fetch_fofa_data(guest_key, query_text, page, 10000, "host")
+            data, error = fetch_fofa_data(guest_key, query_text, page, 10000, "host"); used_key = guest_key
         else:
-            data, _, _, _, _, error = execute_query_with_fallback(
+            data, used_key, _, _, _, error = execute_query_with_fallback(
                 lambda key, key_level, proxy_session: fetch_fofa_data(key, query_text, page, 10000, "host", proxy_session=proxy_session)
             )
-        if error: msg.edit_text(f"❌ 第 {page} 页下载出错: {error}"); break
+        track_job(job_data, requests=1, key=used_key)
+        if error: OUTBOX.edit_now(msg, f"❌ 第 {page} 页下载出错: {error}"); break
         results = data.get('results', []);
         if not results: break
         unique_results.update(res for res in results if ':' in res)
+        track_job(job_data, rows=len(unique_results))
     if unique_results:
-        with open(output_filename, 'w', encoding='utf-8') as f: f.write("\n".join(unique_results))
-        msg.edit_text(f"✅ 下载完成！共 {len(unique_results)} 条。正在发送...")
-        cache_path = os.path.join(FOFA_CACHE_DIR, output_filename)
-        shutil.move(output_filename, cache_path)
+        cache_path = cache_file_path(output_filename)
+        with open_cache_file(cache_path, 'w') as f: f.write("\n".join(unique_results))
+        OUTBOX.edit_now(msg, f"✅ 下载完成！共 {len(unique_results)} 条。正在发送...")
         send_file_safely(context, chat_id, cache_path, filename=output_filename)
         upload_and_send_links(context, chat_id, cache_path)
-        cache_data = {'file_path': cache_path, 'result_count': len(unique_results)}
-        add_or_update_query(query_text, cache_data); offer_post_download_actions(context, chat_id, query_text)
-    elif not context.bot_data.get(stop_flag): msg.edit_text("🤷‍♀️ 任务完成，但未能下载到任何数据。")
+        cache_data = {'file_path': cache_path, 'result_count': len(unique_results), 'high_water': cache_high_water(start_time)}
+        add_or_update_query(query_text, cache_data); archive_results(query_text, unique_results)
+        offer_post_download_actions(context, chat_id, query_text)
+    elif not context.bot_data.get(stop_flag): OUTBOX.edit_now(msg, "🤷‍♀️ 任务完成，但未能下载到任何数据。")
+    context.bot_data.pop(stop_flag, None)
+
+def run_incremental_update_query(context: CallbackContext):
+    """缓存增量更新: 只拉取缓存高水位之后更新的资产并合并进新的缓存文件。"""
+    job_data = context.job.context; bot, chat_id, query_text = context.bot, job_data['chat_id'], job_data['query']
+    stop_flag = job_stop_flag(job_data)
+    msg = bot.send_message(chat_id, "⏳ 开始增量更新...")
+    cached_item = find_cached_query(query_text)
+    if not cached_item: OUTBOX.edit_now(msg, "❌ 找不到本地缓存记录，请重新搜索。"); return
+    old_path, high_water = cached_item['cache']['file_path'], cached_item['cache'].get('high_water')
+    if not high_water:
+        # 导入的文件或旧版本缓存没有记录数据截止日期，从历史时间戳推断会静默漏掉中间的更新
+        OUTBOX.edit_now(msg, "❌ 该缓存没有记录下载日期 (导入或旧版本缓存)，无法增量更新，请使用全新搜索重新下载。"); return
+    since = datetime.strptime(high_water, '%Y-%m-%d').date()
+    with KEY_LEASES.lease(min_level=1, owner=f"incremental#{job_data.get('job_id')}") as lease:
+        if not lease: OUTBOX.edit_now(msg, "❌ 增量更新需要个人会员及以上等级的 Key (查询 lastupdatetime)。"); return
+        OUTBOX.edit_now(msg, f"⏳ 正在获取 {high_water} 之后更新的数据...")
+        rows, covered, complete, error, requests_used = fetch_fofa_delta(lease, query_text, since, should_stop=lambda: context.bot_data.get(stop_flag))
+    track_job(job_data, requests=requests_used, rows=len(rows))
+    if error and not rows: OUTBOX.edit_now(msg, f"❌ 增量更新失败: {error}"); context.bot_data.pop(stop_flag, None); return
+    delta_hosts = {row[0] for row in rows if row and row[0]}
+    with open_cache_file(old_path) as f: known = {line.strip() for line in f if line.strip()}
+    new_hosts = delta_hosts - known
+    output_filename = generate_filename_from_query(query_text)
+    cache_path = cache_file_path(output_filename)
+    with open_cache_file(cache_path, 'w') as f:
+        f.write("\n".join(sorted(known | new_hosts)))
+    cache_data = {'file_path': cache_path, 'result_count': len(known) + len(new_hosts),
+                  'high_water': (max(covered, since) if covered else since).isoformat()}
+    add_or_update_query(query_text, cache_data); archive_results(query_text, delta_hosts)
+    for path in (old_path, old_path + LINE_INDEX_SUFFIX):
+        if path != cache_path and os.path.exists(path): os.remove(path)
+    note = "" if complete else "\n⚠️ 增量未完整覆盖，下次更新会从已覆盖到的日期继续。"
+    OUTBOX.edit_now(msg, f"✅ 增量更新完成！新增 {len(new_hosts)} 条，共 {cache_data['result_count']} 条。{note}")
+    send_file_safely(context, chat_id, cache_path, filename=output_filename)
+    upload_and_send_links(context, chat_id, cache_path)
     context.bot_data.pop(stop_flag, None)
 
 def run_sharded_download_job(context: CallbackContext):
@@ -1113,10 +3465,8 @@ def run_sharded_download_job(context: CallbackContext):
     
     output_filename = generate_filename_from_query(base_query, prefix="smart_sharded")
     unique_results = set()
-    stop_flag = f'stop_job_{chat_id}'
+    stop_flag = job_stop_flag(job_data)
     
-    # 定义 Big N (数据量通常巨大的国家，单独处理)
-    BIG_N = ['CN', 'US', 'DE', 'JP', 'RU', 'GB', 'FR', 'NL', 'CA', 'KR']
 
     # 发送初始消息 (已修复 Markdown 转义)
     msg = bot.send_message(chat_id, f"⏳ *启动递归二分分片下载*\n正在初始化策略引擎\.\.\.", parse_mode=ParseMode.MARKDOWN_V2)
@@ -1125,29 +3475,24 @@ def run_sharded_download_job(context: CallbackContext):
     class StatusReporter:
         def __init__(self, message_obj):
             self.msg = message_obj
-            self.last_update_time = 0
             self.current_stage = "初始化"
             self.total_found = 0
             self.start_time = time.time()
 
         def update(self, stage, force=False):
             self.current_stage = stage
-            now = time.time()
-            # 限制更新频率：每 3 秒更新一次，或者强制更新
-            if force or (now - self.last_update_time > 3):
-                try:
-                    elapsed = int(now - self.start_time)
-                    text = (
-                        f"🚀 *智能分片引擎运行中...*\n"
-                        f"⏱ 耗时: {elapsed}s\n"
-                        f"📊 已收集: *{self.total_found}* 条\n"
-                        f"🔧 *当前阶段: {escape_markdown_v2(self.current_stage)}*\n"
-                        f"💡 策略: 递归二分 \\+ 深度追溯"
-                    )
-                    self.msg.edit_text(text, parse_mode=ParseMode.MARKDOWN_V2)
-                    self.last_update_time = now
-                except (BadRequest, RetryAfter, TimedOut):
-                    pass
+            track_job(job_data, rows=len(unique_results))
+            # 更新频率由 OUTBOX 统一控制，强制更新时立即发送
+            elapsed = int(time.time() - self.start_time)
+            text = (
+                f"🚀 *智能分片引擎运行中...*\n"
+                f"⏱ 耗时: {elapsed}s\n"
+                f"📊 已收集: *{self.total_found}* 条 \\| {escape_markdown_v2(format_rate_eta(self.total_found, None, self.start_time))}\n"
+                f"🔧 *当前阶段: {escape_markdown_v2(self.current_stage)}*\n"
+                f"💡 策略: 递归二分 \\+ 深度追溯"
+            )
+            if force: OUTBOX.edit_now(self.msg, text, parse_mode=ParseMode.MARKDOWN_V2)
+            else: OUTBOX.edit(self.msg, text, parse_mode=ParseMode.MARKDOWN_V2)
 
     reporter = StatusReporter(msg)
 
@@ -1171,24 +3516,22 @@ def run_sharded_download_job(context: CallbackContext):
                 return []
 
             collected = []
-            # 获取一个可用的 key 用于迭代器
-            _, valid_key, _, _, _, _ = execute_query_with_fallback(lambda k,l,p: (True, None))
-            
-            # 使用迭代器
-            iterator = iter_fofa_traceback(valid_key, query_scope, limit=None, proxy_session=proxy_session)
-            
-            for batch in iterator:
-                if context.bot_data.get(stop_flag): break
-                valid_items = [item[0] for item in batch if item and isinstance(item, list) and len(item)>0]
-                
-                new_count = 0
-                for item in valid_items:
-                    if item not in unique_results:
-                        new_count += 1
-                
-                collected.extend(valid_items)
-                reporter.total_found += new_count
-                reporter.update(f"深度追溯 {country_code}: 已抓取 {len(collected)} 条")
+            # 租用一个 VIP Key 用于迭代器 (追溯需要 lastupdatetime)
+            with KEY_LEASES.lease(min_level=1, owner=f"sharded#{job_data.get('job_id')}") as lease:
+                if not lease: return []
+                for batch in iter_fofa_traceback(lease['key'], query_scope, limit=None, proxy_session=proxy_session, lease=lease):
+                    if context.bot_data.get(stop_flag): break
+                    track_job(job_data, requests=1, key=lease['key'])
+                    valid_items = [item[0] for item in batch if item and isinstance(item, list) and len(item)>0]
+                    
+                    new_count = 0
+                    for item in valid_items:
+                        if item not in unique_results:
+                            new_count += 1
+                    
+                    collected.extend(valid_items)
+                    reporter.total_found += new_count
+                    reporter.update(f"深度追溯 {country_code}: 已抓取 {len(collected)} 条")
             
             return collected
         except Exception as e:
@@ -1216,6 +3559,7 @@ def run_sharded_download_job(context: CallbackContext):
             data_check, _, _, _, _, error = execute_query_with_fallback(
                 lambda k, l, ps, q=_q: fetch_fofa_data(k, q, page_size=1, fields="host", proxy_session=ps, full_mode=False)
             )
+        track_job(job_data, requests=1)
         
         if error:
             logger.warning(f"侦察失败: {error}")
@@ -1235,10 +3579,12 @@ def run_sharded_download_job(context: CallbackContext):
                 data, _ = fetch_fofa_data(guest_key, group_query, page=1, page_size=10000, fields="host", full_mode=False)
             else:
                 _q = group_query
-                data, _, _, _, _, _ = execute_query_with_fallback(
+                data, used_key, _, _, _, _ = execute_query_with_fallback(
                     lambda k, l, ps, q=_q: fetch_fofa_data(k, q, page=1, page_size=10000, fields="host", proxy_session=ps, full_mode=False),
                     proxy_session=proxy_session
                 )
+                track_job(job_data, key=used_key)
+            track_job(job_data, requests=1)
             
             if data and data.get('results'):
                 new_res = [r[0] for r in data['results'] if isinstance(r, list)] if isinstance(data['results'][0], list) else data['results']
@@ -1269,9 +3615,9 @@ def run_sharded_download_job(context: CallbackContext):
     # --- 主流程开始 ---
 
     # 1. 优先处理 Big N
-    for i, big_c in enumerate(BIG_N):
+    for i, big_c in enumerate(SHARDING_BIG_N):
         if context.bot_data.get(stop_flag): break
-        reporter.update(f"处理 Big N: {big_c} ({i+1}/{len(BIG_N)})")
+        reporter.update(f"处理 Big N: {big_c} ({i+1}/{len(SHARDING_BIG_N)})")
         process_country_group([big_c])
 
     # 2. 处理剩余国家 (关键修改：分块处理)
@@ -1280,7 +3626,7 @@ def run_sharded_download_job(context: CallbackContext):
         remaining_countries = []
         for continent, countries in CONTINENT_COUNTRIES.items():
             for c in countries:
-                if c not in BIG_N:
+                if c not in SHARDING_BIG_N:
                     remaining_countries.append(c)
         
         # 去重并排序
@@ -1288,59 +3634,41 @@ def run_sharded_download_job(context: CallbackContext):
         
         # 关键修复：将剩余国家切分成小块（每 20 个一组）进行处理
         # 避免一次性构造几百个 OR 条件导致查询 URL 过长被截断或报错
-        CHUNK_SIZE = 20 
-        total_chunks = (len(remaining_countries) + CHUNK_SIZE - 1) // CHUNK_SIZE
+        total_chunks = (len(remaining_countries) + SHARDING_CHUNK_SIZE - 1) // SHARDING_CHUNK_SIZE
         
-        for i in range(0, len(remaining_countries), CHUNK_SIZE):
+        for i in range(0, len(remaining_countries), SHARDING_CHUNK_SIZE):
             if context.bot_data.get(stop_flag): break
-            chunk = remaining_countries[i : i + CHUNK_SIZE]
-            current_chunk_idx = (i // CHUNK_SIZE) + 1
+            chunk = remaining_countries[i : i + SHARDING_CHUNK_SIZE]
+            current_chunk_idx = (i // SHARDING_CHUNK_SIZE) + 1
             reporter.update(f"处理剩余分组: {current_chunk_idx}/{total_chunks}")
             process_country_group(chunk)
 
     # --- 结果处理 ---
+    used_requests = job_data.get('metrics', {}).get('requests', 0)
+    if not context.bot_data.get(stop_flag) and used_requests and job_data.get('total_size'):
+        record_shard_plan(base_query, job_data['total_size'], used_requests, len(unique_results), time.time() - reporter.start_time)
     context.bot_data.pop(stop_flag, None)
     reporter.update("任务完成，正在打包...", force=True)
     
     if unique_results:
         final_count = len(unique_results)
-        msg.edit_text(f"✅ 智能分片完成\!\n总计发现 *{final_count}* 条唯一数据。\n正在生成并发送文件\.\.\.", parse_mode=ParseMode.MARKDOWN_V2)
+        OUTBOX.edit_now(msg, f"✅ 智能分片完成\!\n总计发现 *{final_count}* 条唯一数据。\n正在生成并发送文件\.\.\.", parse_mode=ParseMode.MARKDOWN_V2)
         
-        with open(output_filename, 'w', encoding='utf-8') as f:
+        cache_path = cache_file_path(output_filename)
+        with open_cache_file(cache_path, 'w') as f:
             f.write("\n".join(sorted(list(unique_results))))
             
-        cache_path = os.path.join(FOFA_CACHE_DIR, output_filename)
-        shutil.move(output_filename, cache_path)
         send_file_safely(context, chat_id, cache_path, filename=output_filename)
         upload_and_send_links(context, chat_id, cache_path)
         
-        cache_data = {'file_path': cache_path, 'result_count': final_count}
+        cache_data = {'file_path': cache_path, 'result_count': final_count, 'high_water': cache_high_water(reporter.start_time)}
         add_or_update_query(base_query, cache_data)
+        archive_results(base_query, unique_results)
         offer_post_download_actions(context, chat_id, base_query)
     else:
-        msg.edit_text("🤷‍♀️ 任务完成，但未找到任何数据。")
+        OUTBOX.edit_now(msg, "🤷‍♀️ 任务完成，但未找到任何数据。")
 
 # 在 run_traceback_download_query 函数内部或上方定义
-def get_next_valid_key(current_key, min_level=1):
-    """寻找下一个可用的 VIP Key"""
-    apis = CONFIG.get('apis', [])
-    if not apis: return None
-    
-    try:
-        current_index = apis.index(current_key)
-    except ValueError:
-        current_index = -1
-        
-    # 从当前 Key 的下一个开始找
-    for i in range(1, len(apis) + 1):
-        next_idx = (current_index + i) % len(apis)
-        candidate_key = apis[next_idx]
-        # 确保 Key 等级足够（追溯通常需要 VIP，即 level >= 1）
-        if KEY_LEVELS.get(candidate_key, 0) >= min_level:
-            return candidate_key
-            
-    return None
-
 def run_traceback_download_query(context: CallbackContext):
     job_data = context.job.context
     bot, chat_id = context.bot, job_data['chat_id']
@@ -1349,182 +3677,205 @@ def run_traceback_download_query(context: CallbackContext):
     
     output_filename = generate_filename_from_query(base_query)
     unique_results = set()
-    page_count = 0
-    last_page_date = None
-    termination_reason = ""
-    stop_flag = f'stop_job_{chat_id}'
-    last_update_time = 0
+    stop_flag = job_stop_flag(job_data)
+    # 在抓取线程与各处理阶段之间共享的运行状态
+    state = {'page_count': 0, 'termination_reason': "", 'started': time.time(), 'anchor': None}
     
     msg = bot.send_message(chat_id, "⏳ 开始深度追溯下载...")
     
-    # 初始化查询参数
-    current_query = base_query
-    
-    # 确定初始 Key (优先使用传入的 key，否则找一个)
+    # 确定初始 Key (优先使用传入的 key，否则向租约管理器租用一个)
     # 注意：这里我们不再使用 execute_query_with_fallback 的自动轮询，
-    # 而是手动控制，因为我们需要保持时间锚点(last_page_date)的一致性。
-    
-    # 1. 找到一个初始的高级 Key
-    current_key = None
+    # 而是在整个任务期间持有租约，因为我们需要保持时间锚点的一致性。
+    current_key, lease = None, None
     guest_key = job_data.get('guest_key')
     
     if guest_key:
         current_key = guest_key
     else:
-        # 找一个 level >= 1 的 key
-        for k in CONFIG.get('apis', []):
-            if KEY_LEVELS.get(k, 0) >= 1:
-                current_key = k
-                break
+        # 租用一个 level >= 1 的 key
+        lease = KEY_LEASES.acquire(min_level=1, owner=f"traceback#{job_data.get('job_id')}", wait=60)
+        current_key = lease['key'] if lease else None
     
     if not current_key:
-        msg.edit_text("❌ 无法启动：没有找到 VIP 等级以上的 Key (深度追溯需要查询 lastupdatetime)。")
+        OUTBOX.edit_now(msg, "❌ 无法启动：没有找到 VIP 等级以上的 Key (深度追溯需要查询 lastupdatetime)。")
         return
+    state['key'] = current_key
 
     # 锁定一个代理 session
     proxy_session = get_proxies() 
 
-    while True: # 主循环：每一页
-        page_count += 1
-        if context.bot_data.get(stop_flag): 
-            termination_reason = "\n\n🌀 任务已手动停止."
-            break
-
-        # --- API 请求重试与切换 Key 循环 ---
-        data = None
-        error = None
-        
-        while True: # 内循环：当前页的重试/切换Key
-            # 构造请求
-            # 注意：这里我们直接用 fetch_fofa_data，因为我们要手动处理 Key 切换
+    # --- 抓取阶段: API 请求重试与切换 Key ---
+    def fetch_page(request):
+        state['page_count'] += 1
+        while True:
             # 只有 VIP (level>=1) 才能查 lastupdatetime
-            fields = "host,lastupdatetime"
-            
-            # 发起请求
-            data, error = fetch_fofa_data(current_key, current_query, page=1, page_size=10000, fields=fields, proxy_session=proxy_session)
-            
+            KEY_LEASES.renew(lease)
+            data, error = fetch_fofa_data(state['key'], request['query'], page=1, page_size=10000, fields="host,lastupdatetime", proxy_session=proxy_session)
+            track_job(job_data, requests=1, key=state['key'])
             if not error:
-                break # 请求成功，跳出内循环，处理数据
-            
+                return data, None
+
+            # QUOTA_ERROR_CODES: 并发受限 / F点不足 / 每日上限，换 Key 即可继续
             error_str = str(error)
-            
-            # 检查是否是额度耗尽错误
-            # [820041]: 每日请求次数上限
-            # [820031]: F点余额不足
-            # [45022]: 并发或请求限制
-            if "[820041]" in error_str or "[45022]" in error_str:
-                logger.warning(f"Key ...{current_key[-4:]} 额度耗尽 ({error_str})，正在尝试切换...")
-                
-                # 尝试获取下一个 Key
-                next_key = None
-                apis = CONFIG.get('apis', [])
-                if apis and current_key in apis:
-                    curr_idx = apis.index(current_key)
-                    # 轮询找下一个 VIP Key
-                    for i in range(1, len(apis)):
-                        candidate = apis[(curr_idx + i) % len(apis)]
-                        if KEY_LEVELS.get(candidate, 0) >= 1:
-                            next_key = candidate
-                            break
-                
-                if next_key and next_key != current_key:
-                    msg.edit_text(f"⚠️ Key ...{current_key[-4:]} 额度耗尽，自动切换到 ...{next_key[-4:]} 继续追溯...")
-                    current_key = next_key
+            if is_quota_error(error_str):
+                logger.warning(f"Key ...{state['key'][-4:]} 额度耗尽 ({error_str})，正在尝试切换...")
+                next_key = None if guest_key else KEY_LEASES.rotate(lease, error_str)
+                if next_key:
+                    OUTBOX.edit(msg, f"⚠️ Key ...{state['key'][-4:]} 额度耗尽，自动切换到 ...{next_key[-4:]} 继续追溯...")
+                    state['key'] = next_key
                     time.sleep(1) # 稍作停顿
                     continue # 换了 Key，重新请求当前这一页
-                else:
-                    # 没 Key 可换了
-                    termination_reason = f"\n\n❌ 所有可用 Key 额度均已耗尽，任务终止于第 {page_count} 轮。"
-                    break # 跳出内循环，这会导致外层循环也因为 error 存在而退出
-            else:
-                # 其他网络错误，不换 Key，直接报错退出
-                break 
-        
-        # --- 错误处理 ---
-        if error: 
-            if not termination_reason:
-                termination_reason = f"\n\n❌ 第 {page_count} 轮出错: {error}"
-            break
-
-        # --- 数据处理 ---
+                state['termination_reason'] = f"\n\n❌ 所有可用 Key 额度均已耗尽，任务终止于第 {state['page_count']} 轮。"
+                return None, error
+            # 其他网络错误，不换 Key，直接报错退出
+            state['termination_reason'] = f"\n\n❌ 第 {state['page_count']} 轮出错: {error}"
+            return None, error
+
+    # --- 锚点计算: 在抓取线程内完成，下一轮请求可以立刻发出 ---
+    def next_request(request, data):
         results = data.get('results', [])
-        if not results: 
-            termination_reason = "\n\nℹ️ 已获取所有查询结果 (无更多数据)."
-            break
+        if not results:
+            state['termination_reason'] = "\n\nℹ️ 已获取所有查询结果 (无更多数据)."
+            return None
+        anchor = next_traceback_anchor(results, request['anchor'], force_advance=False)
+        if anchor is None:
+            state['termination_reason'] = "\n\n⚠️ 无法找到更早的时间锚点，可能已达查询边界或当日数据量过大无法切分。"
+            return None
+        # 基于 base_query 重新构建，而不是在当前查询上无限叠加
+        return {'query': f'({base_query}) && before="{anchor.strftime("%Y-%m-%d")}"', 'anchor': anchor}
 
-        # 提取 host (results 是 [host, lastupdatetime] 的列表)
-        newly_added = [r[0] for r in results if r and len(r) > 0 and ':' in r[0]]
-        
-        original_count = len(unique_results)
-        unique_results.update(newly_added)
-        newly_added_count = len(unique_results) - original_count
+    # --- 解析阶段: 提取 host (results 是 [host, lastupdatetime] 的列表) ---
+    def parse_stage(data):
+        return [r[0] for r in data.get('results', []) if r and len(r) > 0 and ':' in r[0]]
 
-        # 检查总上限
-        if limit and len(unique_results) >= limit: 
+    # --- 去重阶段 ---
+    def dedup_stage(hosts):
+        nonlocal unique_results
+        original_count = len(unique_results)
+        unique_results.update(hosts)
+        if limit and len(unique_results) >= limit:
             unique_results = set(list(unique_results)[:limit])
-            termination_reason = f"\n\nℹ️ 已达到您设置的 {limit} 条结果上限。"
-            break
-            
-        # 更新 UI
-        current_time = time.time()
-        if current_time - last_update_time > 2:
-            try: 
-                msg.edit_text(f"⏳ 已找到 {len(unique_results)} 条... (第 {page_count} 轮, 新增 {newly_added_count})\n当前时间锚点: {last_page_date or '初始'}")
-            except (BadRequest, RetryAfter, TimedOut): pass
-            last_update_time = current_time
-
-        # --- 时间锚点推移 (Time Slicing) ---
-        valid_anchor_found = False
-        # 倒序遍历结果，寻找最早的时间
-        for i in range(len(results) - 1, -1, -1):
-            if not results[i] or len(results[i]) < 2 or not results[i][1]: continue
-            try:
-                timestamp_str = results[i][1] # "2023-01-01 12:00:00"
-                current_date_obj = datetime.strptime(timestamp_str.split(' ')[0], '%Y-%m-%d').date()
-                
-                # 如果找到的时间比上一轮的还晚(或相等)，说明没往前走，跳过
-                if last_page_date and current_date_obj >= last_page_date: continue
-                
-                next_page_date_obj = current_date_obj
-                
-                # 如果这一页最后一条的时间 == 上一页的时间锚点，强制 -1 天防止死循环
-                if last_page_date and current_date_obj == last_page_date: 
-                    next_page_date_obj -= timedelta(days=1)
-                
-                last_page_date = next_page_date_obj
-                
-                # 更新查询语句：追加 before 参数
-                # 注意：这里要基于 base_query 重新构建，而不是在 current_query 上无限叠加
-                current_query = f'({base_query}) && before="{next_page_date_obj.strftime("%Y-%m-%d")}"'
-                valid_anchor_found = True
-                break
-            except (ValueError, TypeError): continue
-            
-        if not valid_anchor_found: 
-            termination_reason = "\n\n⚠️ 无法找到更早的时间锚点，可能已达查询边界或当日数据量过大无法切分。"
-            break
+            state['termination_reason'] = f"\n\nℹ️ 已达到您设置的 {limit} 条结果上限。"
+            pipeline.stop()
+        track_job(job_data, rows=len(unique_results))
+        return len(unique_results) - original_count
+
+    # --- UI 阶段 ---
+    def report_stage(newly_added_count):
+        OUTBOX.edit(msg, f"⏳ 已找到 {len(unique_results)} 条... (第 {state['page_count']} 轮, 新增 {newly_added_count})\n"
+                         f"已请求: {pipeline.fetch_count} 页 | {format_rate_eta(len(unique_results), limit, state['started'])}")
+
+    pipeline = FetchPipeline(
+        fetch_page, next_request, first_request={'query': base_query, 'anchor': None},
+        stages=[parse_stage, dedup_stage, report_stage],
+        should_stop=lambda: context.bot_data.get(stop_flag), name="traceback_download")
+    try:
+        pipeline.run()
+    finally:
+        KEY_LEASES.release(lease)
+    termination_reason = state['termination_reason']
+    if context.bot_data.get(stop_flag):
+        termination_reason = "\n\n🌀 任务已手动停止."
 
     # --- 结果保存与发送 ---
     if unique_results:
         # 即使报错退出，也保存已下载的数据
-        with open(output_filename, 'w', encoding='utf-8') as f: 
+        cache_path = cache_file_path(output_filename)
+        with open_cache_file(cache_path, 'w') as f: 
             f.write("\n".join(sorted(list(unique_results))))
             
-        msg.edit_text(f"✅ 深度追溯结束！共 {len(unique_results)} 条。{termination_reason}\n正在发送文件...")
+        OUTBOX.edit_now(msg, f"✅ 深度追溯结束！共 {len(unique_results)} 条。{termination_reason}\n正在发送文件...")
         
-        cache_path = os.path.join(FOFA_CACHE_DIR, output_filename)
-        shutil.move(output_filename, cache_path)
         send_file_safely(context, chat_id, cache_path, filename=output_filename)
         upload_and_send_links(context, chat_id, cache_path)
         
-        cache_data = {'file_path': cache_path, 'result_count': len(unique_results)}
+        cache_data = {'file_path': cache_path, 'result_count': len(unique_results), 'high_water': cache_high_water(state['started'])}
         add_or_update_query(base_query, cache_data)
+        archive_results(base_query, unique_results)
         offer_post_download_actions(context, chat_id, base_query)
     else: 
-        msg.edit_text(f"🤷‍♀️ 任务结束，但未能下载到任何数据。{termination_reason}")
+        OUTBOX.edit_now(msg, f"🤷‍♀️ 任务结束，但未能下载到任何数据。{termination_reason}")
         
     context.bot_data.pop(stop_flag, None)
 
+# --- /batch 自定义字段导出 ---
+BATCH_XLSX_MAX_ROWS = 1000000 # Excel 单表行数上限约 104 万，超出改用 CSV
+
+def export_batch_rows(context: CallbackContext, chat_id, msg, query_text, fields_list, rows, note=""):
+    """入库并把自定义字段结果导出为 Excel/CSV 发送。"""
+    archive_results(query_text, rows, fields_list)
+    ext = ".xlsx" if len(rows) <= BATCH_XLSX_MAX_ROWS else ".csv"
+    export_filename = generate_filename_from_query(query_text, prefix="batch", ext=ext)
+    try:
+        df = pd.DataFrame(rows, columns=fields_list)
+        if ext == ".xlsx": df.to_excel(export_filename, index=False, engine='openpyxl')
+        else: df.to_csv(export_filename, index=False, encoding='utf-8-sig')
+        OUTBOX.edit_now(msg, f"✅ 导出完成！共 {len(rows)} 条。{note}\n正在发送文件...")
+        send_file_safely(context, chat_id, export_filename, caption=f"📤 自定义字段导出 ({len(rows)} 条)")
+        upload_and_send_links(context, chat_id, export_filename)
+    except Exception as e:
+        logger.error(f"批量导出失败: {e}", exc_info=True)
+        OUTBOX.edit_now(msg, f"❌ 生成导出文件失败: {e}")
+    finally:
+        if os.path.exists(export_filename): os.remove(export_filename)
+
+def _batch_rows(results):
+    # 只请求一个字段时 FOFA 返回的是字符串列表
+    return [r if isinstance(r, list) else [r] for r in results if r]
+
+def run_batch_download_query(context: CallbackContext):
+    job_data = context.job.context; bot, chat_id, query_text = context.bot, job_data['chat_id'], job_data['query']
+    fields_str = job_data['fields']; fields_list = fields_str.split(',')
+    msg = bot.send_message(chat_id, "⏳ 开始自定义字段导出 (前1万条)...")
+    guest_key = job_data.get('guest_key')
+    if guest_key:
+        data, error = fetch_fofa_data(guest_key, query_text, 1, 10000, fields_str); used_key = guest_key
+    else:
+        data, used_key, _, _, _, error = execute_query_with_fallback(
+            lambda key, key_level, proxy_session: fetch_fofa_data(key, query_text, 1, 10000, fields_str, proxy_session=proxy_session)
+        )
+    track_job(job_data, requests=1, key=used_key)
+    if error: OUTBOX.edit_now(msg, f"❌ 导出出错: {error}"); return
+    rows = _batch_rows(data.get('results', []))
+    track_job(job_data, rows=len(rows))
+    if not rows: OUTBOX.edit_now(msg, "🤷‍♀️ 任务完成，但未能获取到任何数据。"); return
+    export_batch_rows(context, chat_id, msg, query_text, fields_list, rows)
+
+def run_batch_traceback_query(context: CallbackContext):
+    job_data = context.job.context; bot, chat_id, query_text = context.bot, job_data['chat_id'], job_data['query']
+    fields_list = job_data['fields'].split(','); limit = job_data.get('limit')
+    stop_flag = job_stop_flag(job_data)
+    msg = bot.send_message(chat_id, "⏳ 开始深度追溯导出...")
+    lease = KEY_LEASES.acquire(min_level=1, owner=f"batch_traceback#{job_data.get('job_id')}", wait=60)
+    if not lease:
+        OUTBOX.edit_now(msg, "❌ 无法启动：没有找到 VIP 等级以上的 Key (深度追溯需要查询 lastupdatetime)。")
+        return
+    # 追溯需要 lastupdatetime 作为锚点，始终追加在最后一列；用户没选它时导出前去掉
+    keep_anchor = 'lastupdatetime' in fields_list
+    out_fields = [f for f in fields_list if f != 'lastupdatetime'] + (['lastupdatetime'] if keep_anchor else [])
+    host_idx = out_fields.index('host') if 'host' in out_fields else None
+    seen, rows, note, start_time, rounds = set(), [], "", time.time(), 0
+    try:
+        for results in iter_fofa_traceback(lease['key'], query_text, limit=limit, proxy_session=get_proxies(), lease=lease, fields=",".join(fields_list)):
+            rounds += 1
+            track_job(job_data, requests=1, key=lease['key'])
+            if context.bot_data.get(stop_flag): note = "\n🌀 任务已手动停止。"; break
+            for r in results:
+                row = r if keep_anchor else r[:-1]
+                key = row[host_idx] if host_idx is not None else tuple(row)
+                if key in seen: continue
+                seen.add(key); rows.append(row)
+            track_job(job_data, rows=len(rows))
+            OUTBOX.edit(msg, f"⏳ 已找到 {len(rows)} 条... (第 {rounds} 轮)\n{format_rate_eta(len(rows), limit, start_time)}")
+            if limit and len(rows) >= limit: rows = rows[:limit]; note = f"\nℹ️ 已达到 {limit} 条上限。"; break
+    except Exception as e:
+        logger.error(f"批量追溯导出出错: {e}", exc_info=True); note = f"\n❌ 追溯中断: {e}"
+    finally:
+        KEY_LEASES.release(lease)
+        context.bot_data.pop(stop_flag, None)
+    if not rows: OUTBOX.edit_now(msg, f"🤷‍♀️ 任务结束，但未能获取到任何数据。{note}"); return
+    export_batch_rows(context, chat_id, msg, query_text, out_fields, rows, note)
+
 # --- 监控系统 (Data Reservoir + Radar Mode) ---
 @admin_only
 def monitor_command(update: Update, context: CallbackContext):
@@ -1535,7 +3886,10 @@ def monitor_command(update: Update, context: CallbackContext):
             "`/monitor add <query>` \\- 添加新的监控任务\n"
             "`/monitor list` \\- 查看当前运行的任务\n"
             "`/monitor get <id>` \\- 打包提取任务数据\n"
-            "`/monitor del <id>` \\- 删除监控任务\n\n"
+            "`/monitor get <id> since <7d|last>` \\- 只提取之后新增的数据\n"
+            "`/monitor del <id>` \\- 删除监控任务\n"
+            "`/monitor priority <id> <1\\-5>` \\- 调整调度优先级\n"
+            "`/monitor watch <id> <title,cert\\.\\.\\.|off>` \\- 关注字段变化\n\n"
             "_监控任务会将新数据自动沉淀到本地数据库，您随时可以提取。_"
         )
         update.message.reply_text(help_txt, parse_mode=ParseMode.MARKDOWN_V2)
@@ -1567,17 +3921,16 @@ def monitor_command(update: Update, context: CallbackContext):
             "unnotified_count": 0, # 新增：未通知计数器
             "notification_threshold": 5000 # 新增：通知阈值
         }
+        # 立即到期，由全局调度器在下一次 tick 放行
+        schedule_monitor_run(task_id, 0)
         save_monitor_tasks()
-        
-        # 立即启动第一次调度 (Use Jitter 0 for first run)
-        context.job_queue.run_once(run_monitor_execution_job, 1, context={"task_id": task_id}, name=f"monitor_{task_id}")
         update.message.reply_text(f"✅ 监控雷达已启动\nID: `{task_id}`\n查询: `{escape_markdown_v2(query_text)}`\n\n数据将自动沉淀，使用 `/monitor get {task_id}` 提取。", parse_mode=ParseMode.MARKDOWN_V2)
 
     elif sub_cmd == 'list':
         if not MONITOR_TASKS:
             update.message.reply_text("📭 当前没有活跃的监控任务。")
             return
-        msg = ["*📡 活跃监控任务*"]
+        msg = ["*📡 活跃监控任务*", f"_{escape_markdown_v2(MONITOR_SCHEDULER.summary())}_", ""]
         for tid, task in MONITOR_TASKS.items():
             if task.get('status') != 'active': continue
             
@@ -1585,8 +3938,7 @@ def monitor_command(update: Update, context: CallbackContext):
             data_file = os.path.join(MONITOR_DATA_DIR, f"{tid}.txt")
             count = 0
             if os.path.exists(data_file):
-                try: 
-                    with open(data_file, 'r', encoding='utf-8') as f: count = sum(1 for _ in f)
+                try: count = count_lines(data_file)
                 except: pass
                 
             last_run_str = "等待中"
@@ -1605,18 +3957,47 @@ def monitor_command(update: Update, context: CallbackContext):
             
         update.message.reply_text("\n".join(msg), parse_mode=ParseMode.MARKDOWN_V2)
 
+    elif sub_cmd == 'priority':
+        if len(args) < 3 or args[1] not in MONITOR_TASKS or not args[2].isdigit() or not 1 <= int(args[2]) <= 5:
+            update.message.reply_text("用法: /monitor priority <task_id> <1-5>  (数字越大越优先获得预算)")
+            return
+        MONITOR_TASKS[args[1]]['priority'] = int(args[2])
+        save_monitor_task(args[1])
+        update.message.reply_text(f"✅ 任务 {args[1]} 的优先级已设为 {args[2]}。")
+
+    elif sub_cmd == 'watch':
+        if len(args) < 3 or args[1] not in MONITOR_TASKS:
+            update.message.reply_text("用法: /monitor watch <task_id> <字段1,字段2|off>\n例如: /monitor watch ab12cd34 title,cert,server")
+            return
+        tid, spec = args[1], args[2].lower()
+        if spec == 'off':
+            MONITOR_TASKS[tid].pop('watch_fields', None)
+            try: MONITOR_FINGERPRINTS.drop(tid)
+            except Exception as e: logger.error(f"清理监控字段指纹失败: {e}")
+            save_monitor_task(tid)
+            update.message.reply_text(f"✅ 任务 {tid} 已关闭字段变更检测。")
+            return
+        fields = list(dict.fromkeys(f.strip() for f in spec.split(',') if f.strip()))
+        available = get_fields_by_level(max(KEY_LEVELS.values(), default=0))
+        invalid = [f for f in fields if f not in available or f in ('host', 'lastupdatetime')]
+        if not fields or invalid:
+            update.message.reply_text(f"❌ 不可关注的字段: {', '.join(invalid) or '(空)'}\n当前 Key 可用: {', '.join(f for f in available if f not in ('host', 'lastupdatetime'))}")
+            return
+        MONITOR_TASKS[tid]['watch_fields'] = fields
+        save_monitor_task(tid)
+        update.message.reply_text(f"✅ 任务 {tid} 将关注字段变化: {', '.join(fields)}\n下一轮建立基线，之后有新增/变化/消失时发送事件报告。")
+
     elif sub_cmd == 'del':
         if len(args) < 2: 
             update.message.reply_text("用法: `/monitor del <task_id>`")
             return
         tid = args[1]
         if tid in MONITOR_TASKS:
-            # 取消现有 Job
-            for job in context.job_queue.get_jobs_by_name(f"monitor_{tid}"):
-                job.schedule_removal()
-                
+            # 从 MONITOR_TASKS 移除后调度器不会再放行该任务
             del MONITOR_TASKS[tid]
             save_monitor_tasks()
+            try: MONITOR_FINGERPRINTS.drop(tid)
+            except Exception as e: logger.error(f"清理监控字段指纹失败: {e}")
             
             # 删除数据文件? (保留数据更安全，只删任务)
             update.message.reply_text(f"🗑️ 任务 `{tid}` 已停止并移除配置。", parse_mode=ParseMode.MARKDOWN_V2)
@@ -1624,8 +4005,8 @@ def monitor_command(update: Update, context: CallbackContext):
             update.message.reply_text("❌ 任务ID不存在。")
 
     elif sub_cmd == 'get':
-        if len(args) < 2:
-            update.message.reply_text("用法: `/monitor get <task_id>`") 
+        if len(args) < 2 or (len(args) > 2 and (args[2].lower() != 'since' or len(args) < 4)):
+            update.message.reply_text("用法: /monitor get <task_id> [since <30m|12h|7d|2026-01-01 [12:00]|last>]") 
             return
         tid = args[1]
         
@@ -1640,13 +4021,474 @@ def monitor_command(update: Update, context: CallbackContext):
             
         task_info = MONITOR_TASKS.get(tid, {})
         q_info = task_info.get('query', '未知查询')
+        data_end = monitor_data_end(data_file)
         
-        send_file_safely(context, update.effective_chat.id, data_file, caption=f"📦 监控数据导出\nID: `{tid}`\nQuery: `{escape_markdown_v2(q_info)}`", parse_mode=ParseMode.MARKDOWN_V2)
-        upload_and_send_links(context, update.effective_chat.id, data_file)
+        if len(args) > 2:
+            # 只导出指定时间之后新增的分段，压缩后发送
+            spec = " ".join(args[3:])
+            if spec.lower() == 'last':
+                start, since_label = min(task_info.get('last_export_offset', 0), data_end), "上次导出"
+            else:
+                since_ts = parse_since_arg(spec)
+                if since_ts is None:
+                    update.message.reply_text("❌ 无法识别的时间，支持 30m / 12h / 7d / 2026-01-01 [12:00] / last")
+                    return
+                start, since_label = monitor_offset_since(data_file, since_ts), datetime.fromtimestamp(since_ts).strftime('%Y-%m-%d %H:%M')
+            if start >= data_end:
+                update.message.reply_text(f"🤷‍♀️ {since_label} 之后没有新数据。")
+                return
+            os.makedirs(FOFA_CACHE_DIR, exist_ok=True)
+            delta_path = os.path.join(FOFA_CACHE_DIR, f"monitor_{tid}_delta_{int(time.time())}.txt.gz")
+            try:
+                rows = export_monitor_delta(data_file, start, data_end, delta_path)
+                send_file_safely(context, update.effective_chat.id, delta_path, caption=f"📦 监控增量导出\nID: `{tid}`\n自 {escape_markdown_v2(since_label)} 起新增 *{rows}* 条\nQuery: `{escape_markdown_v2(q_info)}`", parse_mode=ParseMode.MARKDOWN_V2)
+            finally:
+                if os.path.exists(delta_path): os.remove(delta_path)
+        else:
+            send_file_safely(context, update.effective_chat.id, data_file, caption=f"📦 监控数据导出\nID: `{tid}`\nQuery: `{escape_markdown_v2(q_info)}`", parse_mode=ParseMode.MARKDOWN_V2)
+            upload_and_send_links(context, update.effective_chat.id, data_file)
+        if tid in MONITOR_TASKS:
+            MONITOR_TASKS[tid]['last_export_offset'] = data_end
+            save_monitor_task(tid)
         
     else:
         update.message.reply_text("❌ 未知命令。请使用 `/monitor` 查看帮助。")
 
+# --- 监控全局调度 ---
+# 监控任务不再各自 run_once，而是记录 next_due，由每分钟一次的 tick 统一准入:
+# - 每日请求/数据预算 (config: monitor_daily_requests / monitor_daily_data) 按当天剩余时间匀速发放为令牌，避免集中消耗
+# - 到期任务按 优先级 × 产出率 (每次请求新增资产数的 EWMA) × 逾期程度 排序，令牌够用才放行
+# - 放行的任务作为一批交给 JOB_SCHEDULER 的 monitor 通道，受并发上限约束并通过 Key 池并行执行
+MONITOR_TICK_SECONDS = 60
+DEFAULT_MONITOR_DAILY_REQUESTS = 2000
+DEFAULT_MONITOR_DAILY_DATA = 0 # 0 表示不限制数据条数
+MONITOR_YIELD_ALPHA = 0.3
+
+class MonitorScheduler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = set()
+        self.tokens = 0.0
+        self.usage = self._load_usage()
+
+    def _load_usage(self):
+        try: usage = json.loads(STATE.get_meta('monitor_budget', '{}') or '{}')
+        except ValueError: usage = {}
+        return usage if usage.get('day') == self._today() else {'day': self._today(), 'requests': 0, 'data': 0, 'runs': 0}
+
+    @staticmethod
+    def _today():
+        return datetime.now().strftime('%Y-%m-%d')
+
+    def budget(self):
+        return (int(CONFIG.get('monitor_daily_requests', DEFAULT_MONITOR_DAILY_REQUESTS)),
+                int(CONFIG.get('monitor_daily_data', DEFAULT_MONITOR_DAILY_DATA)))
+
+    def _roll_day(self):
+        if self.usage.get('day') != self._today():
+            self.usage = {'day': self._today(), 'requests': 0, 'data': 0, 'runs': 0}
+            self.tokens = 0.0
+
+    def _refill(self):
+        """把今天剩余的请求预算按剩余秒数匀速折算成本轮令牌。"""
+        max_requests, max_data = self.budget()
+        remaining = max_requests - self.usage['requests']
+        if max_data and self.usage['data'] >= max_data: remaining = 0
+        if remaining <= 0: self.tokens = min(self.tokens, 0.0); return
+        now = datetime.now()
+        seconds_left = max(MONITOR_TICK_SECONDS, (now.replace(hour=23, minute=59, second=59) - now).total_seconds())
+        self.tokens = min(self._cap(), remaining, self.tokens + remaining * MONITOR_TICK_SECONDS / seconds_left)
+
+    @staticmethod
+    def _cap():
+        return max(2.0, JOB_SCHEDULER.limit('monitor') * 2.0)
+
+    @staticmethod
+    def _score(task, now):
+        interval = max(60, task.get('interval', 3600))
+        overdue = max(0, now - task.get('next_due', now)) / interval
+        return int(task.get('priority', 1)) * (task.get('yield_ewma', 1.0) + 0.1) * (1 + overdue)
+
+    def tick(self, job_queue):
+        now = time.time()
+        with self.lock:
+            self._roll_day()
+            self._refill()
+            due = [(tid, t) for tid, t in list(MONITOR_TASKS.items())
+                   if t.get('status') == 'active' and t.get('next_due', 0) <= now and tid not in self.inflight]
+            admitted = []
+            for tid, task in sorted(due, key=lambda item: self._score(item[1], now), reverse=True):
+                cost = min(self._cap(), max(1.0, task.get('requests_ewma', 1.0))) # 大任务也终能攒够令牌
+                if self.tokens < cost: break
+                self.tokens -= cost
+                self.inflight.add(tid); admitted.append((tid, task))
+        for tid, task in admitted:
+            JOB_SCHEDULER.submit(job_queue, 'monitor', self._run, {"task_id": tid}, chat_id=task.get('chat_id'),
+                                 name=f"monitor_run_{tid}", on_cancel=lambda tid=tid: self._release(tid))
+        if due and len(admitted) < len(due):
+            logger.debug(f"监控调度: {len(due)} 个到期，放行 {len(admitted)} 个，令牌 {self.tokens:.1f}")
+
+    def _release(self, task_id):
+        with self.lock: self.inflight.discard(task_id)
+
+    def _run(self, context: CallbackContext):
+        task_id = context.job.context.get('task_id')
+        try:
+            run_monitor_execution_job(context)
+        finally:
+            self._release(task_id)
+
+    def record(self, task_id, requests, rows, new_count):
+        """一轮监控结束后记账并更新任务的产出率。"""
+        with self.lock:
+            self._roll_day()
+            self.usage['requests'] += requests; self.usage['data'] += rows; self.usage['runs'] += 1
+            STATE.set_meta('monitor_budget', json.dumps(self.usage))
+        task = MONITOR_TASKS.get(task_id)
+        if not task: return
+        per_request = new_count / max(1, requests)
+        task['yield_ewma'] = round(MONITOR_YIELD_ALPHA * per_request + (1 - MONITOR_YIELD_ALPHA) * task.get('yield_ewma', per_request), 3)
+        task['requests_ewma'] = round(MONITOR_YIELD_ALPHA * requests + (1 - MONITOR_YIELD_ALPHA) * task.get('requests_ewma', requests), 3)
+
+    def summary(self):
+        max_requests, max_data = self.budget()
+        with self.lock:
+            self._roll_day()
+            data_str = f"{self.usage['data']}/{max_data}" if max_data else f"{self.usage['data']}"
+            return f"今日 {self.usage['runs']} 轮，请求 {self.usage['requests']}/{max_requests}，数据 {data_str}"
+
+if not SCAN_WORKER: MONITOR_SCHEDULER = MonitorScheduler()
+
+def monitor_tick_job(context: CallbackContext):
+    try:
+        MONITOR_SCHEDULER.tick(context.job_queue)
+    except Exception as e:
+        logger.error(f"监控调度出错: {e}", exc_info=True)
+
+def schedule_monitor_run(task_id, delay):
+    """设置监控任务的下次到期时间，实际何时执行由 MONITOR_SCHEDULER 按预算决定。"""
+    task = MONITOR_TASKS.get(task_id)
+    if task: task['next_due'] = int(time.time() + delay)
+
+# --- 监控数据时间分段 ---
+# <id>.txt 仍是只追加的完整数据 (去重索引和行索引都建立在它上面)，旁路清单 <id>.txt.seg 每行记录一轮
+# 追加的字节区间和时间: {"first": ts, "last": ts, "start": 字节, "end": 字节, "rows": n}。
+# 每行数据的首次发现时间即所在分段的时间；超过一天的分段按自然日合并，清单保持很小。
+# 按时间导出时只需从对应分段的起始偏移顺序读到文件末尾。
+MONITOR_SEGMENT_SUFFIX = '.seg'
+MONITOR_SEGMENT_COMPACT_AFTER = 200
+
+def load_monitor_segments(db_file, size=None, gap_ts=None):
+    path = db_file + MONITOR_SEGMENT_SUFFIX
+    segments = []
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try: segments.append(json.loads(line))
+                except ValueError: continue
+    if size is None: size = os.path.getsize(db_file) if os.path.exists(db_file) else 0
+    covered = segments[-1]['end'] if segments else 0
+    if size > covered:
+        # 没有清单的旧数据 (或清单落后于数据) 作为一个分段补上，默认取文件修改时间，宁可多发不漏发
+        ts = int(os.path.getmtime(db_file)) if gap_ts is None else gap_ts
+        segments.append({'first': ts, 'last': ts, 'start': covered, 'end': size, 'rows': None})
+    return segments
+
+def _write_monitor_segments(db_file, segments):
+    path = db_file + MONITOR_SEGMENT_SUFFIX
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(seg) + "\n" for seg in segments)
+    os.replace(path + '.tmp', path)
+
+def compact_monitor_segments(segments, now=None):
+    """把一天前的分段按自然日合并，最近一天保留逐轮粒度。"""
+    cutoff = (now or time.time()) - 86400
+    compacted = []
+    for seg in segments:
+        prev = compacted[-1] if compacted else None
+        same_day = prev and datetime.fromtimestamp(prev['first']).date() == datetime.fromtimestamp(seg['first']).date()
+        if prev and same_day and seg['last'] < cutoff and prev['end'] == seg['start']:
+            prev.update(last=seg['last'], end=seg['end'],
+                        rows=None if prev['rows'] is None or seg['rows'] is None else prev['rows'] + seg['rows'])
+        else:
+            compacted.append(dict(seg))
+    return compacted
+
+def append_monitor_segment(db_file, start, end, rows, ts=None):
+    """记录一轮追加的数据区间 [start, end)，清单较小，每次整体原子重写。"""
+    ts = int(ts or time.time())
+    # 此时文件已被追加，修改时间不再可用: 启用分段前的旧数据记为最早，清单中断留下的空档记为本轮
+    gap_ts = ts if os.path.exists(db_file + MONITOR_SEGMENT_SUFFIX) else 0
+    segments = load_monitor_segments(db_file, size=start, gap_ts=gap_ts)
+    segments.append({'first': ts, 'last': ts, 'start': start, 'end': end, 'rows': rows})
+    if len(segments) > MONITOR_SEGMENT_COMPACT_AFTER: segments = compact_monitor_segments(segments)
+    _write_monitor_segments(db_file, segments)
+
+def monitor_offset_since(db_file, since_ts):
+    """返回首个包含 since_ts 之后数据的分段起始偏移，没有则返回文件末尾。"""
+    segments = load_monitor_segments(db_file)
+    for seg in segments:
+        if seg['last'] >= since_ts: return seg['start']
+    return segments[-1]['end'] if segments else 0
+
+def monitor_data_end(db_file):
+    """数据文件当前的末尾偏移，回退到最后一个换行之后，正在追加的半行留给下次。"""
+    with open(db_file, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            step = min(65536, end)
+            f.seek(end - step)
+            chunk = f.read(step)
+            newline = chunk.rfind(b'\n')
+            if newline != -1: return end - step + newline + 1
+            end -= step
+    return 0
+
+def export_monitor_delta(db_file, start, end, out_path):
+    """把 [start, end) 之间的数据流式写成压缩文件，返回行数。end 之后并发追加的数据留给下次导出。"""
+    rows = 0
+    with open(db_file, 'rb') as src, open_cache_file(out_path, 'wb') as dst:
+        src.seek(start)
+        while start < end:
+            chunk = src.read(min(1024 * 1024, end - start))
+            if not chunk: break
+            start += len(chunk)
+            rows += chunk.count(b'\n')
+            dst.write(chunk)
+    return rows
+
+def parse_since_arg(text):
+    """解析 30m / 12h / 7d 或 2026-01-01 [12:00]，返回时间戳。"""
+    text = text.strip()
+    m = re.match(r'^(\d+)([mhd])$', text.lower())
+    if m: return time.time() - int(m.group(1)) * _SINCE_UNITS[m.group(2)]
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try: return datetime.strptime(text, fmt).timestamp()
+        except ValueError: continue
+    return None
+
+# --- 监控库去重索引 ---
+# 每个监控任务的 <id>.txt 旁有一个 <id>.txt.hidx: 头部 + 升序排列的 64 位 host 哈希，mmap 后二分查找。
+# 索引只覆盖数据文件的前 covered 字节，之后追加的行 (本轮及未合并的历史增量) 放在内存 delta 集合里，
+# 增量超过阈值时归并重写一次，每轮去重的成本与增量而非库存总量成正比。
+MONITOR_INDEX_SUFFIX = '.hidx'
+MONITOR_INDEX_DELTA_MIN = 20000
+_MONITOR_INDEX_MAGIC = 0x31584448 # "HDX1"
+
+def normalize_monitor_host(host):
+    """去重用的 host 规范形式: 小写、去掉 http:// 前缀、默认端口和结尾的 /。"""
+    host = host.strip().lower().rstrip('/')
+    if host.startswith('http://'): host = host[7:]
+    if host.endswith(':80') and '://' not in host: host = host[:-3]
+    elif host.startswith('https://') and host.endswith(':443'): host = host[:-4]
+    return host
+
+def _monitor_host_hash(host):
+    return int.from_bytes(hashlib.blake2b(normalize_monitor_host(host).encode('utf-8'), digest_size=8).digest(), 'little')
+
+class MonitorHashIndex:
+    HEADER = struct.Struct('=3Q') # magic, covered_bytes, count
+
+    def __init__(self, db_file):
+        self.db_file, self.path = db_file, db_file + MONITOR_INDEX_SUFFIX
+        self.covered, self.scanned, self.delta = 0, 0, set()
+        self._fh = self._mm = self._view = None
+        self._load()
+        self._catch_up()
+
+    def _load(self):
+        if not os.path.exists(self.path): return
+        db_size = os.path.getsize(self.db_file) if os.path.exists(self.db_file) else 0
+        try:
+            self._fh = open(self.path, 'rb')
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, covered, count = self.HEADER.unpack_from(self._mm, 0)
+            if magic != _MONITOR_INDEX_MAGIC or covered > db_size or len(self._mm) != self.HEADER.size + count * 8:
+                raise ValueError("索引与数据文件不一致")
+            self._view = memoryview(self._mm)[self.HEADER.size:].cast('Q')
+            self.covered = self.scanned = covered
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"监控索引 {self.path} 无效，将重建: {e}")
+            self._release(); self.covered = self.scanned = 0
+
+    def _catch_up(self):
+        """把索引之后追加的完整行计入 delta。"""
+        if not os.path.exists(self.db_file): return
+        with open(self.db_file, 'rb') as f:
+            f.seek(self.scanned)
+            for line in f:
+                if not line.endswith(b'\n'): break
+                self.scanned += len(line)
+                host = line.decode('utf-8', errors='ignore').strip()
+                if host: self.delta.add(_monitor_host_hash(host))
+
+    def __len__(self):
+        return (len(self._view) if self._view is not None else 0) + len(self.delta)
+
+    def __contains__(self, h):
+        if h in self.delta: return True
+        view = self._view
+        if view is None: return False
+        i = bisect.bisect_left(view, h)
+        return i < len(view) and view[i] == h
+
+    def add(self, host):
+        """未见过的 host 返回 True 并记入 delta，否则返回 False。"""
+        h = _monitor_host_hash(host)
+        if h in self: return False
+        self.delta.add(h); return True
+
+    def _release(self):
+        if self._view is not None: self._view.release(); self._view = None
+        if self._mm is not None: self._mm.close(); self._mm = None
+        if self._fh is not None: self._fh.close(); self._fh = None
+
+    def close(self):
+        """调用方追加完数据文件后调用，增量足够大时归并进有序索引。"""
+        self._catch_up()
+        base = len(self._view) if self._view is not None else 0
+        if self.delta and (self._view is None or len(self.delta) >= max(MONITOR_INDEX_DELTA_MIN, base // 8)):
+            merged = array('Q', self._view if self._view is not None else [])
+            merged.extend(self.delta)
+            merged = array('Q', sorted(set(merged)))
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.HEADER.pack(_MONITOR_INDEX_MAGIC, self.scanned, len(merged)))
+                f.write(merged.tobytes())
+            self._release()
+            os.replace(tmp_path, self.path)
+            self.covered, self.delta = self.scanned, set()
+        self._release()
+
+# --- 监控字段变更检测 ---
+# 任务设置了 watch_fields 时，每个 host 在 fingerprints.db 中保存一行: 每个关注字段一个 4 字节哈希拼成的定长摘要
+# 和最近出现时间。每轮只按本批 host 查询和更新 (主键查找)，比较摘要即可得出字段变化，不保存历史版本；
+# 消失只在覆盖了完整结果集的轮次判定 (增量和截断的最新一页不会再返回没变化的 host)：
+# 超过 monitor_gone_days (默认 30 天) 没有在完整轮次中出现的 host 记为消失并移出表。
+MONITOR_FP_DB_FILE = os.path.join(MONITOR_DATA_DIR, 'fingerprints.db')
+MONITOR_FIELD_HASH_BYTES = 4
+DEFAULT_MONITOR_GONE_DAYS = 30
+
+def _field_digest(values):
+    return b''.join(hashlib.blake2b((v or '').strip().encode('utf-8'), digest_size=MONITOR_FIELD_HASH_BYTES).digest() for v in values)
+
+def _signed64(h):
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+class MonitorFingerprints:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS fingerprints (task_id TEXT NOT NULL, host_hash INTEGER NOT NULL, host TEXT NOT NULL, "
+                              "digest BLOB NOT NULL, last_seen INTEGER NOT NULL, PRIMARY KEY (task_id, host_hash)) WITHOUT ROWID")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_fp_seen ON fingerprints (task_id, last_seen)")
+        return self.conn
+
+    def diff(self, task_id, fields, rows, now=None, gone_after=None, full=False):
+        """
+        rows 为 [host, *fields 对应的值]。返回 (changed, gone):
+        changed = [(host, 变化的字段列表, 当前值列表)]，gone = [host]。首次出现的 host 只建立基线。
+        只有 full (rows 是完整结果集) 时才判定消失，否则 gone 恒为空。
+        """
+        now = int(now or time.time())
+        batch = {}
+        for row in rows:
+            values = [str(v) if v is not None else '' for v in row[1:1 + len(fields)]]
+            values += [''] * (len(fields) - len(values))
+            batch[_signed64(_monitor_host_hash(row[0]))] = (row[0], _field_digest(values), values)
+        changed, width = [], MONITOR_FIELD_HASH_BYTES
+        with self.lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                keys = list(batch)
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    marks = ",".join("?" * len(chunk))
+                    for host_hash, digest in conn.execute(f"SELECT host_hash, digest FROM fingerprints WHERE task_id=? AND host_hash IN ({marks})", (task_id, *chunk)):
+                        host, new_digest, values = batch[host_hash]
+                        # 关注字段列表变化后摘要长度不同，只重建基线
+                        if len(digest) != len(new_digest) or digest == new_digest: continue
+                        diff_fields = [f for j, f in enumerate(fields) if digest[j * width:(j + 1) * width] != new_digest[j * width:(j + 1) * width]]
+                        changed.append((host, diff_fields, values))
+                conn.executemany(
+                    "INSERT INTO fingerprints (task_id, host_hash, host, digest, last_seen) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(task_id, host_hash) DO UPDATE SET digest=excluded.digest, last_seen=excluded.last_seen",
+                    [(task_id, h, host, digest, now) for h, (host, digest, _) in batch.items()])
+                gone = []
+                if full:
+                    cutoff = now - int(gone_after if gone_after is not None else DEFAULT_MONITOR_GONE_DAYS * 86400)
+                    gone = [host for (host,) in conn.execute("SELECT host FROM fingerprints WHERE task_id=? AND last_seen < ?", (task_id, cutoff))]
+                    if gone: conn.execute("DELETE FROM fingerprints WHERE task_id=? AND last_seen < ?", (task_id, cutoff))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK"); raise
+        return changed, gone
+
+    def drop(self, task_id):
+        if not os.path.exists(self.path): return
+        with self.lock:
+            self._connect().execute("DELETE FROM fingerprints WHERE task_id=?", (task_id,))
+
+MONITOR_FINGERPRINTS = MonitorFingerprints(MONITOR_FP_DB_FILE)
+
+def write_monitor_events(path, fields, new_rows, changed, gone):
+    """把本轮事件写成 TSV: event, host, changed_fields, 各关注字段的当前值。"""
+    clean = lambda v: str(v or '').replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\t".join(['event', 'host', 'changed_fields'] + list(fields)) + "\n")
+        for row in new_rows:
+            f.write("\t".join(['new', clean(row[0]), ''] + [clean(v) for v in row[1:1 + len(fields)]]) + "\n")
+        for host, diff_fields, values in changed:
+            f.write("\t".join(['changed', clean(host), ",".join(diff_fields)] + [clean(v) for v in values]) + "\n")
+        for host in gone:
+            f.write("\t".join(['gone', clean(host), ''] + [''] * len(fields)) + "\n")
+
+MONITOR_DELTA_MAX_ROWS = 200000 # 单轮增量上限，超出的部分下一轮从已覆盖到的日期继续
+
+def collect_monitor_results(task_id, task):
+    """
+    执行一轮监控收集，返回 (rows, 请求次数, error, full)，rows 为 [host, *watch_fields 的值]。
+    full 表示 rows 是查询的完整结果集 (最新一页已包含全部结果)；增量只返回有更新的 host，恒为 False。
+    task['high_water'] 记录已完整收集到的 lastupdatetime 日期，每轮推进到增量实际覆盖到的日期。
+    """
+    query_text = task['query']
+    watch = list(task.get('watch_fields') or [])
+    width = 1 + len(watch)
+    has_vip = any(level >= 1 for level in KEY_LEVELS.values())
+    high_water = task.get('high_water')
+    if has_vip and high_water:
+        with KEY_LEASES.lease(min_level=1, owner=f"monitor#{task_id}", wait=30) as lease:
+            if lease:
+                since = datetime.strptime(high_water, '%Y-%m-%d').date()
+                rows, covered, complete, error, requests_used = fetch_fofa_delta(lease, query_text, since, fields=",".join(['host'] + watch), max_rows=MONITOR_DELTA_MAX_ROWS)
+                if error and not rows: return [], requests_used, error, False
+                if covered and covered > since: task['high_water'] = covered.isoformat()
+                if not complete: logger.info(f"监控 {task_id} 本轮增量未完整覆盖 ({len(rows)} 条)，高水位推进到 {task['high_water']}")
+                return [list(row[:width]) for row in rows if row and row[0]], requests_used, None, False
+    # 首轮 (建立高水位) 或没有会员 Key: 取最新一页
+    fields = ",".join(['host'] + watch + (['lastupdatetime'] if has_vip else []))
+    attempts = [0]
+    def fetch_func(k, kl, ps):
+        attempts[0] += 1 # 回退过程中换 Key 重试的每一次都计入预算
+        return fetch_fofa_data(k, query_text, page=1, page_size=5000, fields=fields, proxy_session=ps)
+    data, _, _, _, _, error = execute_query_with_fallback(fetch_func, min_level=1 if has_vip else 0)
+    requests_used = max(1, attempts[0])
+    if error or not data: return [], requests_used, error, False
+    rows = [row if isinstance(row, list) else [row] for row in (data.get('results') or [])]
+    if has_vip:
+        newest = max_update_date(rows)
+        if newest and not high_water: task['high_water'] = newest.isoformat()
+    full = int(data.get('size') or 0) <= len(rows)
+    return [list(row[:width]) for row in rows if row and row[0]], requests_used, None, full
+
 def run_monitor_execution_job(context: CallbackContext):
     """自适应监控雷达核心逻辑 (v2)"""
     job_context = context.job.context
@@ -1659,32 +4501,51 @@ def run_monitor_execution_job(context: CallbackContext):
     os.makedirs(MONITOR_DATA_DIR, exist_ok=True)
     db_file = os.path.join(MONITOR_DATA_DIR, f"{task_id}.txt")
     
-    # 1. 载入本地数据库哈希
-    known_hashes = set()
-    if os.path.exists(db_file):
-        try:
-            with open(db_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line: known_hashes.add(hashlib.md5(line.encode()).hexdigest())
-        except Exception as e:
-            logger.error(f"读取监控数据库失败: {e}")
+    # 1. 打开持久化去重索引 (mmap + 增量)，不再每轮重新哈希整个库
+    try:
+        known_hosts = MonitorHashIndex(db_file)
+    except Exception as e:
+        logger.error(f"读取监控数据库失败: {e}")
+        known_hosts = None
 
-    # 2. 执行数据收集 (由“探测”改为“收集”)
-    fetch_func = lambda k, kl, ps: fetch_fofa_data(k, query_text, page=1, page_size=5000, fields="host", proxy_session=ps)
-    data, _, _, _, _, error = execute_query_with_fallback(fetch_func)
+    # 2. 执行数据收集: 有高水位且有会员 Key 时只拉取增量，否则退回到取最新 5000 条
+    results, requests_used, error, full = collect_monitor_results(task_id, task)
     
-    new_data_lines = []
-    if not error and data and data.get('results'):
-        results = data.get('results')
-        for item in results:
-            line_str = item[0] if isinstance(item, list) else str(item)
-            line_str = line_str.strip()
+    watch = list(task.get('watch_fields') or [])
+    new_data_lines, new_rows = [], []
+    if not error and results and known_hosts is not None:
+        for row in results:
+            line_str = str(row[0]).strip()
             if not line_str: continue
-            h = hashlib.md5(line_str.encode()).hexdigest()
-            if h not in known_hashes:
+            if known_hosts.add(line_str): # 同时防止单次查询内重复
                 new_data_lines.append(line_str)
-                known_hashes.add(h) # 在会话中也添加，防止单次查询内重复
+                new_rows.append(row)
+        # 本轮看到的全部 host 都入库，刷新 last_seen
+        archive_results(query_text, results, fields=tuple(['host'] + watch))
+
+    # 关注字段变更检测: 只比对本批 host 的字段摘要
+    changed, gone = [], []
+    if watch and not error and results:
+        try:
+            gone_days = CONFIG.get('monitor_gone_days', DEFAULT_MONITOR_GONE_DAYS)
+            changed, gone = MONITOR_FINGERPRINTS.diff(task_id, watch, results, gone_after=gone_days * 86400, full=full)
+        except Exception as e:
+            logger.error(f"监控 {task_id} 字段变更检测失败: {e}")
+    if watch and (new_rows or changed or gone):
+        chat_id = task.get('chat_id')
+        events_file = os.path.join(FOFA_CACHE_DIR, f"monitor_{task_id}_changes_{int(time.time())}.tsv")
+        try:
+            if chat_id:
+                write_monitor_events(events_file, watch, new_rows, changed, gone)
+                summary = (f"🛰️ *监控事件* \\(Task: `{task_id}`\\)\n"
+                           f"🆕 新增: {len(new_rows)}  🔁 变化: {len(changed)}  🪦 消失: {len(gone)}\n"
+                           f"关注字段: `{escape_markdown_v2(','.join(watch))}`")
+                context.bot.send_message(chat_id, summary, parse_mode=ParseMode.MARKDOWN_V2)
+                send_file_safely(context, chat_id, events_file)
+        except Exception as e:
+            logger.error(f"发送监控变更报告失败: {e}")
+        finally:
+            if os.path.exists(events_file): os.remove(events_file)
                 
     # 3. 智能调频与通知
     num_new_found = len(new_data_lines)
@@ -1693,10 +4554,18 @@ def run_monitor_execution_job(context: CallbackContext):
     notification_threshold = task.get('notification_threshold', 5000)
 
     if num_new_found > 0:
-        # 发现新目标，写入数据库
-        with open(db_file, 'a', encoding='utf-8') as f:
-            f.write("\n".join(new_data_lines) + "\n")
-        
+        # 发现新目标，写入数据库并记录本轮分段
+        with open(db_file, 'ab') as f:
+            segment_start = f.seek(0, os.SEEK_END)
+            f.write(("\n".join(new_data_lines) + "\n").encode('utf-8'))
+            segment_end = f.tell()
+        try: append_monitor_segment(db_file, segment_start, segment_end, num_new_found)
+        except Exception as e: logger.error(f"记录监控分段失败: {e}")
+    if known_hosts is not None:
+        try: known_hosts.close()
+        except Exception as e: logger.error(f"更新监控索引失败: {e}")
+
+    if num_new_found > 0:
         unnotified_count += num_new_found
         
         # 检查是否达到通知阈值
@@ -1724,20 +4593,16 @@ def run_monitor_execution_job(context: CallbackContext):
         # 无新数据，进入冷却，延长间隔
         new_interval = min(43200, int(current_interval * 1.5))
 
-    # 更新任务状态
+    # 更新任务状态与预算记账
     task['last_run'] = int(time.time())
     task['interval'] = new_interval
     task['unnotified_count'] = unnotified_count
-    save_monitor_tasks()
+    MONITOR_SCHEDULER.record(task_id, requests_used, len(results), num_new_found)
     
-    # 4. 安排下一次运行 (加入抖动，并处理 RuntimeError)
+    # 4. 设置下一次到期时间 (加入抖动)，由全局调度器按预算放行
     jitter = random.randint(int(-new_interval * 0.1), int(new_interval * 0.1))
-    next_run_delay = new_interval + jitter
-    
-    try:
-        context.job_queue.run_once(run_monitor_execution_job, next_run_delay, context={"task_id": task_id}, name=f"monitor_{task_id}")
-    except RuntimeError as e:
-        logger.warning(f"无法安排新的监控任务 (可能正在关闭): {e}")
+    schedule_monitor_run(task_id, new_interval + jitter)
+    save_monitor_task(task_id)
 
 # --- 核心命令处理 ---
 def start_command(update: Update, context: CallbackContext):
@@ -1766,13 +4631,15 @@ def help_command(update: Update, context: CallbackContext):
                   "*📊 聚合统计*\n`/stats <query>`\n_获取全局聚合统计 \\(管理员\\)_\n\n"
                   "*📂 批量智能分析*\n`/batchfind`\n_上传IP列表, 分析特征并生成Excel \\(管理员\\)_\n\n"
                   "*📤 批量自定义导出 \\(交互式\\)*\n`/batch <query>`\n_进入交互式菜单选择字段导出 \\(管理员\\)_\n\n"
+                  "*🗃️ 本地资产库*\n`/assets [export|query] ...`\n_过滤和再导出已下载的数据, 不消耗额度 \\(管理员\\)_\n\n"
+                  "*🗂️ 缓存翻阅*\n`/cachepreview [序号] [页码]`\n_分页查看已缓存的查询结果, 不消耗额度 \\(管理员\\)_\n\n"
                   "*⚙️ 管理与设置*\n`/settings`\n_进入交互式设置菜单 \\(管理员\\)_\n\n"
                   "*🔑 Key管理*\n`/batchcheckapi`\n_上传文件批量验证API Key \\(管理员\\)_\n\n"
                   "*💻 系统管理*\n"
                   "`/check` \\- 系统自检\n"
                   "`/update` \\- 在线更新脚本\n"
                   "`/shutdown` \\- 安全关闭/重启\n\n"
-                  "*🛑 任务控制*\n`/stop` \\- 紧急停止下载任务\n`/cancel` \\- 取消当前操作" )
+                  "*🛑 任务控制*\n`/jobs` \\- 查看运行与排队中的任务\n`/stop [id]` \\- 停止指定任务或全部任务\n`/cancel` \\- 取消当前操作" )
     update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN_V2)
 def cancel(update: Update, context: CallbackContext) -> int:
     message = "操作已取消。"
@@ -1926,7 +4793,7 @@ def proceed_with_kkfofa_query(update: Update, context: CallbackContext, message_
         dt_utc = datetime.fromisoformat(cached_item['timestamp']); dt_local = dt_utc.astimezone(tz.tzlocal()); time_str = dt_local.strftime('%Y-%m-%d %H:%M')
         message_text = (f"✅ *发现缓存*\n\n查询: `{escape_markdown_v2(query_text)}`\n缓存于: *{escape_markdown_v2(time_str)}*\n\n")
         keyboard = []; is_expired = (datetime.now(tz.tzutc()) - dt_utc).total_seconds() > CACHE_EXPIRATION_SECONDS
-        if is_expired or not is_admin(update.effective_user.id):
+        if is_expired or not is_admin(update.effective_user.id) or not cached_item['cache'].get('high_water'):
              message_text += "⚠️ *此缓存已过期或您是访客，无法增量更新\\.*" if is_expired else ""
              keyboard.append([InlineKeyboardButton("⬇️ 下载旧缓存", callback_data='cache_download'), InlineKeyboardButton("🔍 全新搜索", callback_data='cache_newsearch')])
         else: 
@@ -1948,9 +4815,151 @@ def cache_choice_callback(update: Update, context: CallbackContext):
         else: query.message.edit_text("❌ 找不到本地缓存记录。")
         return ConversationHandler.END
     elif choice == 'newsearch': return start_new_kkfofa_search(update, context, message_to_edit=query.message)
-    elif choice == 'incremental': query.edit_message_text("⏳ 准备增量更新..."); start_download_job(context, run_incremental_update_query, context.user_data); query.message.delete(); return ConversationHandler.END
+    elif choice == 'incremental': query.edit_message_text("⏳ 准备增量更新..."); context.user_data['chat_id'] = update.effective_chat.id; start_download_job(context, run_incremental_update_query, context.user_data); query.message.delete(); return ConversationHandler.END
     elif choice == 'cancel': query.message.edit_text("操作已取消。"); return ConversationHandler.END
 
+# --- 下载任务预估 (Dry-run Planner) ---
+TRACEBACK_EFFICIENCY = 0.85  # 时间回溯每轮的平均新增比例 (锚点日期附近会有重复)
+KEY_QUOTA_TTL = 600
+KEY_QUOTA_CACHE = {}
+KEY_QUOTA_LOCK = threading.Lock()
+KEY_QUOTA_REFRESHING = set()
+MAX_SHARD_PLANS = 200
+
+def remember_key_quota(key, info):
+    KEY_QUOTA_CACHE[key] = (time.time(), info)
+
+def refresh_key_quotas(keys):
+    """在后台线程里重新拉取这些 Key 的 /info/my，同一 Key 同时只有一个刷新请求。"""
+    with KEY_QUOTA_LOCK:
+        keys = [k for k in keys if k not in KEY_QUOTA_REFRESHING]
+        KEY_QUOTA_REFRESHING.update(keys)
+    if not keys: return
+
+    def refresh():
+        for key in keys:
+            try:
+                data, error = verify_fofa_api(key)
+                if not error: remember_key_quota(key, data)
+            finally:
+                with KEY_QUOTA_LOCK: KEY_QUOTA_REFRESHING.discard(key)
+    threading.Thread(target=refresh, daemon=True, name="quota_refresh").start()
+
+def get_key_quota(key, wait=False):
+    """
+    /info/my 返回的剩余额度 (remain_api_query/remain_api_data)。
+    直接返回缓存 (可能已过期)，超过 KEY_QUOTA_TTL 时在后台刷新；wait=True 且没有缓存时同步查询一次。
+    """
+    cached = KEY_QUOTA_CACHE.get(key)
+    if cached and time.time() - cached[0] < KEY_QUOTA_TTL:
+        return cached[1]
+    if cached or not wait:
+        refresh_key_quotas([key])
+        return cached[1] if cached else None
+    data, error = verify_fofa_api(key)
+    if error: return None
+    remember_key_quota(key, data)
+    return data
+
+def usable_key_count(min_level=0):
+    return sum(1 for k in CONFIG.get('apis', []) if KEY_LEVELS.get(k, -1) >= min_level)
+
+def get_pool_quota(min_level=0, keys=None):
+    """汇总可用 Key 的剩余查询次数与数据条数 (取缓存，过期的在后台刷新)，无法获取时返回 None。"""
+    keys = keys or [k for k in CONFIG.get('apis', []) if KEY_LEVELS.get(k, -1) >= min_level]
+    total = {'queries': 0, 'data': 0, 'known': False}
+    for key in keys:
+        info = get_key_quota(key) or {}
+        if 'remain_api_query' in info or 'remain_api_data' in info:
+            total['known'] = True
+            total['queries'] += int(info.get('remain_api_query') or 0)
+            total['data'] += int(info.get('remain_api_data') or 0)
+    return total if total['known'] else None
+
+def record_shard_plan(query, total_size, requests, rows, seconds):
+    """分片引擎结束后记录实际消耗，下次对同一查询的预估直接按比例复用。"""
+    SHARD_PLANS[hashlib.md5(query.encode()).hexdigest()] = {
+        'query': query, 'total_size': total_size, 'requests': requests, 'rows': rows,
+        'seconds': round(seconds, 1), 'recorded_at': int(time.time())}
+    while len(SHARD_PLANS) > MAX_SHARD_PLANS:
+        SHARD_PLANS.pop(next(iter(SHARD_PLANS)))
+    save_shard_plans()
+
+def _plan(requests, rows, total_size, cached=False, parallel=1):
+    requests = max(int(math.ceil(requests)), 0)
+    return {'requests': requests, 'rows': int(rows), 'coverage': min(rows / total_size, 1.0) if total_size else 1.0,
+            'seconds': requests * get_api_latency() / max(parallel, 1), 'cached': cached}
+
+def estimate_download_plans(query, total_size, stats=None, can_traceback=True, limit=None, keys=1):
+    """
+    按模式估算请求次数、数据条数 (消耗的数据额度)、覆盖率与耗时:
+    - full: 前 1 万条
+    - sharding: 优先复用历史分片记录，否则按聚合统计中的国家分布推算；各分组互不依赖，耗时按 keys 个 Key 分摊
+    - traceback: 时间回溯，按 TRACEBACK_EFFICIENCY 计入重复
+    - cursor: /allfofa 的 search/next 游标 (首页已在预检中取回)
+    """
+    page = 10000
+    target = min(limit, total_size) if limit else total_size
+    plans = {'full': _plan(1, min(total_size, page), total_size),
+             'cursor': _plan(math.ceil(target / page) - 1, target, total_size),
+             'traceback': _plan(target / (page * TRACEBACK_EFFICIENCY), target, total_size) if can_traceback else None}
+
+    cached = SHARD_PLANS.get(hashlib.md5(query.encode()).hexdigest())
+    if cached and cached.get('total_size'):
+        scale = total_size / cached['total_size']
+        plans['sharding'] = _plan(cached['requests'] * scale, min(cached['rows'] * scale, total_size), total_size, cached=True, parallel=keys)
+        return plans
+
+    countries = {c.get('name'): int(c.get('count', 0)) for c in (stats or {}).get('countries', []) if c.get('name')}
+    requests, rows, known = 0, 0, 0
+    for code in SHARDING_BIG_N:
+        count = countries.get(code)
+        requests += 1  # 侦察
+        if count is None: continue
+        known += count
+        if count <= page: requests += 1; rows += count
+        elif can_traceback: requests += count / (page * TRACEBACK_EFFICIENCY); rows += count
+        else: requests += 1; rows += page
+    # 剩余国家按块侦察，超过 1 万的块继续二分，每多 1 万条约多 2 次请求 (侦察 + 下载)
+    remaining = max(total_size - known, 0)
+    other = {c for cs in CONTINENT_COUNTRIES.values() for c in cs} - set(SHARDING_BIG_N)
+    requests += math.ceil(len(other) / SHARDING_CHUNK_SIZE) * 2 + math.ceil(remaining / page) * 2
+    plans['sharding'] = _plan(requests, min(rows + remaining, total_size), total_size, parallel=keys)
+    return plans
+
+def format_plan(plan, quota=None):
+    """单行预估文本，例: ~12 次请求 · 100000 条 · 覆盖 100% · ~36s"""
+    if not plan: return "不可用"
+    text = f"~{plan['requests']} 次请求 · {plan['rows']} 条 · 覆盖 {plan['coverage']:.0%} · ~{format_duration(plan['seconds'])}"
+    if plan['cached']: text += " (历史记录)"
+    if quota and (plan['requests'] > quota['queries'] or plan['rows'] > quota['data']): text += " ⚠️超出剩余额度"
+    return text
+
+def format_plan_short(plan):
+    if not plan: return "不可用"
+    return f"{plan['requests']}次·~{format_duration(plan['seconds'])}"
+
+def plan_download_modes(query, total_size, guest_key=None, limit=None):
+    """
+    模式选择前的规划: 没有历史分片记录时经快速通道取一次聚合统计，返回 (各模式预估, 剩余额度)。
+    额度取自缓存 (后台刷新)，不在处理函数里逐个 Key 请求 /info/my。
+    """
+    stats = None
+    if hashlib.md5(query.encode()).hexdigest() not in SHARD_PLANS:
+        with interactive_lane():
+            if guest_key:
+                data, error = fetch_fofa_stats(guest_key, query)
+            else:
+                data, _, _, _, _, error = execute_query_with_fallback(
+                    lambda key, key_level, proxy_session: fetch_fofa_stats(key, query, proxy_session=proxy_session))
+        if not error and data: stats = data.get("aggs", data)
+    if guest_key:
+        guest_info = get_key_quota(guest_key, wait=True) or {}
+        can_traceback, quota, keys = bool(guest_info.get('isvip')), get_pool_quota(keys=[guest_key]), 1
+    else:
+        can_traceback, quota, keys = any(level >= 1 for level in KEY_LEVELS.values()), get_pool_quota(), usable_key_count()
+    return estimate_download_plans(query, total_size, stats=stats, can_traceback=can_traceback, limit=limit, keys=keys), quota
+
 def start_new_kkfofa_search(update: Update, context: CallbackContext, message_to_edit=None):
     query_text = context.user_data['query']; key_index = context.user_data.get('key_index'); add_or_update_query(query_text)
     msg_text = f"🔄 正在对 `{escape_markdown_v2(query_text)}` 执行全新查询\\.\\.\\."
@@ -1989,17 +4998,24 @@ def start_new_kkfofa_search(update: Update, context: CallbackContext, message_to
         start_download_job(context, run_full_download_query, context.user_data)
         return ConversationHandler.END
     else:
+        plans, quota = plan_download_modes(query_text, total_size, guest_key=guest_key)
         keyboard = [
-            [InlineKeyboardButton("💎 全部下载 (前1万)", callback_data='mode_full'), InlineKeyboardButton("🌍 分片下载 (突破上限)", callback_data='mode_sharding')],
-            [InlineKeyboardButton("🌀 深度追溯下载", callback_data='mode_traceback'), InlineKeyboardButton("❌ 取消", callback_data='mode_cancel')]
+            [InlineKeyboardButton(f"💎 前1万 ({format_plan_short(plans['full'])})", callback_data='mode_full'), InlineKeyboardButton(f"🌍 分片 ({format_plan_short(plans['sharding'])})", callback_data='mode_sharding')],
+            [InlineKeyboardButton(f"🌀 深度追溯 ({format_plan_short(plans['traceback'])})", callback_data='mode_traceback'), InlineKeyboardButton("❌ 取消", callback_data='mode_cancel')]
         ]
+        quota_text = f"剩余额度: 查询 {quota['queries']} 次 / 数据 {quota['data']} 条" if quota else "剩余额度: 未知"
         
         msg_text = (
             f"{success_message}\n"
             f"检测到大量结果 \\({total_size}条\\)\\。由于单次查询上限 \\(10,000\\)，您可以：\n\n"
             f"1️⃣ *前1万*：仅下载最近的1万条\\。\n"
             f"2️⃣ *分片下载*：按国家自动拆分，尽可能通过积少成多突破1万条限制 \\(消耗更多请求\\)\\。\n"
-            f"3️⃣ *深度追溯*：按时间回溯 \\(需高等级Key\\)\\。"
+            f"3️⃣ *深度追溯*：按时间回溯 \\(需高等级Key\\)\\。\n\n"
+            f"📐 *预估* \\(单次请求约 {escape_markdown_v2(f'{get_api_latency():.1f}s')}\\)\n"
+            f"1️⃣ {escape_markdown_v2(format_plan(plans['full'], quota))}\n"
+            f"2️⃣ {escape_markdown_v2(format_plan(plans['sharding'], quota))}\n"
+            f"3️⃣ {escape_markdown_v2(format_plan(plans['traceback'], quota))}\n"
+            f"{escape_markdown_v2(quota_text)}"
         )
         msg.edit_text(msg_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
         return QUERY_STATE_KKFOFA_MODE 
@@ -2045,6 +5061,39 @@ def get_traceback_limit(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 # --- /host 和 /lowhost 命令 ---
+# 两个命令都先查本地资产库 (历史下载、监控数据、之前的 /host 结果)，
+# 本地数据在 host_local_max_age 秒内时直接回答并标注新鲜度；带 refresh 参数或数据过旧时才请求 FOFA。
+def local_host_records(host_arg):
+    """
+    本地资产能回答 /host 时返回 (记录列表, 入库时长)，否则 (None, 时长或 None)，调用方转而查询 FOFA。
+    只有带 ip 且带端口或协议的记录才算服务记录；新鲜度只按这些记录判断，过期的记录不参与展示。
+    """
+    records, _ = ASSET_STORE.lookup_host(host_arg)
+    services = [r for r in records if r.get('ip') and (r.get('port') or r.get('protocol'))]
+    if not services: return None, None
+    now, max_age = time.time(), CONFIG.get('host_local_max_age', 86400)
+    fresh = [r for r in services if now - r['_last_seen'] <= max_age]
+    age = now - max(r['_last_seen'] for r in services)
+    if not fresh: return None, age
+    return fresh, age
+
+def format_local_freshness(command, host_arg, age):
+    return (f"\n\n🗃️ _本地数据，{escape_markdown_v2(format_duration(age))} 前入库_\n"
+            f"发送 `/{command} {escape_markdown_v2(host_arg)} refresh` 从 FOFA 获取最新结果")
+
+def build_local_host_data(host_arg, records):
+    """把本地资产记录拼成与 /host 聚合接口相同结构的字典，供 format_host_summary/format_host_details 使用。"""
+    first = records[0]
+    services = [r for r in records if r.get('port')]
+    return {
+        'host': host_arg, 'ip': first.get('ip', ''), 'org': first.get('org', ''), 'asn': first.get('asn', ''),
+        'country_name': first.get('country_name') or first.get('country', ''), 'region': first.get('region', ''), 'city': first.get('city', ''),
+        'ports': sorted({int(r['port']) for r in services}),
+        'protocols': sorted({r['protocol'] for r in records if r.get('protocol')}),
+        'port_details': [{'port': r['port'], 'protocol': r.get('protocol', 'N/A'), 'title': r.get('title'),
+                          'product': r.get('product'), 'jarm': r.get('jarm'), 'banner': r.get('banner')} for r in services],
+    }
+
 def _create_dict_from_fofa_result(result_list, fields_list):
     return {fields_list[i]: result_list[i] for i in range(len(fields_list))}
 def get_common_host_info(results, fields_list):
@@ -2102,40 +5151,50 @@ def format_full_host_report(host_arg, results, fields_list):
     return "\n".join(report)
 def host_command_logic(update: Update, context: CallbackContext):
     if not context.args:
-        update.message.reply_text(f"用法: `/host <ip_or_domain>`\n\n示例:\n`/host 1\\.1\\.1\\.1`", parse_mode=ParseMode.MARKDOWN_V2)
+        update.message.reply_text(f"用法: `/host <ip_or_domain> [refresh]`\n\n示例:\n`/host 1\\.1\\.1\\.1`\n_默认优先使用本地数据，加 refresh 强制请求 FOFA_", parse_mode=ParseMode.MARKDOWN_V2)
         return
     host_arg = context.args[0]
-    processing_message = update.message.reply_text(f"⏳ 正在查询主机 `{escape_markdown_v2(host_arg)}`\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    refresh = any(a.lower() == 'refresh' for a in context.args[1:])
     query = f'ip="{host_arg}"' if re.match(r"^\d{1,3}(\.\d{1,3}){3}$", host_arg) else f'domain="{host_arg}"'
-    data, final_fields_list, error = None, [], None
-    for level in range(3, -1, -1): 
-        fields_to_try = get_fields_by_level(level)
-        fields_str = ",".join(fields_to_try)
-        try:
-            processing_message.edit_text(f"⏳ 正在尝试以 *等级 {level}* 字段查询\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        except (BadRequest, RetryAfter, TimedOut):
-            time.sleep(1)
-        temp_data, _, _, _, _, temp_error = execute_query_with_fallback(
-            lambda key, key_level, proxy_session: fetch_fofa_data(key, query, page_size=100, fields=fields_str, proxy_session=proxy_session)
-        )
-        if not temp_error:
-            data = temp_data
-            final_fields_list = fields_to_try
-            error = None
-            break
-        if "[820001]" not in str(temp_error):
-            error = temp_error
-            break
-        else:
-            error = temp_error
-            continue
-    if error:
-        processing_message.edit_text(f"查询失败 😞\n*原因:* `{escape_markdown_v2(error)}`", parse_mode=ParseMode.MARKDOWN_V2)
-        return
-    raw_results = data.get('results', [])
-    if not raw_results:
-        processing_message.edit_text(f"🤷‍♀️ 未找到关于 `{escape_markdown_v2(host_arg)}` 的任何信息\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        return
+    records, age = (None, None) if refresh else local_host_records(host_arg)
+    if records:
+        processing_message = update.message.reply_text(f"🗃️ 命中本地数据 `{escape_markdown_v2(host_arg)}`\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        final_fields_list = ['ip', 'port', 'protocol'] + sorted({k for r in records for k in r if not k.startswith('_')} - {'ip', 'port', 'protocol'})
+        raw_results = [[str(r.get(f, '')) for f in final_fields_list] for r in records]
+        source_note = format_local_freshness("host", host_arg, age)
+    else:
+        processing_message = update.message.reply_text(f"⏳ 正在查询主机 `{escape_markdown_v2(host_arg)}`\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        data, final_fields_list, error = None, [], None
+        for level in range(3, -1, -1): 
+            fields_to_try = get_fields_by_level(level)
+            fields_str = ",".join(fields_to_try)
+            try:
+                processing_message.edit_text(f"⏳ 正在尝试以 *等级 {level}* 字段查询\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
+            except (BadRequest, RetryAfter, TimedOut):
+                time.sleep(1)
+            temp_data, _, _, _, _, temp_error = execute_query_with_fallback(
+                lambda key, key_level, proxy_session: fetch_fofa_data(key, query, page_size=100, fields=fields_str, proxy_session=proxy_session)
+            )
+            if not temp_error:
+                data = temp_data
+                final_fields_list = fields_to_try
+                error = None
+                break
+            if "[820001]" not in str(temp_error):
+                error = temp_error
+                break
+            else:
+                error = temp_error
+                continue
+        if error:
+            processing_message.edit_text(f"查询失败 😞\n*原因:* `{escape_markdown_v2(error)}`", parse_mode=ParseMode.MARKDOWN_V2)
+            return
+        raw_results = data.get('results', [])
+        if not raw_results:
+            processing_message.edit_text(f"🤷‍♀️ 未找到关于 `{escape_markdown_v2(host_arg)}` 的任何信息\\.", parse_mode=ParseMode.MARKDOWN_V2)
+            return
+        archive_results(query, raw_results, final_fields_list)
+        source_note = ""
     
     unique_services = {}
     ip_idx = final_fields_list.index('ip') if 'ip' in final_fields_list else -1
@@ -2152,9 +5211,9 @@ def host_command_logic(update: Update, context: CallbackContext):
         results = raw_results
 
     full_report = format_full_host_report(host_arg, results, final_fields_list)
-    if len(full_report) > 3800:
+    if len(full_report) + len(source_note) > 3800:
         summary_report = create_host_summary(host_arg, results, final_fields_list)
-        processing_message.edit_text(summary_report, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+        processing_message.edit_text(summary_report + source_note, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
         report_filename = f"host_details_{host_arg.replace('.', '_')}.txt"
         try:
             plain_text_report = re.sub(r'([*_`\[\]\\])', '', full_report)
@@ -2164,8 +5223,9 @@ def host_command_logic(update: Update, context: CallbackContext):
         finally:
             if os.path.exists(report_filename): os.remove(report_filename)
     else:
-        processing_message.edit_text(full_report, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+        processing_message.edit_text(full_report + source_note, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
 @admin_only
+@interactive_command("host")
 def host_command(update: Update, context: CallbackContext):
     host_command_logic(update, context)
 def format_host_summary(data):
@@ -2202,26 +5262,42 @@ def format_host_details(data):
         details.append(port_str)
     full_report = summary + "\n".join(details)
     return full_report
+@interactive_command("lowhost")
 def lowhost_command(update: Update, context: CallbackContext) -> None:
     if not context.args:
-        update.message.reply_text("用法: `/lowhost <ip_or_domain> [detail]`\n\n示例:\n`/lowhost 1\\.1\\.1\\.1`\n`/lowhost example\\.com detail`", parse_mode=ParseMode.MARKDOWN_V2)
+        update.message.reply_text("用法: `/lowhost <ip_or_domain> [detail] [refresh]`\n\n示例:\n`/lowhost 1\\.1\\.1\\.1`\n`/lowhost example\\.com detail`", parse_mode=ParseMode.MARKDOWN_V2)
         return
     host = context.args[0]
-    detail = len(context.args) > 1 and context.args[1].lower() == 'detail'
-    processing_message = update.message.reply_text(f"正在查询主机 `{escape_markdown_v2(host)}` 的聚合信息\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    data, _, _, _, _, error = execute_query_with_fallback(
-        lambda key, key_level, proxy_session: fetch_fofa_host_info(key, host, detail, proxy_session=proxy_session)
-    )
-    if error:
-        processing_message.edit_text(f"查询失败 😞\n*原因:* `{escape_markdown_v2(error)}`", parse_mode=ParseMode.MARKDOWN_V2)
-        return
-    if not data:
-        processing_message.edit_text(f"🤷‍♀️ 未找到关于 `{escape_markdown_v2(host)}` 的任何信息\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        return
+    flags = {a.lower() for a in context.args[1:]}
+    detail, refresh = 'detail' in flags, 'refresh' in flags
+    records, age = (None, None) if refresh else local_host_records(host)
+    source_note = ""
+    if records:
+        processing_message = update.message.reply_text(f"🗃️ 命中本地数据 `{escape_markdown_v2(host)}`\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        data = build_local_host_data(host, records)
+        source_note = format_local_freshness("lowhost", host, age)
+    else:
+        processing_message = update.message.reply_text(f"正在查询主机 `{escape_markdown_v2(host)}` 的聚合信息\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        data, _, _, _, _, error = execute_query_with_fallback(
+            lambda key, key_level, proxy_session: fetch_fofa_host_info(key, host, detail, proxy_session=proxy_session)
+        )
+        if error:
+            processing_message.edit_text(f"查询失败 😞\n*原因:* `{escape_markdown_v2(error)}`", parse_mode=ParseMode.MARKDOWN_V2)
+            return
+        if not data:
+            processing_message.edit_text(f"🤷‍♀️ 未找到关于 `{escape_markdown_v2(host)}` 的任何信息\\.", parse_mode=ParseMode.MARKDOWN_V2)
+            return
+        if data.get('port_details') and data.get('ip'):
+            detail_fields = ['host', 'ip', 'port', 'protocol', 'title', 'product', 'jarm', 'banner', 'org', 'country_name']
+            archive_results(f'ip="{data["ip"]}"', [
+                [f"{data['ip']}:{p.get('port')}", data['ip'], p.get('port'), p.get('protocol'), p.get('title'),
+                 p.get('product'), p.get('jarm'), p.get('banner'), data.get('org'), data.get('country_name')]
+                for p in data['port_details'] if p.get('port')], detail_fields)
     if detail:
         formatted_text = format_host_details(data)
     else:
         formatted_text = format_host_summary(data)
+    formatted_text += source_note
     if len(formatted_text) > 3800:
         processing_message.edit_text("报告过长，将作为文件发送。")
         report_filename = f"lowhost_details_{host.replace('.', '_')}.txt"
@@ -2242,6 +5318,7 @@ def stats_command(update: Update, context: CallbackContext):
         update.message.reply_text("请输入要进行聚合统计的FOFA查询语法:")
         return STATS_STATE_GET_QUERY
     return get_fofa_stats_query(update, context)
+@interactive_command("stats")
 def get_fofa_stats_query(update: Update, context: CallbackContext):
     query_text = " ".join(context.args) if context.args else update.message.text
     msg = update.message.reply_text(f"⏳ 正在对 `{escape_markdown_v2(query_text)}` 进行聚合统计\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
@@ -2307,6 +5384,7 @@ def get_fofa_stats_query(update: Update, context: CallbackContext):
 
     return ConversationHandler.END
 
+@interactive_command("inline")
 def inline_fofa_handler(update: Update, context: CallbackContext) -> None:
     """处理内联查询请求"""
     query_text = update.inline_query.query
@@ -2418,7 +5496,7 @@ def select_batch_features_callback(update: Update, context: CallbackContext):
         if not selected: query.answer("请至少选择一个特征！", show_alert=True); return BATCHFIND_STATE_SELECT_FEATURES
         query.message.edit_text("✅ 特征选择完毕，任务已提交到后台分析。")
         job_context = {'chat_id': query.message.chat_id, 'file_path': context.user_data['batch_file_path'], 'features': list(selected)}
-        context.job_queue.run_once(run_batch_find_job, 1, context=job_context, name=f"batchfind_{query.message.chat_id}")
+        submit_job(context, 'batchfind', run_batch_find_job, job_context, query.message.chat_id)
         return ConversationHandler.END
     if feature == 'all':
         if len(selected) == len(BATCH_FEATURES): selected.clear()
@@ -2442,20 +5520,23 @@ def run_batch_find_job(context: CallbackContext):
     bot = context.bot; msg = bot.send_message(chat_id, "⏳ 开始批量分析任务...")
     try:
         with open(file_path, 'r', encoding='utf-8') as f: targets = [line.strip() for line in f if line.strip()]
-    except Exception as e: msg.edit_text(f"❌ 读取文件失败: {e}"); return
-    if not targets: msg.edit_text("❌ 文件为空。"); return
-    total_targets = len(targets); processed_count = 0; detailed_results_for_excel = []
+    except Exception as e: OUTBOX.edit_now(msg, f"❌ 读取文件失败: {e}"); return
+    if not targets: OUTBOX.edit_now(msg, "❌ 文件为空。"); return
+    total_targets = len(targets); processed_count = 0; detailed_results_for_excel = []; start_time = time.time()
+    track_job(job_data, total=total_targets)
     for target in targets:
+        if context.bot_data.get(job_stop_flag(job_data)): OUTBOX.edit_now(msg, "🌀 批量分析已手动停止，正在导出已完成部分..."); break
         processed_count += 1
-        if processed_count % 10 == 0:
-            try: msg.edit_text(f"分析进度: {create_progress_bar(processed_count/total_targets*100)} ({processed_count}/{total_targets})")
-            except (BadRequest, RetryAfter, TimedOut): pass
+        track_job(job_data, rows=processed_count, requests=1)
+        OUTBOX.edit(msg, f"分析进度: {create_progress_bar(processed_count/total_targets*100)} ({processed_count}/{total_targets})\n"
+                         f"{format_rate_eta(processed_count, total_targets, start_time)}")
         query = f'ip="{target}"' if ':' not in target else f'host="{target}"'
         data, _, _, _, _, error = execute_query_with_fallback(
             lambda key, key_level, proxy_session: fetch_fofa_data(key, query, page_size=1, fields=",".join(features), proxy_session=proxy_session)
         )
         if not error and data.get('results'):
             result = data['results'][0]
+            archive_results(query, [result if isinstance(result, list) else [result]], features)
             row_data = {'Target': target}
             row_data.update({BATCH_FEATURES.get(f, f): result[i] for i, f in enumerate(features)})
             detailed_results_for_excel.append(row_data)
@@ -2464,12 +5545,12 @@ def run_batch_find_job(context: CallbackContext):
             df = pd.DataFrame(detailed_results_for_excel)
             excel_filename = generate_filename_from_query(os.path.basename(file_path), prefix="analysis", ext=".xlsx")
             df.to_excel(excel_filename, index=False, engine='openpyxl')
-            msg.edit_text("✅ 分析完成！正在发送Excel报告...")
+            OUTBOX.edit_now(msg, "✅ 分析完成！正在发送Excel报告...")
             send_file_safely(context, chat_id, excel_filename, caption="📄 详细特征分析Excel报告")
             upload_and_send_links(context, chat_id, excel_filename)
             os.remove(excel_filename)
-        except Exception as e: msg.edit_text(f"❌ 生成Excel失败: {e}")
-    else: msg.edit_text("🤷‍♀️ 分析完成，但未找到任何匹配的FOFA数据。")
+        except Exception as e: OUTBOX.edit_now(msg, f"❌ 生成Excel失败: {e}")
+    else: OUTBOX.edit_now(msg, "🤷‍♀️ 分析完成，但未找到任何匹配的FOFA数据。")
     if os.path.exists(file_path): os.remove(file_path)
 
 # --- /batch (交互式) ---
@@ -2602,12 +5683,7 @@ def receive_api_file(update: Update, context: CallbackContext) -> int:
             valid_keys.append(f"`...{key[-4:]}` \\- ✅ *有效* \\({escape_markdown_v2(data.get('username', 'N/A'))}, {level_name}会员\\)")
         else:
             invalid_keys.append(f"`...{key[-4:]}` \\- ❌ *无效* \\(原因: {escape_markdown_v2(error)}\\)")
-        if (i + 1) % 10 == 0 or (i + 1) == total:
-            try:
-                progress_text = f"⏳ 验证进度: {create_progress_bar((i+1)/total*100)} ({i+1}/{total})"
-                msg.edit_text(progress_text)
-            except (BadRequest, RetryAfter, TimedOut):
-                time.sleep(2)
+        OUTBOX.edit(msg, f"⏳ 验证进度: {create_progress_bar((i+1)/total*100)} ({i+1}/{total})")
     
     report = [f"📋 *批量API Key验证报告*"]
     report.append(f"\n总计: {total} \\| 有效: {len(valid_keys)} \\| 无效: {len(invalid_keys)}\n")
@@ -2621,7 +5697,7 @@ def receive_api_file(update: Update, context: CallbackContext) -> int:
     report_text = "\n".join(report)
     if len(report_text) > 3800:
         summary = f"✅ 验证完成！\n总计: {total} \\| 有效: {len(valid_keys)} \\| 无效: {len(invalid_keys)}\n\n报告过长，已作为文件发送\\."
-        msg.edit_text(summary)
+        OUTBOX.edit_now(msg, summary)
         report_filename = f"api_check_report_{int(time.time())}.txt"
         try:
             plain_text_report = re.sub(r'([*_`\[\]\\])', '', report_text)
@@ -2630,7 +5706,7 @@ def receive_api_file(update: Update, context: CallbackContext) -> int:
         finally:
             if os.path.exists(report_filename): os.remove(report_filename)
     else:
-        msg.edit_text(report_text, parse_mode=ParseMode.MARKDOWN_V2)
+        OUTBOX.edit_now(msg, report_text, parse_mode=ParseMode.MARKDOWN_V2)
 
     if os.path.exists(temp_path): os.remove(temp_path)
     return ConversationHandler.END
@@ -2643,8 +5719,8 @@ def check_command(update: Update, context: CallbackContext):
     report = ["*📋 系统自检报告*"]
     
     try:
-        
-        CONFIG = load_json_file(CONFIG_FILE, DEFAULT_CONFIG)
+        PERSIST.flush()
+        CONFIG = load_config()
         report.append("✅ *配置文件*: `config\\.json` 加载正常")
     except Exception as e:
         report.append(f"❌ *配置文件*: 加载失败 \\- {escape_markdown_v2(str(e))}")
@@ -2666,12 +5742,112 @@ def check_command(update: Update, context: CallbackContext):
                 requests.get("https://fofa.info", proxies={"http": p, "https": p}, timeout=10, verify=False)
                 report.append(f"  \\- `{escape_markdown_v2(p)}`: ✅ 连接成功")
             except Exception as e: report.append(f"  \\- `{escape_markdown_v2(p)}`: ❌ 连接失败 \\- `{escape_markdown_v2(str(e))}`")
+    report.append("\n*🔐 Key 利用率:*")
+    for usage in KEY_LEASES.stats():
+        cooldown = f"，冷却 {format_duration(usage['cooldown'])}" if usage['cooldown'] else ""
+        report.append(f"  `\\#{CONFIG['apis'].index(usage['key'])+1}` 租约 {usage['active']}，请求 {usage['requests']}，占用 {escape_markdown_v2(format_duration(usage['busy_seconds']))}{escape_markdown_v2(cooldown)}")
+    report.append("\n*⚡ 交互延迟 \\(p50 / p95\\):*")
+    latency = interactive_latency_stats()
+    if not latency: report.append("  \\- ℹ️ 暂无样本")
+    for name, (count, p50, p95) in sorted(latency.items()):
+        report.append(f"  \\- `{name}`: {escape_markdown_v2(f'{p50:.2f}s / {p95:.2f}s')} \\(n\\={count}\\)")
+    report.append("\n*🗂 任务调度:*")
+    for job_class, (running, queued, limit) in JOB_SCHEDULER.summary().items():
+        report.append(f"  \\- `{job_class}`: 运行 {running}/{limit}，排队 {queued}")
+    report.append(f"\n*📨 出站消息:* 已发送 {OUTBOX.stats['sent']}，合并 {OUTBOX.stats['coalesced']}，限流 {OUTBOX.stats['retry_after']} 次")
+    state_stats = STATE.stats(); state_kb = escape_markdown_v2(f"{state_stats['size'] / 1024:.1f}")
+    report.append(f"\n*🗄️ 状态库:* {state_kb} KB，监控 {state_stats['counts']['monitor_tasks']}，历史 {state_stats['counts']['history']}，累计写入 {state_stats['writes']} 行 \\(合并前 {PERSIST.stats['requested']} 次保存请求\\)")
+    asset_stats = ASSET_STORE.stats(); asset_mb = escape_markdown_v2(f"{asset_stats['size'] / 1024 ** 2:.1f}")
+    report.append(f"*🗃️ 资产库:* {asset_stats['assets']} 个资产，{asset_stats['queries']} 条查询，{asset_mb} MB")
+    cache_bytes, cache_files = CACHE_MANAGER.usage(); cache_budget = CACHE_MANAGER.budget()
+    cache_mb = escape_markdown_v2(f"{cache_bytes / 1024 ** 2:.1f}/{cache_budget / 1024 ** 2:.0f}")
+    report.append(f"*📁 结果缓存:* {cache_mb} MB，{cache_files} 个文件，已淘汰 {CACHE_MANAGER.stats['evicted']}，清理无主 {CACHE_MANAGER.stats['orphans_removed']}")
     msg.edit_text("\n".join(report), parse_mode=ParseMode.MARKDOWN_V2)
 @admin_only
 def stop_all_tasks(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
-    context.bot_data[f'stop_job_{chat_id}'] = True
-    update.message.reply_text("🛑 已发送停止信号，当前下载任务将在完成本页后停止。")
+    job_id = context.args[0].lstrip('#') if context.args else None
+    stopped, cancelled = JOB_SCHEDULER.stop(context.bot_data, chat_id, job_id)
+    if not stopped and not cancelled:
+        update.message.reply_text(f"🤷‍♀️ 未找到任务 #{job_id}，使用 /jobs 查看当前任务。" if job_id else "🤷‍♀️ 当前会话没有正在运行或排队的任务。")
+        return
+    lines = []
+    if stopped: lines.append(f"🛑 已向任务 {', '.join('#' + j for j in stopped)} 发送停止信号，将在完成当前页后停止。")
+    if cancelled: lines.append(f"已取消排队中的任务 {', '.join('#' + j for j in cancelled)}。")
+    update.message.reply_text("\n".join(lines))
+@admin_only
+def jobs_command(update: Update, context: CallbackContext):
+    show_all = bool(context.args) and context.args[0] == 'all' and is_super_admin(update.effective_user.id)
+    running, queued = JOB_SCHEDULER.snapshot(None if show_all else update.effective_chat.id)
+    lines = [f"📋 {'全部' if show_all else '当前会话'}任务 (进程内存: {get_process_rss_mb():.1f} MB)"]
+    overall = interactive_latency_stats().get('all')
+    if overall: lines.append(f"⚡ 交互延迟 p50 {overall[1]:.2f}s / p95 {overall[2]:.2f}s (n={overall[0]})")
+    if not running and not queued:
+        lines.append("\n当前没有正在运行或排队的任务。")
+    now = time.time()
+    for entry in running:
+        m = entry['metrics']; elapsed = now - entry['started']
+        keys = ",".join(f"...{k}" for k in sorted(m['keys'])) or "-"
+        stopping = " (停止中)" if context.bot_data.get(f"stop_job_{entry['job_id']}") else ""
+        lines.append(
+            f"\n▶️ #{entry['job_id']} [{entry['class']}]{stopping} 已运行 {format_duration(elapsed)}\n"
+            f"   {entry['label'][:60]}\n"
+            f"   {m['rows']}{'/' + str(m['total']) if m['total'] else ''} 条 | 请求 {m['requests']} | Key {keys}\n"
+            f"   {format_rate_eta(m['rows'], m['total'], entry['started'])}"
+        )
+    for position, entry in queued:
+        lines.append(f"\n⏳ #{entry['job_id']} [{entry['class']}] 排队第 {position} 位，已等待 {format_duration(now - entry['submitted'])}\n   {entry['label'][:60]}")
+    lines.append("\n使用 /stop <id> 停止单个任务，/stop 停止本会话全部任务 (定时监控需指定 id)。")
+    update.message.reply_text("\n".join(lines))
+ASSET_EXPORT_FORMATS = ('txt', 'csv', 'xlsx')
+_SINCE_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+
+@admin_only
+def assets_command(update: Update, context: CallbackContext):
+    """本地资产库: 统计、按条件导出、按查询再导出，全部不消耗 FOFA 额度。"""
+    args = context.args or []
+    usage = ("用法:\n"
+             "/assets - 资产库统计\n"
+             "/assets export <txt|csv|xlsx> [country=CN] [port=443] [protocol=https] [org=..] [server=..] [since=7d] [fields=host,title] [limit=N]\n"
+             "/assets query <FOFA语句> - 导出该查询历史上收集到的全部资产 (csv)")
+    if not args:
+        st = ASSET_STORE.stats()
+        update.message.reply_text(
+            f"🗃️ 本地资产库\n资产: {st['assets']} 个 (24小时内出现 {st['seen_24h']})\n查询: {st['queries']} 条\n"
+            f"占用: {st['size'] / 1024 ** 2:.1f} MB\n\n{usage}")
+        return
+    sub_cmd = args[0].lower()
+    select_kwargs, fmt = {}, 'csv'
+    if sub_cmd == 'query' and len(args) > 1:
+        select_kwargs['query_text'] = " ".join(args[1:])
+    elif sub_cmd == 'export' and len(args) > 1 and args[1].lower() in ASSET_EXPORT_FORMATS:
+        fmt, filters = args[1].lower(), {}
+        for token in args[2:]:
+            if '=' not in token: update.message.reply_text(f"❌ 无法识别的条件: {token}\n\n{usage}"); return
+            k, v = token.split('=', 1); k = k.lower()
+            if k == 'since':
+                m = re.match(r'^(\d+)([mhd])$', v.lower())
+                if not m: update.message.reply_text("❌ since 格式应为 30m / 12h / 7d"); return
+                select_kwargs['since'] = int(m.group(1)) * _SINCE_UNITS[m.group(2)]
+            elif k == 'fields': select_kwargs['columns'] = [f for f in v.split(',') if f]
+            elif k == 'limit' and v.isdigit(): select_kwargs['limit'] = int(v)
+            elif k == 'port' and not v.isdigit(): update.message.reply_text("❌ port 必须是数字"); return
+            else: filters[k] = v.strip('"')
+        select_kwargs['filters'] = filters
+    else:
+        update.message.reply_text(usage); return
+    label = select_kwargs.get('query_text') or "_".join(args[1:]) or "assets"
+    export_filename = generate_filename_from_query(label, prefix="assets", ext=f".{fmt}")
+    try:
+        count = ASSET_STORE.export(export_filename, fmt, **select_kwargs)
+        if not count: update.message.reply_text("🤷‍♀️ 资产库中没有符合条件的记录。"); return
+        send_file_safely(context, update.effective_chat.id, export_filename, caption=f"🗃️ 本地资产导出 ({count} 条，未消耗 FOFA 额度)")
+        upload_and_send_links(context, update.effective_chat.id, export_filename)
+    except Exception as e:
+        logger.error(f"资产导出失败: {e}", exc_info=True)
+        update.message.reply_text(f"❌ 资产导出失败: {e}")
+    finally:
+        if os.path.exists(export_filename): os.remove(export_filename)
 @super_admin_only
 def backup_config_command(update: Update, context: CallbackContext):
     if update.callback_query:
@@ -2679,17 +5855,23 @@ def backup_config_command(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     backup_filename = f"fofabot_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
     
+    PERSIST.flush()
     json_files = glob.glob('*.json')
     if not json_files:
         context.bot.send_message(chat_id, "🤷‍♀️ 未找到任何 \\.json 配置文件可以备份。")
         return
         
-    msg = context.bot.send_message(chat_id, f"📦 正在打包所有 {len(json_files)} 个 \\.json 配置文件...")
+    msg = context.bot.send_message(chat_id, f"📦 正在打包所有 {len(json_files)} 个 \\.json 配置文件及状态库...")
+    snapshot = os.path.join(FOFA_CACHE_DIR, f"{STATE_DB_FILE}.{int(time.time())}")
     
     try:
+        os.makedirs(FOFA_CACHE_DIR, exist_ok=True)
+        STATE.backup_to(snapshot)
         with zipfile.ZipFile(backup_filename, 'w', zipfile.ZIP_DEFLATED) as zf:
             for f in json_files:
                 zf.write(f)
+            zf.write(snapshot, arcname=STATE_DB_FILE)
+        os.remove(snapshot)
         
         msg.edit_text("✅ 打包完成，正在发送备份文件...")
         send_file_safely(context, chat_id, backup_filename, caption=f"FofaBot 完整配置备份({len(json_files)}个文件)")
@@ -2716,6 +5898,13 @@ def receive_config_file(update: Update, context: CallbackContext):
     doc = update.message.document
     file_name = doc.file_name.lower()
     
+    if not (file_name.endswith('.zip') or file_name == 'config.json'):
+        update.message.reply_text("❌ 文件格式错误，请上传 `config.json` 或 `.zip` 备份文件。")
+        return ConversationHandler.END
+
+    # 恢复前先落盘待写数据，然后冻结持久化: 恢复之后到重启之前内存中的旧状态不再写回
+    PERSIST.flush()
+    PERSIST.freeze()
     # 恢复 .zip 备份
     if file_name.endswith('.zip'):
         msg = update.message.reply_text("解压并恢复 ZIP 备份中...")
@@ -2725,33 +5914,36 @@ def receive_config_file(update: Update, context: CallbackContext):
         try:
             with zipfile.ZipFile(zip_path, 'r') as zf:
                 if 'config.json' not in zf.namelist():
+                    PERSIST.thaw()
                     msg.edit_text("❌ 压缩包中缺少 `config.json`，恢复失败。")
                     return ConversationHandler.END
                 
-                zf.extractall('.')
+                names = zf.namelist()
+                if STATE_DB_FILE in names: STATE.restore_from(zf)
+                zf.extractall('.', members=[n for n in names if n != STATE_DB_FILE])
             
             os.remove(zip_path)
-            CONFIG = load_json_file(CONFIG_FILE, DEFAULT_CONFIG)
+            if STATE_DB_FILE not in names:
+                # 旧版备份只有 JSON 文件，重新导入数据库
+                STATE.migrate_from_json(force=True)
+            CONFIG = load_config()
             msg.edit_text("✅ 已从ZIP成功恢复所有配置文件。机器人将自动重启。")
             shutdown_command(update, context, restart=True)
             
         except Exception as e:
             logger.error(f"恢复ZIP备份时出错: {e}")
+            PERSIST.thaw()
             msg.edit_text(f"❌ 恢复备份失败: {escape_markdown_v2(str(e))}", parse_mode=ParseMode.MARKDOWN_V2)
 
         return ConversationHandler.END
     
     # 恢复单个 config.json
-    elif file_name == 'config.json':
+    else:
         doc.get_file().download(custom_path=CONFIG_FILE)
-        CONFIG = load_json_file(CONFIG_FILE, DEFAULT_CONFIG)
+        CONFIG = load_config()
         update.message.reply_text("✅ 配置文件已恢复。机器人将自动重启。")
         shutdown_command(update, context, restart=True)
         return ConversationHandler.END
-
-    else:
-        update.message.reply_text("❌ 文件格式错误，请上传 `config.json` 或 `.zip` 备份文件。")
-        return ConversationHandler.END
 @admin_only
 def history_command(update: Update, context: CallbackContext):
     if not HISTORY['queries']: update.message.reply_text("查询历史为空。"); return
@@ -2770,14 +5962,16 @@ def get_import_query(update: Update, context: CallbackContext):
     file = doc.get_file()
     temp_path = os.path.join(FOFA_CACHE_DIR, f"import_{doc.file_id}.txt")
     file.download(custom_path=temp_path)
-    try:
-        with open(temp_path, 'r', encoding='utf-8') as f: result_count = sum(1 for _ in f)
-    except Exception as e: update.message.reply_text(f"❌ 读取文件失败: {e}"); os.remove(temp_path); return ConversationHandler.END
     query_text = update.message.text
     if not query_text: update.message.reply_text("请输入与此文件关联的原始FOFA查询语法:"); return IMPORT_STATE_GET_FILE
     final_filename = generate_filename_from_query(query_text)
-    final_path = os.path.join(FOFA_CACHE_DIR, final_filename)
-    shutil.move(temp_path, final_path)
+    try:
+        final_path = store_cache_file(temp_path, final_filename)
+        result_count = count_lines(final_path)
+    except Exception as e:
+        update.message.reply_text(f"❌ 读取文件失败: {e}")
+        if os.path.exists(temp_path): os.remove(temp_path)
+        return ConversationHandler.END
     cache_data = {'file_path': final_path, 'result_count': result_count}
     add_or_update_query(query_text, cache_data)
     update.message.reply_text(f"✅ 成功导入缓存！\n查询: `{escape_markdown_v2(query_text)}`\n共 {result_count} 条记录\\.", parse_mode=ParseMode.MARKDOWN_V2)
@@ -3175,25 +6369,18 @@ def show_monitor_menu(update: Update, context: CallbackContext):
             data_file = os.path.join(MONITOR_DATA_DIR, f"{tid}.txt")
             count = 0
             if os.path.exists(data_file):
-                try: 
-                    with open(data_file, 'r', encoding='utf-8') as f: count = sum(1 for _ in f)
+                try: count = count_lines(data_file)
                 except Exception: pass
             
             next_run_str = "未知"
-            jobs = context.job_queue.get_jobs_by_name(f"monitor_{tid}")
-            if jobs:
-                # Use next_t for next run time
-                next_run_dt = jobs[0].next_t
-                if isinstance(next_run_dt, datetime):
-                     next_run_str = next_run_dt.astimezone(tz.tzlocal()).strftime('%H:%M:%S')
-                else: 
-                     next_run_str = "计划中..."
-            else:
-                 last_run = task.get('last_run', 0)
-                 if last_run == 0:
-                     next_run_str = "首次运行"
-                 else:
-                     next_run_str = "已暂停" 
+            if task.get('status') != 'active':
+                next_run_str = "已暂停"
+            elif task.get('next_due'):
+                next_run_str = datetime.fromtimestamp(task['next_due']).replace(tzinfo=tz.tzlocal()).strftime('%H:%M:%S')
+                if tid in MONITOR_SCHEDULER.inflight: next_run_str = "执行中"
+                elif task['next_due'] <= time.time(): next_run_str += " (等待预算)"
+            elif task.get('last_run', 0) == 0:
+                next_run_str = "首次运行"
 
             threshold = task.get('notification_threshold', 5000)
             
@@ -3246,8 +6433,8 @@ def get_monitor_query_to_add(update: Update, context: CallbackContext):
             "added_at": int(time.time()), "last_run": 0, "interval": 3600,
             "status": "active", "unnotified_count": 0, "notification_threshold": 5000
         }
+        schedule_monitor_run(task_id, 0)
         save_monitor_tasks()
-        context.job_queue.run_once(run_monitor_execution_job, 1, context={"task_id": task_id}, name=f"monitor_{task_id}")
         update.message.reply_text(f"✅ 监控已添加，ID: `{task_id}`", parse_mode=ParseMode.MARKDOWN_V2)
     
     return show_monitor_menu(update, context)
@@ -3255,10 +6442,10 @@ def get_monitor_query_to_add(update: Update, context: CallbackContext):
 def get_monitor_id_to_remove(update: Update, context: CallbackContext):
     tid = update.message.text.strip()
     if tid in MONITOR_TASKS:
-        for job in context.job_queue.get_jobs_by_name(f"monitor_{tid}"):
-            job.schedule_removal()
         del MONITOR_TASKS[tid]
         save_monitor_tasks()
+        try: MONITOR_FINGERPRINTS.drop(tid)
+        except Exception as e: logger.error(f"清理监控字段指纹失败: {e}")
         update.message.reply_text(f"🗑️ 任务 `{tid}` 已停止并移除。", parse_mode=ParseMode.MARKDOWN_V2)
     else:
         update.message.reply_text("❌ 任务ID不存在。")
@@ -3281,7 +6468,7 @@ def get_monitor_threshold(update: Update, context: CallbackContext):
         if threshold < 0: raise ValueError
         tid = context.user_data.pop('config_monitor_id')
         MONITOR_TASKS[tid]['notification_threshold'] = threshold
-        save_monitor_tasks()
+        save_monitor_task(tid)
         update.message.reply_text(f"✅ 任务 `{tid}` 的通知阈值已更新为 *{threshold}*。", parse_mode=ParseMode.MARKDOWN_V2)
     except (ValueError, KeyError):
         update.message.reply_text("❌ 无效输入。请输入一个非负整数。")
@@ -3321,12 +6508,17 @@ def start_allfofa_search(update: Update, context: CallbackContext, message_to_ed
     # v10.9.4 FIX: Lock the proxy session for the background job.
     context.user_data['proxy_session'] = used_proxy
 
+    plan = estimate_download_plans(query_text, total_size)['cursor']
+    quota = get_pool_quota(min_level=1)
     keyboard = [
-        [InlineKeyboardButton(f"♾️ 全部获取 ({total_size}条)", callback_data='allfofa_limit_none')],
+        [InlineKeyboardButton(f"♾️ 全部获取 ({total_size}条 · {format_plan_short(plan)})", callback_data='allfofa_limit_none')],
         [InlineKeyboardButton("❌ 取消", callback_data='allfofa_limit_cancel')]
     ]
+    quota_text = f"剩余额度: 查询 {quota['queries']} 次 / 数据 {quota['data']} 条" if quota else "剩余额度: 未知"
     msg.edit_text(
         f"✅ 查询预检成功，共发现 {total_size} 条结果。\n\n"
+        f"📐 全部获取预估: {format_plan(plan, quota)}\n"
+        f"每 1 万条约需 1 次请求、~{format_duration(get_api_latency())}。{quota_text}\n\n"
         "请输入您希望获取的数量上限 (例如: 50000)，或选择全部获取。",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -3359,6 +6551,131 @@ def allfofa_get_limit(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 def run_allfofa_download_job(context: CallbackContext):
+    """
+    游标驱动的海量下载器 (search/next)
+    核心策略:
+    1. 直接复用预检阶段已取回的第一页 (initial_results / initial_next_id)，不浪费请求。
+    2. FetchPipeline: 解析/去重/写盘在各自线程中进行，抓取线程始终在预取下一页游标。
+    3. 额度耗尽换 Key、网络异常换代理，游标不丢失。
+    如果预检没有拿到游标 (Key 不支持 next 接口)，回退到智能剥离下载器。
+    """
+    job_data = context.job.context
+    bot, chat_id = context.bot, job_data['chat_id']
+    limit = job_data.get('limit')
+    original_query = job_data['query']
+    total_size = job_data.get('total_size', 0)
+    initial_results = job_data.get('initial_results') or []
+    next_id = job_data.get('initial_next_id')
+
+    if not job_data.get('start_key'):
+        bot.send_message(chat_id, "❌ 内部错误：任务上下文丢失 Key 信息。")
+        return
+
+    if not next_id and total_size > len(initial_results):
+        logger.info("预检未返回 next 游标，回退到智能剥离下载器。")
+        return run_allfofa_peeling_job(context)
+
+    # 预检用过的 Key 作为首选，但仍须经过租约管理器，避免与其他任务撞 Key
+    lease = KEY_LEASES.acquire(min_level=1, owner=f"allfofa#{job_data.get('job_id')}", prefer=job_data['start_key'], wait=60)
+    if not lease:
+        bot.send_message(chat_id, "❌ 无法启动：没有可用的 VIP Key (可能均在冷却中)。")
+        return
+    cursor_state = {'lease': lease, 'key': lease['key'], 'proxy': job_data.get('proxy_session'), 'rotations': 0}
+    target_total = min(limit, total_size) if limit else total_size
+
+    output_filename = generate_filename_from_query(original_query, prefix="cursor_all")
+    cache_path = cache_file_path(output_filename)
+    stop_flag = job_stop_flag(job_data)
+    msg = bot.send_message(chat_id, "🚀 游标下载引擎已启动 (search/next)...")
+
+    collected_results = set()
+    state = {'written': 0, 'accepted': 0, 'pages': 0, 'termination_reason': ""}
+    start_time = time.time()
+
+    def fetch_page(cursor):
+        result = fetch_next_page_with_failover(cursor_state, original_query, cursor)
+        track_job(job_data, requests=1, key=cursor_state['key'])
+        return result
+
+    def next_request(cursor, data):
+        # 游标在抓取线程里推进，当前页还在去重写盘时下一页已经发出
+        if not data.get('results'): return None
+        next_cursor = data.get('next')
+        if not next_cursor or next_cursor == cursor: return None
+        if limit and state['accepted'] >= limit: return None
+        return next_cursor
+
+    def parse_stage(data):
+        state['pages'] += 1
+        hosts = []
+        for r in data.get('results', []):
+            host = r[0] if isinstance(r, list) and r else r
+            if isinstance(host, str) and ':' in host: hosts.append(host)
+        return hosts
+
+    def dedup_stage(hosts):
+        # 上限在本阶段按已接收条数截断 (写盘在另一个线程，written 会滞后)；
+        # 不调用 pipeline.stop()，否则已截断的最后一批会在写盘前被丢弃，由 next_request 结束抓取
+        if limit and state['accepted'] >= limit: return None
+        new_lines = [h for h in hosts if h not in collected_results]
+        if limit and state['accepted'] + len(new_lines) >= limit:
+            new_lines = new_lines[:limit - state['accepted']]
+            state['termination_reason'] = f"\nℹ️ 已达到您设置的 {limit} 条上限。"
+        collected_results.update(new_lines)
+        state['accepted'] += len(new_lines)
+        return new_lines
+
+    def write_stage(new_lines):
+        if new_lines:
+            out_f.write("\n".join(new_lines) + "\n")
+            state['written'] += len(new_lines)
+            track_job(job_data, rows=state['written'], total=target_total)
+        prog_bar = create_progress_bar(state['written'] / target_total * 100 if target_total else 100)
+        OUTBOX.edit(msg,
+            f"📥 游标下载中 (第 {state['pages']} 页)\n{prog_bar}\n"
+            f"已收录: {state['written']}/{target_total} | {format_rate_eta(state['written'], target_total, start_time)}\n"
+            f"Key: ...{(cursor_state['key'] or '----')[-4:]} | 切换次数: {cursor_state['rotations']}"
+        )
+
+    try:
+        with open_cache_file(cache_path, 'w') as out_f:
+            pipeline = FetchPipeline(
+                fetch_page, next_request, first_request=None,
+                initial_data={'results': initial_results, 'next': next_id},
+                stages=[parse_stage, dedup_stage, write_stage],
+                should_stop=lambda: context.bot_data.get(stop_flag), name="allfofa_cursor")
+            pipeline.run()
+        termination_reason = state['termination_reason']
+        if pipeline.error:
+            termination_reason = f"\n❌ 第 {state['pages'] + 1} 页出错: {pipeline.error}"
+        if context.bot_data.get(stop_flag):
+            termination_reason = "\n🌀 任务已手动停止。"
+    except Exception as e:
+        logger.error(f"Cursor download fatal error: {e}", exc_info=True)
+        termination_reason = f"\n❌ 任务发生严重错误: {e}"
+    finally:
+        KEY_LEASES.release(lease)
+    written_count, page_count = state['written'], state['pages']
+
+    if written_count:
+        final_caption = (
+            f"✅ *海量下载完成*\n\n🎯 原始查询: `{escape_markdown_v2(original_query)}`\n"
+            f"🔢 最终获取: *{written_count}* 条 \\({page_count} 页\\)\n"
+            f"⏱ 耗时: {int(time.time() - start_time)}s{escape_markdown_v2(termination_reason)}"
+        )
+        send_file_safely(context, chat_id, cache_path, caption=final_caption, parse_mode=ParseMode.MARKDOWN_V2, filename=output_filename)
+        upload_and_send_links(context, chat_id, cache_path)
+        add_or_update_query(original_query, {'file_path': cache_path, 'result_count': written_count, 'high_water': cache_high_water(start_time)})
+        archive_results(original_query, collected_results)
+        offer_post_download_actions(context, chat_id, original_query)
+        OUTBOX.delete(msg)
+    else:
+        if os.path.exists(cache_path): os.remove(cache_path)
+        OUTBOX.edit_now(msg, f"🤷‍♀️ 任务结束，未收集到有效数据。{termination_reason}")
+
+    context.bot_data.pop(stop_flag, None)
+
+def run_allfofa_peeling_job(context: CallbackContext):
     """
     智能剥离下载器 (Smart Peeling + Time Slicing)
     核心策略: 
@@ -3375,43 +6692,47 @@ def run_allfofa_download_job(context: CallbackContext):
     # 原始查询
     original_query = job_data['query']
     
-    # 使用锁定的 Key 和 Proxy Session (从 allfofa command 初始化传过来的)
-    current_key = job_data.get('start_key') 
+    # 以 allfofa command 预检用过的 Key 为首选租用，Proxy Session 沿用初始化传过来的
+    if not job_data.get('start_key'):
+        bot.send_message(chat_id, "❌ 内部错误：任务上下文丢失 Key 信息。")
+        return
+    lease = KEY_LEASES.acquire(min_level=1, owner=f"allfofa#{job_data.get('job_id')}", prefer=job_data['start_key'], wait=60)
     proxy_session = job_data.get('proxy_session')
 
-    if not current_key:
-        bot.send_message(chat_id, "❌ 内部错误：任务上下文丢失 Key 信息。")
+    if not lease:
+        bot.send_message(chat_id, "❌ 无法启动：没有可用的 VIP Key (可能均在冷却中)。")
         return
 
     # 输出文件名管理
     output_filename = generate_filename_from_query(original_query, prefix="smart_all")
-    cache_path = os.path.join(FOFA_CACHE_DIR, output_filename)
+    cache_path = cache_file_path(output_filename)
     
     # 用于显示的进度更新
     msg = bot.send_message(chat_id, "🚀 智能剥离引擎已启动...\n正在分析数据分布...")
-    stop_flag = f'stop_job_{chat_id}'
+    stop_flag = job_stop_flag(job_data)
     
     current_query_scope = original_query
     collected_results = set() # 为了最后去重 (海量数据内存是个问题，但对于set str通常还能接受，如果百万级考虑落盘去重)
     
     loop_count = 0
     start_time = time.time()
-    last_ui_update = 0
 
     try:
         while True:
             loop_count += 1
             if context.bot_data.get(stop_flag):
-                msg.edit_text("🌀 任务已收到停止信号，正在中止...")
+                OUTBOX.edit_now(msg, "🌀 任务已收到停止信号，正在中止...")
                 break
                 
             if limit and len(collected_results) >= limit:
                 break
 
             # 1. 估算当前 Scope 大小
-            data_size_chk, error = fetch_fofa_data(current_key, current_query_scope, page_size=1, fields="host", proxy_session=proxy_session)
+            KEY_LEASES.renew(lease)
+            data_size_chk, error = fetch_fofa_data(lease['key'], current_query_scope, page_size=1, fields="host", proxy_session=proxy_session)
+            track_job(job_data, requests=1, key=lease['key'])
             if error: 
-                msg.edit_text(f"❌ 侦查失败: {error}")
+                OUTBOX.edit_now(msg, f"❌ 侦查失败: {error}")
                 break
             
             scope_size = data_size_chk.get('size', 0)
@@ -3419,28 +6740,29 @@ def run_allfofa_download_job(context: CallbackContext):
             # --- 阶段 A: 小数据量直接吞噬 ---
             if scope_size <= 10000: # 小于1万，一锅端
                 if loop_count == 1: 
-                    msg.edit_text(f"🔍 数据量 ({scope_size}) 小于单次限制，直接下载...")
+                    OUTBOX.edit_now(msg, f"🔍 数据量 ({scope_size}) 小于单次限制，直接下载...")
                 
                 # 普通翻页获取 (Normal Page Iteration)
                 pages = (scope_size + 9999) // 10000
                 for p in range(1, pages + 1):
                     # 获取
-                    d, e = fetch_fofa_data(current_key, current_query_scope, page=p, page_size=10000, fields="host", proxy_session=proxy_session)
+                    KEY_LEASES.renew(lease)
+                    d, e = fetch_fofa_data(lease['key'], current_query_scope, page=p, page_size=10000, fields="host", proxy_session=proxy_session)
                     if not e and d.get('results'):
                         collected_results.update([r for r in d.get('results') if isinstance(r, str) and ':' in r])
+                    track_job(job_data, rows=len(collected_results), requests=1)
                     
                     # 进度UI
-                    if time.time() - last_ui_update > 3:
-                        msg.edit_text(f"📥 直接下载中... (已收录: {len(collected_results)})")
-                        last_ui_update = time.time()
+                    OUTBOX.edit(msg, f"📥 直接下载中... (已收录: {len(collected_results)})\n{format_rate_eta(len(collected_results), limit, start_time)}")
                         
                 break # 当前剩余的所有都在这一轮被拿走了，大循环结束
 
             # --- 阶段 B: 大数据量空间剥离 (Country Slicing) ---
             # 获取 Top1 国家
-            stats_data, e = fetch_fofa_stats(current_key, current_query_scope, proxy_session=proxy_session)
+            KEY_LEASES.renew(lease)
+            stats_data, e = fetch_fofa_stats(lease['key'], current_query_scope, proxy_session=proxy_session)
             if e: 
-                msg.edit_text(f"❌ 聚合分析失败: {e}")
+                OUTBOX.edit_now(msg, f"❌ 聚合分析失败: {e}")
                 break
             
             aggs = stats_data.get("aggs", stats_data)
@@ -3468,7 +6790,7 @@ def run_allfofa_download_job(context: CallbackContext):
             # 对 Slice 使用深度追溯下载 (Time Peeling)
             # 用户核心策略：复用深度追溯，利用时间轴把这个巨大的 slice 扒下来
             trace_count_added = 0
-            iterator = iter_fofa_traceback(current_key, slice_query, limit=limit, proxy_session=proxy_session)
+            iterator = iter_fofa_traceback(lease['key'], slice_query, limit=limit, proxy_session=proxy_session, lease=lease)
             
             for batch in iterator:
                 if context.bot_data.get(stop_flag): break
@@ -3482,20 +6804,17 @@ def run_allfofa_download_job(context: CallbackContext):
                         new_items_count += 1
                         
                 trace_count_added += new_items_count
+                track_job(job_data, rows=len(collected_results), requests=1)
                 
-                if time.time() - last_ui_update > 3:
-                    try:
-                        prog_bar = create_progress_bar(min(len(collected_results) / (limit or (len(collected_results)+100000)) * 100, 100))
-                        # 修改点：对 slice_desc 使用 escape_markdown_v2
-                        msg.edit_text(
-                            f"✂️ *正在剥离数据块:* `{escape_markdown_v2(slice_desc)}`\n"
-                            f"📉 策略: 时间轴降维打击 \(Time Trace\)\n"
-                            f"{prog_bar} 总数: {len(collected_results)}\n"
-                            f"\\(本轮新增: {trace_count_added}\\)", # 建议：这里的括号也顺手转义一下，虽然不是必须
-                            parse_mode=ParseMode.MARKDOWN_V2
-                        )
-                    except Exception: pass
-                    last_ui_update = time.time()
+                prog_bar = create_progress_bar(min(len(collected_results) / (limit or (len(collected_results)+100000)) * 100, 100))
+                # 修改点：对 slice_desc 使用 escape_markdown_v2
+                OUTBOX.edit(msg,
+                    f"✂️ *正在剥离数据块:* `{escape_markdown_v2(slice_desc)}`\n"
+                    f"📉 策略: 时间轴降维打击 \(Time Trace\)\n"
+                    f"{prog_bar} 总数: {len(collected_results)}\n"
+                    f"\\(本轮新增: {trace_count_added}\\) {escape_markdown_v2(format_rate_eta(len(collected_results), limit, start_time))}",
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
                 
                 if limit and len(collected_results) >= limit: break
             
@@ -3506,13 +6825,15 @@ def run_allfofa_download_job(context: CallbackContext):
             current_query_scope = next_round_query
             # 防止无限死循环保护 (例如 Stats 返回空但Size > 0)
             if loop_count > 50:
-                msg.edit_text("⚠️ 警告：智能剥离循环次数过多，自动停止以防死锁。")
+                OUTBOX.edit_now(msg, "⚠️ 警告：智能剥离循环次数过多，自动停止以防死锁。")
                 break
 
     except Exception as e:
         logger.error(f"Smart download fatal error: {e}", exc_info=True)
-        msg.edit_text(f"❌ 任务发生严重错误: {e}")
+        OUTBOX.edit_now(msg, f"❌ 任务发生严重错误: {e}")
         return
+    finally:
+        KEY_LEASES.release(lease)
     
     # 结果交付
     final_limit_msg = ""
@@ -3521,22 +6842,23 @@ def run_allfofa_download_job(context: CallbackContext):
     if collected_results:
         # 排序并写入文件
         sorted_results = sorted(list(collected_results))
-        with open(cache_path, 'w', encoding='utf-8') as f:
+        with open_cache_file(cache_path, 'w') as f:
             f.write("\n".join(sorted_results))
             
         final_caption = f"✅ *海量下载完成*\n\n🎯 原始查询: `{escape_markdown_v2(original_query)}`\n🔢 最终获取: *{len(collected_results)}* 条{escape_markdown_v2(final_limit_msg)}\n⏱ 耗时: {int(time.time()-start_time)}s"
-        send_file_safely(context, chat_id, cache_path, caption=final_caption, parse_mode=ParseMode.MARKDOWN_V2)
+        send_file_safely(context, chat_id, cache_path, caption=final_caption, parse_mode=ParseMode.MARKDOWN_V2, filename=output_filename)
         upload_and_send_links(context, chat_id, cache_path)
         
         # 本地记录更新
-        cache_entry = {'file_path': cache_path, 'result_count': len(collected_results)}
+        cache_entry = {'file_path': cache_path, 'result_count': len(collected_results), 'high_water': cache_high_water(start_time)}
         add_or_update_query(original_query, cache_entry)
+        archive_results(original_query, collected_results)
         
         offer_post_download_actions(context, chat_id, original_query)
-        msg.delete() # 删掉进度条
+        OUTBOX.delete(msg) # 删掉进度条
         
     else:
-        msg.edit_text("🤷‍♀️ 任务结束，未收集到有效数据。")
+        OUTBOX.edit_now(msg, "🤷‍♀️ 任务结束，未收集到有效数据。")
     
     context.bot_data.pop(stop_flag, None)
 
@@ -3682,6 +7004,7 @@ def _build_preview_message(context: CallbackContext, page: int):
     return message, InlineKeyboardMarkup(keyboard)
 
 
+@interactive_command("preview")
 def preview_command(update: Update, context: CallbackContext) -> int:
     """/preview 和 /p 命令的入口点，支持自定义数量。"""
     if not context.args:
@@ -3919,6 +7242,67 @@ def preview_page_callback(update: Update, context: CallbackContext):
     return PREVIEW_STATE_PAGINATE
 
 
+# --- /cachepreview 命令 ---
+# 直接翻阅本地缓存文件，借助行索引只解压当前页所在的块，不消耗 FOFA 额度。
+CACHE_PREVIEW_PAGE_SIZE = 50
+CACHE_PREVIEW_LINE_MAX = 200
+
+def _cached_history_entries():
+    return [q for q in HISTORY['queries'] if q.get('cache') and os.path.exists(q['cache'].get('file_path', ''))]
+
+def _build_cache_preview(entry, page):
+    """返回 (文本, 按钮)。页码从 1 开始，超出范围时自动收敛到首/末页。"""
+    file_path = entry['cache']['file_path']
+    total = count_lines(file_path)
+    total_pages = max(1, math.ceil(total / CACHE_PREVIEW_PAGE_SIZE))
+    page = min(max(1, page), total_pages)
+    start = (page - 1) * CACHE_PREVIEW_PAGE_SIZE
+    lines = read_lines(file_path, start, CACHE_PREVIEW_PAGE_SIZE)
+    body = [f"{start + i + 1}. {line[:CACHE_PREVIEW_LINE_MAX]}{'…' if len(line) > CACHE_PREVIEW_LINE_MAX else ''}" for i, line in enumerate(lines)]
+    text = f"🗂️ 缓存预览: {entry['query_text']}\n共 {total} 条 | 第 {page}/{total_pages} 页\n\n" + ("\n".join(body) or "(空)")
+    fingerprint = query_fingerprint(entry['query_text'])
+    nav_row = []
+    if page > 1: nav_row.append(InlineKeyboardButton("◀️ 上一页", callback_data=f"cpv_{fingerprint}_{page - 1}"))
+    if page < total_pages: nav_row.append(InlineKeyboardButton("下一页 ▶️", callback_data=f"cpv_{fingerprint}_{page + 1}"))
+    return text[:4000], InlineKeyboardMarkup([nav_row]) if nav_row else None
+
+@admin_only
+def cache_preview_command(update: Update, context: CallbackContext):
+    """/cachepreview [序号] [页码]: 分页查看已缓存的查询结果。"""
+    entries = _cached_history_entries()
+    if not entries: update.message.reply_text("📭 当前没有可预览的缓存结果。"); return
+    args = context.args or []
+    if not args:
+        lines = [f"{i}. {q['query_text']} ({q['cache'].get('result_count', '?')} 条)" for i, q in enumerate(entries[:20], 1)]
+        update.message.reply_text("🗂️ 已缓存的查询:\n" + "\n".join(lines) + "\n\n用法: /cachepreview <序号> [页码]")
+        return
+    if not args[0].isdigit() or not 1 <= int(args[0]) <= len(entries) or (len(args) > 1 and not args[1].isdigit()):
+        update.message.reply_text("❌ 用法: /cachepreview <序号> [页码]"); return
+    page = int(args[1]) if len(args) > 1 else 1
+    try:
+        text, markup = _build_cache_preview(entries[int(args[0]) - 1], page)
+    except Exception as e:
+        logger.error(f"读取缓存预览失败: {e}", exc_info=True)
+        update.message.reply_text(f"❌ 读取缓存失败: {e}"); return
+    update.message.reply_text(text, reply_markup=markup, disable_web_page_preview=True)
+
+@admin_only
+def cache_preview_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    _, fingerprint, page = query.data.split('_', 2)
+    entry = STATE.get_history_by_fingerprint(fingerprint)
+    if not entry or not entry.get('cache') or not os.path.exists(entry['cache'].get('file_path', '')):
+        query.answer("缓存已失效。", show_alert=True); return
+    query.answer()
+    try:
+        text, markup = _build_cache_preview(entry, int(page))
+        query.edit_message_text(text, reply_markup=markup, disable_web_page_preview=True)
+    except BadRequest as e:
+        if "Message is not modified" not in str(e): logger.error(f"编辑缓存预览消息时出错: {e}")
+    except Exception as e:
+        logger.error(f"读取缓存预览失败: {e}", exc_info=True)
+
+
 # --- 主函数与调度器 ---
 def interactive_setup():
     """Handles the initial interactive setup for the bot."""
@@ -3965,6 +7349,8 @@ def main() -> None:
     except (ValueError, resource.error) as e:
         logger.warning(f"无法提升 FD 限制（需要 root 或修改 /etc/security/limits.conf）: {e}")
     os.makedirs(FOFA_CACHE_DIR, exist_ok=True)
+    CACHE_MANAGER.sweep()
+    threading.Thread(target=backfill_asset_store, daemon=True, name="asset_backfill").start()
 
     if not os.path.exists(CONFIG_FILE) or CONFIG.get("bot_token") == "YOUR_BOT_TOKEN_HERE":
         if not interactive_setup():
@@ -3980,7 +7366,8 @@ def main() -> None:
                 continue
 
             check_and_classify_keys()
-            updater = Updater(token=bot_token, use_context=True, request_kwargs={'read_timeout': 20, 'connect_timeout': 20})
+            # 交互命令以 run_async 在 Dispatcher 线程池执行，批量任务在 JobQueue 线程中运行，二者线程互不占用
+            updater = Updater(token=bot_token, use_context=True, workers=int(CONFIG.get('interactive_workers', 8)), request_kwargs={'read_timeout': 20, 'connect_timeout': 20})
             break  # Break loop if updater is created successfully
         except InvalidToken:
             logger.error("!!!!!! 无效的 Bot Token !!!!!!")
@@ -4005,7 +7392,7 @@ def main() -> None:
         BotCommand("backup", "📤 备份配置"), BotCommand("restore", "📥 恢复配置"),
         BotCommand("update", "🔄 在线更新脚本"), BotCommand("getlog", "📄 获取日志"),
         BotCommand("shutdown", "🔌 关闭机器人"), BotCommand("stop", "🛑 停止任务"),
-        BotCommand("monitor", "📡 监控雷达 (添加/列表/删除)"), BotCommand("cancel", "❌ 取消操作")
+        BotCommand("jobs", "📋 任务面板"), BotCommand("assets", "🗃️ 本地资产库"), BotCommand("cachepreview", "🗂️ 翻阅本地缓存"), BotCommand("monitor", "📡 监控雷达 (添加/列表/删除)"), BotCommand("cancel", "❌ 取消操作")
     ]
     try: updater.bot.set_my_commands(commands)
     except Exception as e: logger.warning(f"设置机器人命令失败: {e}")
@@ -4079,7 +7466,7 @@ def main() -> None:
     stats_conv = ConversationHandler(entry_points=[CommandHandler("stats", stats_command)], states={STATS_STATE_GET_QUERY: [MessageHandler(Filters.text & ~Filters.command, get_fofa_stats_query)]}, fallbacks=[CommandHandler("cancel", cancel)], conversation_timeout=300)
     batchfind_conv = ConversationHandler(entry_points=[CommandHandler("batchfind", batchfind_command)], states={BATCHFIND_STATE_GET_FILE: [MessageHandler(Filters.document.mime_type("text/plain"), get_batch_file_handler)], BATCHFIND_STATE_SELECT_FEATURES: [CallbackQueryHandler(select_batch_features_callback, pattern=r"^batchfeature_")]}, fallbacks=[CommandHandler("cancel", cancel)], conversation_timeout=300)
     restore_conv = ConversationHandler(entry_points=[CommandHandler("restore", restore_config_command)], states={RESTORE_STATE_GET_FILE: [MessageHandler(Filters.document, receive_config_file)]}, fallbacks=[CommandHandler("cancel", cancel)], conversation_timeout=300)
-    scan_conv = ConversationHandler(entry_points=[CallbackQueryHandler(start_scan_callback, pattern=r'^start_scan_')], states={SCAN_STATE_GET_CONCURRENCY: [MessageHandler(Filters.text & ~Filters.command, get_concurrency_callback)], SCAN_STATE_GET_TIMEOUT: [MessageHandler(Filters.text & ~Filters.command, get_timeout_callback)]}, fallbacks=[CommandHandler('cancel', cancel)], conversation_timeout=120)
+    scan_conv = ConversationHandler(entry_points=[CallbackQueryHandler(start_scan_callback, pattern=r'^start_scan_')], states={SCAN_STATE_GET_CONCURRENCY: [MessageHandler(Filters.text & ~Filters.command, get_concurrency_callback)], SCAN_STATE_GET_TIMEOUT: [MessageHandler(Filters.text & ~Filters.command, get_timeout_callback)], SCAN_STATE_GET_PROBES: [MessageHandler(Filters.text & ~Filters.command, get_probes_callback)]}, fallbacks=[CommandHandler('cancel', cancel)], conversation_timeout=120)
     batch_check_api_conv = ConversationHandler(entry_points=[CommandHandler("batchcheckapi", batch_check_api_command)], states={BATCHCHECKAPI_STATE_GET_FILE: [MessageHandler(Filters.document.mime_type("text/plain"), receive_api_file)]}, fallbacks=[CommandHandler("cancel", cancel)], conversation_timeout=300)
     
     # 新增预览功能的会话处理器
@@ -4092,26 +7479,32 @@ def main() -> None:
         conversation_timeout=300
     )
 
-    dispatcher.add_handler(CommandHandler("start", start_command)); dispatcher.add_handler(CommandHandler("help", help_command)); dispatcher.add_handler(CommandHandler("host", host_command)); dispatcher.add_handler(CommandHandler("lowhost", lowhost_command)); dispatcher.add_handler(CommandHandler("check", check_command)); dispatcher.add_handler(CommandHandler("stop", stop_all_tasks)); dispatcher.add_handler(CommandHandler("backup", backup_config_command)); dispatcher.add_handler(CommandHandler("history", history_command)); dispatcher.add_handler(CommandHandler("getlog", get_log_command)); dispatcher.add_handler(CommandHandler("shutdown", shutdown_command)); dispatcher.add_handler(CommandHandler("update", update_script_command)); dispatcher.add_handler(CommandHandler("monitor", monitor_command)) # 注册监控命令
-    dispatcher.add_handler(InlineQueryHandler(inline_fofa_handler)); 
+    dispatcher.add_handler(CommandHandler("start", start_command)); dispatcher.add_handler(CommandHandler("help", help_command)); dispatcher.add_handler(CommandHandler("host", host_command, run_async=True)); dispatcher.add_handler(CommandHandler("lowhost", lowhost_command, run_async=True)); dispatcher.add_handler(CommandHandler("check", check_command)); dispatcher.add_handler(CommandHandler("stop", stop_all_tasks)); dispatcher.add_handler(CommandHandler("jobs", jobs_command)); dispatcher.add_handler(CommandHandler("assets", assets_command, run_async=True)); dispatcher.add_handler(CommandHandler("cachepreview", cache_preview_command, run_async=True)); dispatcher.add_handler(CallbackQueryHandler(cache_preview_callback, pattern=r"^cpv_", run_async=True)); dispatcher.add_handler(CommandHandler("backup", backup_config_command)); dispatcher.add_handler(CommandHandler("history", history_command)); dispatcher.add_handler(CommandHandler("getlog", get_log_command)); dispatcher.add_handler(CommandHandler("shutdown", shutdown_command)); dispatcher.add_handler(CommandHandler("update", update_script_command)); dispatcher.add_handler(CommandHandler("monitor", monitor_command)) # 注册监控命令
+    dispatcher.add_handler(InlineQueryHandler(inline_fofa_handler, run_async=True)); 
     
     # --- 恢复监控任务 ---
+    # 到期时间沿用上次的计划；重启后即使大量任务同时到期，也由调度器按预算匀速放行
     if MONITOR_TASKS:
         count = 0
         for task_id, task in MONITOR_TASKS.items():
             if task.get('status') == 'active':
-                # 计算初始延迟：分散启动，避免洪峰 (0 - 60s)
-                delay = random.randint(5, 60)
-                updater.job_queue.run_once(run_monitor_execution_job, delay, context={"task_id": task_id, "is_restore": True}, name=f"monitor_{task_id}")
+                task.setdefault('next_due', task.get('last_run', 0) + task.get('interval', 3600))
                 count += 1
         logger.info(f"已恢复 {count} 个监控任务。")
+    # 必须在 start_polling 启动调度器之前设置，否则 APScheduler 会创建默认的 10 线程执行器
+    updater.job_queue.scheduler.add_executor(
+        ThreadPoolExecutor(max_workers=JOB_SCHEDULER.capacity() + JOB_QUEUE_RESERVED_THREADS), 'default')
+    updater.job_queue.run_repeating(monitor_tick_job, interval=MONITOR_TICK_SECONDS, first=10, name="monitor_tick")
+    updater.job_queue.run_repeating(cache_maintenance_job, interval=CACHE_SWEEP_INTERVAL, first=CACHE_SWEEP_INTERVAL, name="cache_maintenance")
     dispatcher.add_handler(settings_conv); dispatcher.add_handler(query_conv); dispatcher.add_handler(batch_conv); dispatcher.add_handler(import_conv); dispatcher.add_handler(stats_conv); dispatcher.add_handler(batchfind_conv); dispatcher.add_handler(restore_conv); dispatcher.add_handler(scan_conv); dispatcher.add_handler(batch_check_api_conv); dispatcher.add_handler(preview_conv)
     
     logger.info(f"🚀 Fofa Bot v10.9 (稳定版) 已启动...")
     updater.start_polling()
     updater.idle()
+    PERSIST.flush()
     logger.info("Bot has been shut down gracefully.")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # 分片扫描以 spawn 方式启动子进程
     main()
 